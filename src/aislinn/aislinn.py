@@ -19,6 +19,14 @@
 
 
 from mpi.generator import Generator
+from mpi.workerprocess import ProcessGenerator
+from mpi.sampling import SamplingGenerator, parse_trace
+from mpi.hosts import (HostGenerator,
+                       run_worker_host,
+                       parse_address,
+                       get_auth_key)
+from mpi.search import get_search_queue_class
+from mpi.zygote import ZygoteServer
 from base.arc import STREAM_STDOUT, STREAM_STDERR
 import base.report as report
 import base.paths as paths
@@ -46,6 +54,16 @@ def parse_threshold(value):
     return (size1, size2)
 
 
+def parse_watermarks(value):
+    values = value.split(":")
+    if len(values) != 2 or not all(utils.is_integer(v) for v in values):
+        return None
+    high, low = int(values[0]), int(values[1])
+    if low < 0 or high < low:
+        return None
+    return (high, low)
+
+
 def positive_int(value):
     i = int(value)
     if i <= 0:
@@ -70,6 +88,7 @@ def parse_args():
     parser.add_argument("program",
                         metavar="PROGRAM",
                         type=str,
+                        nargs="?",
                         help="Path to your program")
 
     parser.add_argument("args",
@@ -99,6 +118,12 @@ def parse_args():
                         type=size_type,
                         help="Allocation red zones")
 
+    parser.add_argument("--shm-size",
+                        metavar="SIZE",
+                        type=size_type,
+                        help="Size of memory shared with Valgrind "
+                             "processes for bulk data")
+
     parser.add_argument("-S", "--send-protocol",
                         metavar="VALUE",
                         type=str,
@@ -111,6 +136,56 @@ def parse_args():
                         default=1,
                         help="Number of workers")
 
+    parser.add_argument("--gcontexts",
+                        metavar="N",
+                        type=int,
+                        default=1,
+                        help="Number of states expanded at once "
+                             "by a worker")
+
+    parser.add_argument("--cleanup-interval",
+                        metavar="N",
+                        type=positive_int,
+                        default=16,
+                        help="Free unused buffers in Valgrind after "
+                             "every N expansions (default: 16)")
+
+    parser.add_argument("--clone-workers",
+                        action="store_true",
+                        help="Create processes of workers as clones "
+                             "of processes of the first worker")
+
+    parser.add_argument("--worker-processes",
+                        action="store_true",
+                        help="Run each worker in a separate process")
+
+    parser.add_argument("--listen",
+                        metavar="[HOST:]PORT",
+                        type=str,
+                        help="Wait for workers started on other hosts "
+                             "by --connect")
+
+    parser.add_argument("--connect",
+                        metavar="HOST:PORT",
+                        type=str,
+                        help="Run a worker for aislinn started with --listen")
+
+    parser.add_argument("--fake-remote",
+                        action="store_true",
+                        help="Run workers as local hosts connected by TCP")
+
+    parser.add_argument("--zygote",
+                        metavar="PATH",
+                        type=str,
+                        help="Take started valgrind processes from "
+                             "a server started by --zygote-server")
+
+    parser.add_argument("--zygote-server",
+                        metavar="PATH",
+                        type=str,
+                        help="Keep started valgrind processes for "
+                             "the program and serve them on the socket PATH")
+
     parser.add_argument("--report-type",
                         metavar="TYPE",
                         choices=["html", "xml", "none", "html+xml"],
@@ -151,7 +226,64 @@ def parse_args():
                         metavar="SEARCH",
                         type=str,
                         default="bfs",
-                        help="Statespace search strategy (bfs or dfs)")
+                        help="Statespace search strategy "
+                             "(bfs, dfs, adaptive, requests, deep, cached "
+                             "or MODULE:CLASS)")
+
+    parser.add_argument("--search-watermarks",
+                        metavar="HIGH:LOW",
+                        type=str,
+                        default="1000:100",
+                        help="Watermarks of adaptive search")
+
+    parser.add_argument("--spill-queue",
+                        metavar="N",
+                        type=int,
+                        default=0,
+                        help="Write Valgrind states of cold queue entries "
+                             "to disk when a worker's queue holds more than "
+                             "N entries in memory")
+
+    parser.add_argument("--spill-dir",
+                        metavar="DIR",
+                        type=str,
+                        default=None,
+                        help="Directory for states written by --spill-queue "
+                             "and --state-memory")
+
+    parser.add_argument("--state-memory",
+                        metavar="SIZE",
+                        type=size_type,
+                        default=None,
+                        help="Memory of each Valgrind process above which "
+                             "least recently used states are written "
+                             "to disk")
+
+    parser.add_argument("--sample",
+                        metavar="N",
+                        type=int,
+                        default=0,
+                        help="Check N random runs instead of "
+                             "the whole statespace")
+
+    parser.add_argument("--sample-time",
+                        metavar="SECONDS",
+                        type=int,
+                        help="Time limit for random runs")
+
+    parser.add_argument("--sample-seed",
+                        metavar="SEED",
+                        type=int,
+                        help="Seed for random runs")
+
+    parser.add_argument("--replay",
+                        metavar="TRACE",
+                        type=str,
+                        help="Check the run given by a trace from the report")
+
+    parser.add_argument("--por",
+                        action="store_true",
+                        help="Partial order reduction (sleep sets)")
 
     parser.add_argument("--write-dot",
                         action="store_true")
@@ -159,6 +291,10 @@ def parse_args():
     parser.add_argument("--profile",
                         action="store_true")
 
+    parser.add_argument("--event-stacktraces",
+                        action="store_true",
+                        help="Obtain stack traces of all MPI calls")
+
     # Internal debug options
     parser.add_argument("--debug-state",
                         metavar="NAME",
@@ -192,8 +328,15 @@ def parse_args():
                         type=int,
                         default=0,
                         help="Verbosity of valgrind tool")
+    parser.add_argument("--debug-text-protocol",
+                        action="store_true",
+                        help="Use text protocol for controlling "
+                             "valgrind tool")
     parser.add_argument("--debug-stats",
                         action="store_true")
+    parser.add_argument("--debug-no-local-answers",
+                        action="store_true",
+                        help="Send all MPI calls to the controller")
 
 
     args = parser.parse_args()
@@ -226,10 +369,89 @@ def parse_args():
                         level=level)
     logging.info("Aislinn v%s", VERSION_STRING)
 
-    if args.search != "bfs" and args.search != "dfs":
+    if get_search_queue_class(args.search) is None:
         logging.error("Invalid argument for --search")
         sys.exit(1)
 
+    args.search_watermarks = parse_watermarks(args.search_watermarks)
+    if args.search_watermarks is None:
+        logging.error("Invalid argument for --search-watermarks")
+        sys.exit(1)
+
+    if args.gcontexts < 1:
+        logging.error("Invalid argument for --gcontexts")
+        sys.exit(1)
+
+    if args.connect:
+        args.connect = parse_address(args.connect)
+        if args.connect is None:
+            logging.error("Invalid argument for --connect")
+            sys.exit(1)
+        if get_auth_key() is None:
+            logging.error("Variable AISLINN_AUTH_KEY is not set")
+            sys.exit(1)
+        return args
+
+    if args.program is None:
+        logging.error("No program specified")
+        sys.exit(1)
+
+    if args.listen:
+        if parse_address(args.listen) is None:
+            logging.error("Invalid argument for --listen")
+            sys.exit(1)
+        if get_auth_key() is None:
+            logging.error("Variable AISLINN_AUTH_KEY is not set")
+            sys.exit(1)
+
+    if (args.zygote or args.zygote_server) and \
+            (args.workers > 1 or args.worker_processes or args.listen or
+             args.fake_remote or args.debug_by_valgrind_tool or
+             args.debug_vglogfile):
+        logging.error("--zygote and --zygote-server cannot be used with "
+                      "more workers or valgrind debugging options")
+        sys.exit(1)
+
+    if args.zygote and args.zygote_server:
+        logging.error("--zygote and --zygote-server cannot be used together")
+        sys.exit(1)
+
+    if args.listen and args.fake_remote:
+        logging.error("--listen and --fake-remote cannot be used together")
+        sys.exit(1)
+
+    if args.listen or args.fake_remote:
+        args.worker_processes = True
+
+    if args.sample < 0:
+        logging.error("Invalid argument for --sample")
+        sys.exit(1)
+
+    if args.sample_time is not None and args.sample_time <= 0:
+        logging.error("Invalid argument for --sample-time")
+        sys.exit(1)
+
+    if args.replay is not None and parse_trace(args.replay) is None:
+        logging.error("Invalid argument for --replay")
+        sys.exit(1)
+
+    if args.sample or args.sample_time or args.replay is not None:
+        if args.worker_processes or args.por or args.gcontexts > 1:
+            logging.error("Random runs cannot be used with "
+                          "--worker-processes, --por and --gcontexts")
+            sys.exit(1)
+
+    if args.clone_workers and args.worker_processes:
+        logging.error("--clone-workers cannot be used "
+                      "with --worker-processes")
+        sys.exit(1)
+
+    if args.worker_processes and \
+            (args.debug_state or args.debug_compare_states):
+        logging.error("--debug-state and --debug-compare-states "
+                      "cannot be used with --worker-processes")
+        sys.exit(1)
+
     if args.send_protocol not in ("full", "eager", "rendezvous"):
         threshold = parse_threshold(args.send_protocol)
         if threshold is None:
@@ -287,6 +509,14 @@ def check_program(program):
 
 def main():
     args = parse_args()
+    if args.connect:
+        paths.configure()
+        if paths.VALGRIND_BIN is None:
+            logging.error("Valgrind not found")
+            sys.exit(2)
+        run_worker_host(args.connect, get_auth_key())
+        return
+
     run_args = [check_program(args.program)] + args.args
 
     if platform.architecture()[0] != "64bit" or platform.system() != "Linux":
@@ -303,9 +533,18 @@ def main():
         sys.exit(2)
     logging.debug("Path to Valgrind: %s", paths.VALGRIND_BIN)
 
-    generator = Generator(run_args,
-                          args.p,
-                          args)
+    if args.zygote_server:
+        ZygoteServer(args.zygote_server, run_args, args.p, args).serve()
+        return
+
+    if args.sample or args.sample_time or args.replay is not None:
+        generator = SamplingGenerator(run_args, args.p, args)
+    elif args.listen or args.fake_remote:
+        generator = HostGenerator(run_args, args.p, args)
+    elif args.worker_processes:
+        generator = ProcessGenerator(run_args, args.p, args)
+    else:
+        generator = Generator(run_args, args.p, args)
 
     if args.debug_profile:
         import cProfile
@@ -22,6 +22,7 @@ class Node:
 
     allocations = None
     indegree = 0
+    sleep_set = None
 
     def __init__(self, uid, hash):
         self.uid = uid
@@ -178,6 +178,28 @@ class Report:
             E("search", generator.search, "Search strategy"),
         ]
 
+        if generator.por:
+            self.analysis_configuration.append(
+                E("por", "sleep sets", "Partial order reduction"))
+
+        if args.sample or args.sample_time or args.replay is not None:
+            self.analysis_configuration.append(
+                E("sample", generator.sample_count or "unlimited",
+                  "Random walks"))
+
+        if args.gcontexts > 1:
+            self.analysis_configuration.append(
+                E("gcontexts", args.gcontexts, "States expanded at once"))
+
+        if args.spill_queue:
+            self.analysis_configuration.append(
+                E("spill-queue", args.spill_queue, "Queue spilling limit"))
+
+        if args.state_memory:
+            self.analysis_configuration.append(
+                E("state-memory", args.state_memory,
+                  "Memory for states per process (bytes)"))
+
         if args.heap_size:
             self.analysis_configuration.append(
                 E("heap-size", args.heap_size, "Heap size"))
@@ -209,9 +231,15 @@ class Report:
             E("nodes",
               generator.statespace.nodes_count,
               "Number of nodes in statespace"),
+            E("arcs",
+              generator.statespace.arcs_count,
+              "Number of arcs in statespace"),
             E("mpi_calls",
               generator.statespace.mpi_calls_count,
               "Number of MPI calls processed during the analysis"),
+            E("local-calls",
+              generator.get_local_calls_count(),
+              "MPI calls answered by the Valgrind tool"),
             E("full-statespace",
               generator.is_full_statespace,
               "Statespace fully explored"),
@@ -219,6 +247,34 @@ class Report:
               generator.statespace.nodes_count/execution_time.total_seconds(),
               "Nodes per seconds"),
         ]
+        if args.sample or args.sample_time or args.replay is not None:
+            self.analysis_details.append(
+                E("walks", generator.walks_count, "Finished random walks"))
+
+        if args.state_memory:
+            hits, misses, evictions = generator.get_state_store_counters()
+            self.analysis_details.append(
+                E("state-store-hits", hits,
+                  "Restored states that were kept in memory"))
+            self.analysis_details.append(
+                E("state-store-misses", misses,
+                  "Restored states that were loaded from disk"))
+            self.analysis_details.append(
+                E("state-store-evictions", evictions,
+                  "States written to disk by --state-memory"))
+
+        if args.zygote:
+            self.analysis_details.append(
+                E("zygote-controllers", generator.zygote.attached_count,
+                  "Valgrind processes taken from the zygote server"))
+
+        if generator.search == "adaptive":
+            switches = ", ".join("{0:.2f}s worker {1}: {2}".format(*s)
+                                 for s in generator.get_search_switches())
+            self.analysis_details.append(
+                E("search-switches", switches or "none",
+                  "Switches of adaptive search"))
+
         self.error_messages = generator.error_messages
 
     @property
@@ -253,6 +309,8 @@ class Report:
                     e.set(name, str(value))
             if error.pid is not None:
                 e.set("pid", str(error.pid))
+            if error.trace is not None:
+                e.set("trace", error.trace)
             root.append(e)
             ev = xml.Element("events")
             root.append(ev)
@@ -34,6 +34,10 @@ class StateSpace:
     def nodes_count(self):
         return len(self.nodes_with_hash) + len(self.nodes_without_hash)
 
+    @property
+    def arcs_count(self):
+        return sum(len(node.arcs) for node in self.all_nodes())
+
     @property
     def mpi_calls_count(self):
         count = 0
@@ -207,6 +207,12 @@ def test_nodes_count(sspace_empty, sspace_complex, sspace_fork1):
     assert sspace_fork1.nodes_count == 3
 
 
+def test_arcs_count(sspace_empty, sspace_complex, sspace_fork1):
+    assert sspace_empty.arcs_count == 0
+    assert sspace_complex.arcs_count == 12
+    assert sspace_fork1.arcs_count == 2
+
+
 def test_outputs_empty(sspace_empty):
     assert sspace_empty.get_all_outputs(STREAM_STDOUT, 0) == set(("",))
 
@@ -21,9 +21,15 @@ import base.utils as utils
 import copy
 
 
+def is_independent(key1, key2):
+    # The second item of a key contains pids touched by the action
+    return not set(key1[1]).intersection(key2[1])
+
+
 class Action(utils.EqMixin):
 
     action_index = 0
+    sleep_set = None
 
     def transfer(self, transfer_context):
         return self
@@ -31,6 +37,8 @@ class Action(utils.EqMixin):
 
 class ActionMatching(utils.EqMixin):
 
+    sleep_set = None
+
     def __init__(self, matching):
         self.matching = matching
 
@@ -49,6 +57,11 @@ class ActionMatching(utils.EqMixin):
     def name(self):
         return "M[{},{}]".format(self.matching[0], self.matching[2])
 
+    @property
+    def key(self):
+        source_pid, s, target_pid, r = self.matching
+        return ("M", (source_pid, target_pid), s.id, r.id)
+
     """
     def is_dependent(self, action):
         return (self.matching[2] == action.matching[2]
@@ -71,6 +84,10 @@ class ActionWaitAny(Action):
     def name(self):
         return "WA[{},{}]".format(self.pid, self.index)
 
+    @property
+    def key(self):
+        return ("WA", (self.pid,), self.index)
+
 
 class ActionWaitSome(Action):
 
@@ -87,6 +104,10 @@ class ActionWaitSome(Action):
     def name(self):
         return "WS[{},{}]".format(self.pid, self.indices)
 
+    @property
+    def key(self):
+        return ("WS", (self.pid,), tuple(self.indices))
+
 
 class ActionFlag0(Action):
 
@@ -102,6 +123,10 @@ class ActionFlag0(Action):
     def name(self):
         return "F0[{}]".format(self.pid)
 
+    @property
+    def key(self):
+        return ("F0", (self.pid,))
+
 
 class ActionProbePromise(Action):
 
@@ -120,6 +145,11 @@ class ActionProbePromise(Action):
     def name(self):
         return "PP[{}]".format(self.pid)
 
+    @property
+    def key(self):
+        return ("PP", (self.pid,),
+                self.comm_id, self.source, self.tag, self.rank)
+
 
 class ActionTestAll(Action):
 
@@ -134,3 +164,7 @@ class ActionTestAll(Action):
     @property
     def name(self):
         return "TA[{}]".format(self.pid)
+
+    @property
+    def key(self):
+        return ("TA", (self.pid,))
@@ -20,6 +20,7 @@
 from base.arc import STREAM_STDOUT, STREAM_STDERR, COUNTER_INSTRUCTIONS
 from base.arc import COUNTER_ALLOCATIONS, COUNTER_SIZE_ALLOCATIONS
 from base.utils import convert_type
+from state import State
 import errormsg
 import consts
 import ops
@@ -30,6 +31,10 @@ import event
 
 class Allocation:
 
+    # Allocations are compared by identity, key identifies an allocation
+    # when it is sent between worker processes
+    key = None
+
     def __init__(self, pid, addr, size):
         self.pid = pid
         self.addr = addr
@@ -56,9 +61,26 @@ class Context:
     def generator(self):
         return self.gcontext.generator
 
+    def get_event_stacktrace(self):
+        # Stack traces are obtained only when they are needed,
+        # the process has to be still in the call of the event
+        e = self.event
+        if e.stacktrace is None and self.controller is not None:
+            e.stacktrace = self.controller.get_stacktrace()
+        return e.stacktrace
+
     def save_state_with_hash(self):
         self.state.vg_state = self.controller.save_state_with_hash()
 
+    def release_controller(self):
+        # The process is not running; unless it is finished,
+        # its state is saved and restored when it is needed again
+        assert not self.controller.running
+        if self.state.status != State.StatusFinished:
+            self.save_state_with_hash()
+        self.controller.context = None
+        self.controller = None
+
     def add_error_message(self, error_message):
         self.gcontext.add_error_message(error_message)
 
@@ -129,7 +151,8 @@ class Context:
         # Restore the state and forget about the restored state
         # The state is forgotten because we are going to modify it
         assert self.controller is None
-        self.controller = self.gcontext.worker.get_controller(self.state.pid)
+        self.controller = self.gcontext.worker.get_controller(
+            self.state.pid, self.gcontext)
         # Register context into controller to capture unexpected outputs
         self.controller.context = self
         self.controller.restore_state(self.state.vg_state)
@@ -156,6 +179,10 @@ class Context:
             self.process_profile(result)
             result = self.controller.receive_line()
             return self.process_run_result(result)
+        if result[0] == "LOCAL":
+            self.process_local_calls(result)
+            result = self.controller.receive_line()
+            return self.process_run_result(result)
         if result[0] == "SYSCALL":
             return_value = self.process_syscall(result)
             if return_value is None:
@@ -180,6 +207,15 @@ class Context:
                 self.make_error_message_from_report(result))
         raise Exception("Invalid command " + result[0])
 
+    def process_local_calls(self, result):
+        # Calls answered by AVT (see Worker.set_local_answers),
+        # only their events are created
+        self.gcontext.worker.local_calls += len(result) - 1
+        for call in result[1:]:
+            name, args = call.split(",", 1)
+            self.gcontext.add_event(
+                event.CallEvent(name, self.state.pid, args))
+
     def run(self):
         #if self.gcontext.worker.stats_time is not None:
         #    self.gcontext.worker.record_process_start(self.state.pid)
@@ -195,6 +231,8 @@ class Context:
 
     def make_error_message_from_report(self, parts):
         assert parts[0] == "REPORT"
+        # AVT cannot resume the process after a report
+        self.controller.reported = True
         name = parts[1]
         if name == "heaperror":
             assert len(parts) == 2
@@ -222,14 +260,16 @@ class Context:
         self.run()
         self.gcontext.make_node()
 
-    def initial_run(self, first_worker=True):
-        controller = self.gcontext.worker.get_controller(self.state.pid)
+    def start_initial_run(self):
+        controller = self.gcontext.worker.get_controller(
+            self.state.pid, self.gcontext)
         controller.context = self
         self.controller = controller
-        result = controller.receive_line()
-        if result is None:
-            return False
 
+    def process_initial_result(self, result, first_worker=True):
+        # Returns None when the process was resumed asynchronously,
+        # the next result has to be obtained by controller.finish_async()
+        controller = self.controller
         while True:
             result = result.split()
             if result[0] == "CALL":
@@ -239,8 +279,8 @@ class Context:
                     assert len(result) == 3
                     ptr = convert_type(result[2], "ptr")
                     controller.write_int(ptr, 0)
-                    result = self.run_sync()
-                    continue
+                    self.run()
+                    return None
                 elif result[1] != "MPI_Init":
                     e = errormsg.NoMpiInit(self)
                     self.add_error_and_throw(e)
@@ -264,20 +304,18 @@ class Context:
                 return True
             elif result[0] == "REPORT":
                 if not first_worker:
-                    return False
+                    # The error is reported by the first worker
+                    return True
                 e = self.make_error_message_from_report(result)
                 self.add_error_and_throw(e)
                 return True
             elif result[0] == "SYSCALL":
                 return_value = self.process_syscall(result)
                 if return_value is None:
-                    result = self.run_sync()
+                    self.run()
                 else:
-                    #if self.gcontext.worker.stats_time is not None:
-                    #    self.gcontext.worker.record_process_start(self.state.pid)
-                    result = controller.run_drop_syscall(return_value)
-                    #if self.gcontext.worker.stats_time is not None:
-                    #    self.gcontext.worker.record_process_stop(self.state.pid)
+                    controller.run_drop_syscall_async(return_value)
+                return None
             else:
                 assert 0, "Invalid reposponse " + repr(result)
 
@@ -346,25 +384,31 @@ class Context:
                                     controller.read_pointer(value_out_ptr))
             controller.client_free(tmp)
 
-    def make_buffer(self, pointer, datatype, count):
+    def make_buffer(self, pids, pointer, datatype, count):
+        worker = self.gcontext.worker
+        segment = worker.buffer_manager.segment
+        if segment is not None and self.controller.segment is segment:
+            # Data are packed by AVT directly into the shared segment
+            regions = []
+            datatype.memory_regions(pointer, count, regions)
+            size = sum(s for addr, s in regions)
+            if size and len(regions) <= self.controller.PACK_REGIONS_LIMIT:
+                offset = segment.alloc(size)
+                if offset is not None:
+                    hash = self.controller.pack_into_segment(offset, regions)
+                    controllers = [worker.controllers[pid] for pid in pids]
+                    return worker.buffer_manager.new_buffer_from_segment(
+                        hash, size, offset, controllers)
         data = []
         datatype.pack2(self.controller, pointer, count, data.append)
-        return self.gcontext.worker.buffer_manager.new_buffer("".join(data))
+        controllers = [worker.controllers[pid] for pid in pids]
+        return worker.buffer_manager.new_buffer("".join(data), controllers)
 
     def make_buffer_for_one(self, pid, pointer, datatype, count):
-        buffer = self.make_buffer(pointer, datatype, count)
-        buffer.remaining_controllers = 1
-        controller = self.gcontext.worker.get_controller(pid)
-        controller.add_buffer(buffer)
-        return buffer
+        return self.make_buffer((pid,), pointer, datatype, count)
 
     def make_buffer_for_more(self, pids, pointer, datatype, count):
-        buffer = self.make_buffer(pointer, datatype, count)
-        buffer.remaining_controllers = len(pids)
-        for pid in pids:
-            controller = self.gcontext.worker.get_controller(pid)
-            controller.add_buffer(buffer)
-        return buffer
+        return self.make_buffer(pids, pointer, datatype, count)
 
     def close_all_requests(self):
         if not self.state.tested_request_ids:
@@ -377,19 +421,27 @@ class Context:
         else:
             request_ids = None
 
-        for i, index in enumerate(indices):
-            request_id = self.state.tested_request_ids[index]
-            if request_id == consts.MPI_REQUEST_NULL:
-                continue
-            request = self.state.get_finished_request(request_id)
-            if not (request_ids is None or
-                    (request.is_send() and
-                        request.target == consts.MPI_PROC_NULL) or
-                    (request.is_receive() and
-                        request.source == consts.MPI_PROC_NULL)):
-                request_ids.append(request_id)
-
-            self._close_request(request, index, i)
+        # Writes into the client are sent at once and
+        # confirmations are checked together
+        self.controller.start_batch()
+        try:
+            for i, index in enumerate(indices):
+                request_id = self.state.tested_request_ids[index]
+                if request_id == consts.MPI_REQUEST_NULL:
+                    continue
+                request = self.state.get_finished_request(request_id)
+                if not (request_ids is None or
+                        (request.is_send() and
+                            request.target == consts.MPI_PROC_NULL) or
+                        (request.is_receive() and
+                            request.source == consts.MPI_PROC_NULL)):
+                    request_ids.append(request_id)
+
+                self._close_request(request, index, i)
+        except:
+            self.controller.cancel_batch()
+            raise
+        self.controller.finish_batch()
 
         if request_ids is not None:
             self.gcontext.add_event(event.Continue(self.state.pid,
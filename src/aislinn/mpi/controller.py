@@ -27,6 +27,7 @@ class Controller(vgtool.controller.ControllerWithResources):
     REQUEST_SIZE = vgtool.controller.Controller.INT_SIZE
 
     context = None
+    reported = False
 
     def write_status(self, status_ptr, source, tag, size):
         self.write_ints(status_ptr, [source, tag, size])
@@ -36,6 +36,8 @@ class ErrorMessage(object):
 
     events = None
     node = None
+    # Indices of actions chosen by a random walk (see --replay)
+    trace = None
 
     def __init__(self, context, pid=None, gcontext=None, **kw):
         for name in self.optional_arg_names:
@@ -56,8 +58,7 @@ class ErrorMessage(object):
             context.make_fail_node()
             self.node = context.gcontext.node
             if context.event:
-                if context.event.stacktrace:
-                    self.stacktrace = context.event.stacktrace
+                self.stacktrace = context.get_event_stacktrace()
                 if isinstance(context.event, event.CallEvent):
                     self.fn_name = context.event.name
             elif context.controller:
@@ -33,6 +33,11 @@ class ErrorFound(Exception):
 class GlobalContext:
 
     init_time = None
+    sleep_set = None
+    start_time = None
+    # True if the global context waits for a controller
+    # that runs a process of another global context
+    blocked = False
 
     def __init__(self, worker, node, gstate, generator=None):
         self.worker = worker
@@ -78,6 +83,11 @@ class GlobalContext:
                     context.state.status != State.StatusFinished):
                 context.save_state_with_hash()
 
+    def release_controllers(self):
+        for context in self.contexts:
+            if context and context.controller:
+                context.controller.context = None
+
     def add_error_message(self, error_message):
         self.generator.add_error_message(error_message)
 
@@ -87,6 +97,7 @@ class GlobalContext:
 
     def make_node(self):
         self.save_states()
+        self.release_controllers()
         node, is_new = self.generator.add_node(
             self.node, self.worker, self.gstate)
         arc = Arc(node, self.action, self.events, self.get_compact_data())
@@ -113,6 +124,7 @@ class GlobalContext:
             gstate = gstate.copy()
         else:
             self.gstate = None
+        gstate.depth += 1
         self.worker.add_to_queue(self.node, gstate, action)
 
     def make_fail_node(self):
@@ -180,10 +192,10 @@ class GlobalContext:
 
     def is_pid_running(self, pid):
         context = self.contexts[pid]
-        return context and context.controller.running
+        return context and context.controller and context.controller.running
 
     def is_running(self):
         for context in self.contexts:
-            if context and context.controller.running:
+            if context and context.controller and context.controller.running:
                 return True
         return False
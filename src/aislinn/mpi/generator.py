@@ -25,8 +25,11 @@ from context import Context
 from gcontext import GlobalContext, ErrorFound
 from mpi.ndsync import NdsyncChecker
 from base.node import Node
-from worker import Worker
-from vgtool.controller import poll_controllers
+from search import get_search_queue_class
+from stealing import StealPolicy
+from worker import Worker, run_initial_runs
+from zygote import ZygoteClient
+from vgtool.controller import ControllerPoller
 
 import consts
 import errormsg
@@ -55,6 +58,9 @@ class Generator:
         self.deterministic_unallocated_memory = None
 
         self.search = aislinn_args.search
+        self.search_queue_class = get_search_queue_class(self.search)
+        self.search_watermarks = aislinn_args.search_watermarks
+        self.por = aislinn_args.por
         self.max_states = aislinn_args.max_states
 
         self.stdout_mode = aislinn_args.stdout
@@ -71,9 +77,21 @@ class Generator:
         self.is_full_statespace = False
 
         self.profile = aislinn_args.profile
+        self.event_stacktraces = aislinn_args.event_stacktraces
+        # Stack traces are obtained when Python handles the call
+        self.local_answers = not (aislinn_args.debug_no_local_answers or
+                                  aislinn_args.event_stacktraces)
+        self.clone_workers = aislinn_args.clone_workers
         self.debug_seq = aislinn_args.debug_seq
         self.debug_arc_times = aislinn_args.debug_arc_times
 
+        self.steal_policy = StealPolicy()
+        self.poller = ControllerPoller()
+        if aislinn_args.zygote:
+            self.zygote = ZygoteClient(aislinn_args.zygote)
+        else:
+            self.zygote = None
+
         self.workers = [Worker(i,
                                aislinn_args.workers,
                                self,
@@ -125,8 +143,39 @@ class Generator:
                  "name" : "Controllers utilization",
                  "data" : [sum(d) for d in chart["data"]]}
         charts.append(chart)
+
+        chart = {"type" : "bars",
+                 "name" : "Steals",
+                 "data" : [worker.stats_steals for worker in self.workers]}
+        charts.append(chart)
+
+        chart = {"type" : "bars",
+                 "name" : "Idle time [s]",
+                 "data" : [worker.stats_idle_time
+                           for worker in self.workers]}
+        charts.append(chart)
         return charts
 
+    def get_state_store_counters(self):
+        """ Returns sums of (hits, misses, evictions) of controllers
+            with --state-memory """
+        controllers = [c for worker in self.workers
+                       for c in worker.controllers]
+        return (sum(c.store_hits for c in controllers),
+                sum(c.store_misses for c in controllers),
+                sum(c.store_evictions for c in controllers))
+
+    def get_local_calls_count(self):
+        return sum(worker.local_calls for worker in self.workers)
+
+    def get_search_switches(self):
+        """ Returns sorted triplets (time, worker_id, mode) """
+        switches = [(time, worker.worker_id, mode)
+                    for worker in self.workers
+                    for time, mode in worker.search_switches]
+        switches.sort()
+        return switches
+
     def add_error_message(self, error_message):
         if error_message.name in [e.name for e in self.error_messages]:
             return
@@ -141,49 +190,110 @@ class Generator:
         for node, gstate in self.queue:
             gstate.sanity_check()
 
-    def sleeping_neighbours_of(self, worker_id):
+    def distribute_work(self, worker):
+        # Idle workers steal from the queue of 'worker'. The transfer is
+        # performed here, because controllers of 'worker' are not running
+        # between two gcontexts.
         for i in xrange(1, len(self.workers)):
-            worker = self.workers[(i + worker_id) % len(self.workers)]
-            if not worker.queue and not worker.gcontext:
-                return worker
-        return None
+            thief = self.workers[(i + worker.worker_id) % len(self.workers)]
+            if thief.queue or thief.gcontexts:
+                continue
+            batch = self.steal_policy.select_batch(worker, thief)
+            if not batch:
+                return
+            self.transfer_batch(worker, thief, batch)
+            thief.start_next_in_queue()
+
+    def transfer_batch(self, worker, thief, batch):
+        for controller in worker.controllers:
+            controller.make_buffers()
+
+        logging.debug("---- Transfer %s ==> %s (%s entries) ----",
+                      worker, thief, len(batch))
+        worker.interconnect(thief)
+        for node, gstate, action in batch:
+            new_gstate, new_action = worker.transfer_gstate_and_action(
+                thief, gstate, action)
+            gstate.dispose()
+            thief.add_to_queue(node, new_gstate, new_action)
+        logging.debug("---- End of transfer ----")
+
+        for controller in thief.controllers:
+            controller.make_buffers()
+        if thief.stats_time is not None:
+            thief.record_steal()
+
+    def create_initial_node(self):
+        initial_node = Node("init", None)
+        self.statespace.add_node(initial_node)
+        self.statespace.initial_node = initial_node
+        return initial_node
+
+    def set_final_allocations(self, node, allocations):
+        node.allocations = allocations
+
+    def update_sleep_set(self, node, sleep_set, is_new):
+        # Returns (sleep set, awoken actions) that should be used for
+        # expanding the node or None if there is nothing to explore
+        if is_new:
+            node.sleep_set = sleep_set
+            return sleep_set, None
+        if node.sleep_set is None or node.sleep_set <= sleep_set:
+            return None
+        awoken = node.sleep_set - sleep_set
+        node.sleep_set = node.sleep_set.intersection(sleep_set)
+        return node.sleep_set, awoken
 
     def start_workers(self):
-        for worker in self.workers:
+        if self.clone_workers:
+            workers = self.workers[:1]
+        else:
+            workers = self.workers
+
+        for worker in workers:
             worker.start_controllers()
 
-        for worker in self.workers:
+        for worker in workers:
             worker.connect_controllers()
 
-        if not self.workers[0].make_initial_node():
+        if self.clone_workers:
+            for worker in self.workers[1:]:
+                worker.clone_controllers(self.workers[0])
+
+        runs = self.workers[0].start_initial_run()
+        for worker in self.workers[1:]:
+            runs += worker.start_initial_run(False)
+        if not run_initial_runs(runs):
             return False
 
+        for worker in self.workers:
+            worker.set_local_answers()
+
         for worker in self.workers[1:]:
-            if not worker.init_nonfirst_worker():
-                return False
+            worker.finish_initial_run(False)
+        self.workers[0].finish_initial_run()
 
-        self.workers[0].start_next_in_queue()
+        for worker in self.workers[1:]:
+            self.workers[0].share_initial_states(worker)
+
+        self.start_exploration()
         return True
 
+    def start_exploration(self):
+        self.workers[0].start_next_in_queue()
+
+    def select_actions(self, worker, actions):
+        # Returns actions of a node that are explored
+        return actions
+
     def main_cycle(self):
-        while True:
-            controllers = sum((worker.running_controllers()
-                               for worker in self.workers if worker.gcontext),
-                              [])
-            logging.debug("Running controllers %s", controllers)
-            if not controllers:
-                return
-            controllers = poll_controllers(controllers)
-            for c in controllers:
+        while self.poller.has_running():
+            for c in self.poller.poll():
                 worker = self.workers[c.name / self.process_count]
                 #if worker.stats_time is not None:
                 #    worker.record_process_stop(c.name % self.process_count)
-                context = worker.gcontext.get_context(
-                    c.name % self.process_count)
-                logging.debug("Ready controller %s", context)
-                context.process_run_result(c.finish_async())
-                worker.continue_in_execution()
-                if worker.gcontext is None:
+                worker.process_event(c)
+                if worker.can_start_gcontext():
                     worker.start_next_in_queue()
 
     def run(self):
@@ -202,11 +312,17 @@ class Generator:
         except ErrorFound:
             logging.debug("ErrorFound catched")
         finally:
-            for worker in self.workers:
-                worker.kill_controllers()
+            self.stop_workers()
+            self.poller.close()
             self.end_time = datetime.datetime.now()
         return True
 
+    def stop_workers(self):
+        if self.zygote is not None:
+            self.zygote.release_controllers()
+        for worker in self.workers:
+            worker.kill_controllers()
+
     def ndsync_check(self):
         self.statespace.inject_dfs_indegree()
         message = NdsyncChecker(self, self.statespace).run()
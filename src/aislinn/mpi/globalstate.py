@@ -29,6 +29,9 @@ import logging
 
 class GlobalState(EqMixin):
 
+    # Number of expansions from the initial state
+    depth = 0
+
     def __init__(self,
                  process_count):
         self.states = [State(self, i, None) for i in xrange(process_count)]
@@ -0,0 +1,138 @@
+#
+#    Copyright (C) 2015 Stanislav Bohm
+#
+#    This file is part of Aislinn.
+#
+#    Aislinn is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 2 of the License, or
+#    (at your option) any later version.
+#
+#    Aislinn is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Aislinn.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Workers running on several hosts
+#
+# The main process listens on a TCP address and waits until all workers
+# connect to it (they are started by 'aislinn --connect=ADDRESS').
+# Then the exploration continues as with --worker-processes, messages are
+# sent through TCP connections instead of pipes and Valgrind states are
+# pushed directly between controllers on different hosts.
+# The main process keeps the statespace, i.e. the set of visited states
+# is shared by all hosts.
+#
+# In the fake remote mode, "hosts" are local processes in separate process
+# groups connected through TCP on the loopback interface.
+
+from generator import Generator
+from workerprocess import ProcessGenerator, RemoteGenerator
+
+import base.paths as paths
+import logging
+import multiprocessing.connection
+import os
+import subprocess
+import sys
+
+
+AUTH_KEY_VARIABLE = "AISLINN_AUTH_KEY"
+
+
+def parse_address(address):
+    """ Parses '[HOST:]PORT', returns (host, port) or None """
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+    else:
+        host, port = "0.0.0.0", address
+    try:
+        port = int(port)
+    except ValueError:
+        return None
+    if not host or port < 0 or port > 65535:
+        return None
+    return (host, port)
+
+
+def get_auth_key():
+    return os.environ.get(AUTH_KEY_VARIABLE)
+
+
+def run_worker_host(address, auth_key):
+    logging.info("Connecting to %s:%s", address[0], address[1])
+    connection = multiprocessing.connection.Client(address, authkey=auth_key)
+    message = connection.recv()
+    assert message[0] == "setup"
+    _, worker_id, args, process_count, aislinn_args, init_time, cwd = message
+    if os.path.isdir(cwd):
+        os.chdir(cwd)
+    logging.info("Running worker %s", worker_id)
+    generator = Generator(args, process_count, aislinn_args)
+    generator.init_time = init_time
+    RemoteGenerator(generator, worker_id, connection).run()
+    connection.close()
+
+
+class HostGenerator(ProcessGenerator):
+
+    def __init__(self, args, process_count, aislinn_args):
+        ProcessGenerator.__init__(self, args, process_count, aislinn_args)
+        self.aislinn_args = aislinn_args
+        self.fake_remote = aislinn_args.fake_remote
+        if self.fake_remote:
+            self.address = ("127.0.0.1", 0)
+            self.auth_key = os.urandom(32).encode("hex")
+        else:
+            self.address = parse_address(aislinn_args.listen)
+            self.auth_key = get_auth_key()
+        self.host_processes = []
+
+    def spawn_workers(self):
+        listener = multiprocessing.connection.Listener(
+            self.address, authkey=self.auth_key)
+        try:
+            host, port = listener.address
+            if self.fake_remote:
+                self.start_fake_hosts(port)
+            logging.info("Waiting for %s worker(s) on %s:%s",
+                         len(self.workers), host, port)
+            for worker in self.workers:
+                connection = listener.accept()
+                peer = listener.last_accepted[0]
+                logging.info("Worker %s connected from %s",
+                             worker.worker_id, peer)
+                connection.send(("setup",
+                                 worker.worker_id,
+                                 self.args,
+                                 self.process_count,
+                                 self.aislinn_args,
+                                 self.init_time,
+                                 os.getcwd()))
+                self.connections.append(connection)
+                self.hosts.append(peer)
+        finally:
+            listener.close()
+
+    def start_fake_hosts(self, port):
+        env = os.environ.copy()
+        env[AUTH_KEY_VARIABLE] = self.auth_key
+        command = [sys.executable,
+                   os.path.join(paths.SRC_DIR, "aislinn.py"),
+                   "--connect=127.0.0.1:{0}".format(port),
+                   "--verbose={0}".format(self.aislinn_args.verbose)]
+        for worker in self.workers:
+            # Each host gets its own process group, like on a real host
+            process = subprocess.Popen(command, env=env, preexec_fn=os.setsid)
+            self.host_processes.append(process)
+
+    def stop_workers(self):
+        ProcessGenerator.stop_workers(self)
+        for process in self.host_processes:
+            process.wait()
+        for connection in self.connections:
+            connection.close()
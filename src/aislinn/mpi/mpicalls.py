@@ -913,8 +913,9 @@ class Call:
         e = event.CallEvent(self.name,
                             context.state.pid,
                             ",".join(args))
-        e.stacktrace = context.controller.get_stacktrace()
         context.event = e
+        if context.gcontext.generator.event_stacktraces:
+            context.get_event_stacktrace()
         context.gcontext.add_event(e)
         r = self.fn(context,
                     [self.args[i].make_conversion(args[i], i + 1, context)
@@ -1071,3 +1072,19 @@ calls_non_communicating = dict((c.name, c) for c in [
     Call(MPI_Attr_delete, (at.Comm, at.Keyval)),
     Call(MPI_Abort, (at.Comm, at.Int)),
 ])
+
+
+def local_answers(pid, process_count):
+    """ Returns triplets (name, args, value) of non-communicating calls
+        whose results do not depend on the state of the process,
+        AVT answers them without asking the controller """
+    answers = [("MPI_Initialized", (), 1),
+               ("MPI_Comm_rank", (consts.MPI_COMM_WORLD,), pid),
+               ("MPI_Comm_size", (consts.MPI_COMM_WORLD,), process_count),
+               ("MPI_Comm_rank", (consts.MPI_COMM_SELF,), 0),
+               ("MPI_Comm_size", (consts.MPI_COMM_SELF,), 1)]
+    for datatype in types.buildin_types.values():
+        if datatype.size is not None:
+            answers.append(("MPI_Type_size", (datatype.type_id,),
+                            datatype.size))
+    return answers
@@ -0,0 +1,260 @@
+#
+#    Copyright (C) 2015 Stanislav Bohm
+#
+#    This file is part of Aislinn.
+#
+#    Aislinn is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 2 of the License, or
+#    (at your option) any later version.
+#
+#    Aislinn is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Aislinn.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Random walks
+#
+# Instead of exploring the whole state space, each worker repeatedly
+# executes the program from the state after MPI_Init and chooses a random
+# action in each node. Only the path of the current walk is kept; when an
+# error is found, the walk is stopped and the next one starts.
+# Each error carries a trace (indices of chosen actions) that can be
+# replayed by --replay.
+
+from base.arc import STREAM_STDOUT, STREAM_STDERR
+from base.node import Node
+from base.report import Report
+from gcontext import ErrorFound
+from generator import Generator
+
+import datetime
+import itertools
+import logging
+import random
+
+
+def parse_trace(value):
+    """ Parses a trace 'I,J,...', returns a list of indices or None """
+    if not value:
+        return []
+    try:
+        trace = [int(i) for i in value.split(",")]
+    except ValueError:
+        return None
+    if any(i < 0 for i in trace):
+        return None
+    return trace
+
+
+class SamplingGenerator(Generator):
+
+    def __init__(self, args, process_count, aislinn_args):
+        Generator.__init__(self, args, process_count, aislinn_args)
+        self.sample_count = aislinn_args.sample
+        if aislinn_args.sample_time:
+            self.sample_time = datetime.timedelta(
+                seconds=aislinn_args.sample_time)
+        else:
+            self.sample_time = None
+        if aislinn_args.replay is not None:
+            self.replay = parse_trace(aislinn_args.replay)
+            self.sample_count = 1
+        else:
+            self.replay = None
+        self.random = random.Random(aislinn_args.sample_seed)
+
+        self.walks_started = 0
+        self.walks_count = 0
+        self.steps_count = 0
+        # Traces of running walks, indexed by worker_id
+        self.traces = [None] * len(self.workers)
+        self.root_gstates = None
+        self.initial_arcs = None
+        self.error_keys = set()
+
+    def run(self):
+        result = Generator.run(self)
+        self.is_full_statespace = False
+        return result
+
+    def start_exploration(self):
+        # The entry after MPI_Init is the root of all walks,
+        # other workers obtain its copy with their own states
+        worker0 = self.workers[0]
+        node, gstate, action = worker0.pop_from_queue()
+        self.initial_arcs = self.statespace.arcs_to_node(node)
+        self.root_gstates = [gstate]
+        for worker in self.workers[1:]:
+            for controller in worker0.controllers:
+                controller.make_buffers()
+            worker0.interconnect(worker)
+            self.root_gstates.append(
+                worker0.transfer_gstate_and_action(worker, gstate, None)[0])
+            for controller in worker.controllers:
+                controller.make_buffers()
+
+        for worker in self.workers:
+            self.step_walk(worker)
+
+    def main_cycle(self):
+        while self.poller.has_running():
+            for c in self.poller.poll():
+                # Controller may be stopped by an aborted walk
+                if c.running:
+                    self.step_walk(
+                        self.workers[c.name / self.process_count], c)
+
+    def step_walk(self, worker, controller=None):
+        while True:
+            try:
+                if controller is not None:
+                    worker.process_event(controller)
+                    controller = None
+                if worker.can_start_gcontext():
+                    worker.start_next_in_queue()
+                if worker.gcontexts or worker.queue:
+                    return
+                self.finish_walk(worker)
+            except ErrorFound:
+                self.abort_walk(worker)
+            if not self.start_walk(worker):
+                return
+
+    def start_walk(self, worker):
+        if self.sample_count and self.walks_started >= self.sample_count:
+            return False
+        if self.sample_time is not None and \
+                datetime.datetime.now() - self.init_time > self.sample_time:
+            return False
+        if any(c.reported for c in worker.controllers):
+            logging.warning("Worker %s stops random walks, its process "
+                            "cannot continue after an error reported "
+                            "by Valgrind", worker.worker_id)
+            return False
+        self.walks_started += 1
+        logging.debug("Starting walk %s on %s", self.walks_started, worker)
+        self.traces[worker.worker_id] = []
+        node = Node("walk{0}".format(self.walks_started), None)
+        worker.add_to_queue(
+            node, self.root_gstates[worker.worker_id].copy(), None)
+        return True
+
+    def finish_walk(self, worker):
+        if self.traces[worker.worker_id] is not None:
+            self.traces[worker.worker_id] = None
+            self.walks_count += 1
+
+    def abort_walk(self, worker):
+        # Processes of the walk are stopped, their controllers get
+        # another state when the next walk starts
+        for controller in worker.controllers:
+            if controller.running:
+                self.stop_process(controller)
+            controller.context = None
+        for gcontext in worker.gcontexts:
+            if gcontext.gstate is not None and \
+                    gcontext.gstate.states is not None:
+                gcontext.gstate.dispose()
+        worker.gcontexts = []
+        while worker.queue:
+            worker.queue.pop_to_dispose()[1].dispose()
+        self.finish_walk(worker)
+
+    def stop_process(self, controller):
+        # The process is left at the next event that needs an answer,
+        # syscalls are skipped, so outputs of the aborted walk are dropped
+        result = controller.finish_async()
+        while True:
+            if result.startswith("PROFILE") or result.startswith("LOCAL"):
+                result = controller.receive_line()
+            elif result.startswith("SYSCALL"):
+                result = controller.run_drop_syscall(result.split()[4])
+            else:
+                return
+
+    def select_actions(self, worker, actions):
+        trace = self.traces[worker.worker_id]
+        if self.replay is None:
+            index = self.random.randrange(len(actions))
+        elif len(trace) < len(self.replay) and \
+                self.replay[len(trace)] < len(actions):
+            index = self.replay[len(trace)]
+        else:
+            logging.warning("Replayed trace does not match the program "
+                            "(step %s)", len(trace))
+            return ()
+        trace.append(index)
+        return (actions[index],)
+
+    def add_node(self, prev, worker, gstate, do_hash=True):
+        if prev is self.statespace.initial_node:
+            # The node after MPI_Init
+            return Generator.add_node(self, prev, worker, gstate, do_hash)
+        self.steps_count += 1
+        node = Node("s{0}".format(self.steps_count), None)
+        node.prev = prev
+        return (node, True)
+
+    def distribute_work(self, worker):
+        pass  # Each worker performs its own walks
+
+    def memory_leak_check(self):
+        pass
+
+    def final_check(self):
+        pass
+
+    def ndsync_check(self):
+        pass
+
+    def arcs_to_node(self, node):
+        if self.initial_arcs is None:
+            # Error found before walks were started
+            return self.statespace.arcs_to_node(node)
+        arcs = []
+        while node.prev is not None:
+            prev = node.prev
+            arcs.append(
+                [arc for arc in prev.arcs if arc.node is node][0])
+            node = prev
+        arcs.reverse()
+        return self.initial_arcs + arcs
+
+    def add_error_message(self, error_message):
+        key = (error_message.key,
+               error_message.pid,
+               error_message.stacktrace)
+        if key in self.error_keys:
+            return
+        self.error_keys.add(key)
+        if error_message.node is not None:
+            # The path of the walk is not stored in the statespace,
+            # hence it is collected now
+            arcs = self.arcs_to_node(error_message.node)
+            error_message.trace = ",".join(
+                str(arc.action.action_index) for arc in arcs if arc.action)
+            error_message.events = list(
+                itertools.chain.from_iterable(arc.events for arc in arcs))
+            if self.stdout_mode == "capture":
+                error_message.stdout = [
+                    self.stream_of_arcs(arcs, STREAM_STDOUT, pid)
+                    for pid in xrange(self.process_count)]
+            if self.stderr_mode == "capture":
+                error_message.stderr = [
+                    self.stream_of_arcs(arcs, STREAM_STDERR, pid)
+                    for pid in xrange(self.process_count)]
+        logging.info("Error '%s' found", error_message.name)
+        self.error_messages.append(error_message)
+
+    def stream_of_arcs(self, arcs, name, pid):
+        return "".join(data.value
+                       for data in (arc.get_data(name, pid) for arc in arcs)
+                       if data)
+
+    def create_report(self, args, version):
+        return Report(self, args, version)
@@ -0,0 +1,265 @@
+#
+#    Copyright (C) 2015 Stanislav Bohm
+#
+#    This file is part of Aislinn.
+#
+#    Aislinn is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 2 of the License, or
+#    (at your option) any later version.
+#
+#    Aislinn is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Aislinn.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import deque
+import heapq
+import importlib
+import logging
+
+
+class SearchQueue:
+    """ Queue of entries (node, gstate, action) waiting for expansion.
+
+        pop() returns the entry that is expanded next, pop_cold() returns
+        the entry that would be expanded as the last one (such entries are
+        given to other workers) and push_cold() returns an entry
+        obtained by pop_cold() back. iter_cold() iterates entries
+        starting from the cold end.
+        Attribute 'worker' is set to the worker that owns the queue. """
+
+    worker = None
+
+    def __init__(self):
+        self.entries = deque()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, entry):
+        self.entries.append(entry)
+
+    def pop_to_dispose(self):
+        """ Pops an entry whose gstate is only disposed """
+        return self.pop()
+
+    def close(self):
+        pass
+
+
+class DfsQueue(SearchQueue):
+
+    def pop(self):
+        return self.entries.pop()
+
+    def peek(self):
+        return self.entries[-1]
+
+    def pop_cold(self):
+        return self.entries.popleft()
+
+    def push_cold(self, entry):
+        self.entries.appendleft(entry)
+
+    def iter_cold(self):
+        return iter(self.entries)
+
+
+class BfsQueue(SearchQueue):
+
+    def pop(self):
+        return self.entries.popleft()
+
+    def peek(self):
+        return self.entries[0]
+
+    def pop_cold(self):
+        return self.entries.pop()
+
+    def push_cold(self, entry):
+        self.entries.append(entry)
+
+    def iter_cold(self):
+        return reversed(self.entries)
+
+
+class AdaptiveQueue(SearchQueue):
+    """ Breadth-first search that switches to depth-first search when
+        the queue or saved Valgrind states of the worker grow over the high
+        watermark and back when both fall under the low watermark.
+        Saved states are counted per process, because an entry holds
+        at most one state of each process. """
+
+    def __init__(self):
+        SearchQueue.__init__(self)
+        self.dfs = False
+
+    def saved_states(self):
+        controllers = self.worker.controllers
+        # Released states are not counted, they are kept in AVT
+        # only as a cache until the cleanup
+        return sum(c.states.resource_count
+                   for c in controllers) / len(controllers)
+
+    def push(self, entry):
+        self.entries.append(entry)
+        high, low = self.worker.generator.search_watermarks
+        size = max(len(self.entries), self.saved_states())
+        if not self.dfs and size > high:
+            self.switch(True)
+        elif self.dfs and size < low:
+            self.switch(False)
+
+    def switch(self, dfs):
+        self.dfs = dfs
+        mode = "dfs" if dfs else "bfs"
+        logging.debug("%s switches to %s (queue=%s)",
+                      self.worker, mode, len(self.entries))
+        self.worker.record_search_switch(mode)
+
+    def pop(self):
+        if self.dfs:
+            return self.entries.pop()
+        return self.entries.popleft()
+
+    def peek(self):
+        return self.entries[-1 if self.dfs else 0]
+
+    def pop_cold(self):
+        if self.dfs:
+            return self.entries.popleft()
+        return self.entries.pop()
+
+    def push_cold(self, entry):
+        if self.dfs:
+            self.entries.appendleft(entry)
+        else:
+            self.entries.append(entry)
+
+    def iter_cold(self):
+        if self.dfs:
+            return iter(self.entries)
+        return reversed(self.entries)
+
+
+class PriorityQueue(SearchQueue):
+    """ Entries with a higher priority are expanded first, entries with
+        the same priority are expanded in the order of insertion.
+        Subclasses redefine method priority(entry), by default it is
+        the depth of the entry (the number of expansions from the initial
+        state). The priority is computed when the entry is pushed. """
+
+    def __init__(self):
+        # Heaps of items (-priority, counter, token, entry) for pop() and
+        # (priority, -counter, token, entry) for pop_cold(). Each item is in
+        # both heaps, it is valid while 'tokens' maps its counter to its
+        # token; invalid items are removed when they get to the top.
+        self.hot = []
+        self.cold = []
+        self.tokens = {}
+        self.counter = 0
+        self.cold_item = None
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def priority(self, entry):
+        return entry[1].depth
+
+    def push(self, entry):
+        self.counter += 1
+        self.push_item(self.priority(entry), self.counter, entry)
+
+    def push_item(self, priority, counter, entry):
+        token = object()
+        self.tokens[counter] = token
+        heapq.heappush(self.hot, (-priority, counter, token, entry))
+        heapq.heappush(self.cold, (priority, -counter, token, entry))
+
+    def top(self, heap, sign):
+        while self.tokens.get(sign * heap[0][1]) is not heap[0][2]:
+            heapq.heappop(heap)
+        return heap[0]
+
+    def pop(self):
+        item = self.top(self.hot, 1)
+        del self.tokens[item[1]]
+        return item[3]
+
+    def peek(self):
+        return self.top(self.hot, 1)[3]
+
+    def pop_cold(self):
+        item = self.top(self.cold, -1)
+        del self.tokens[-item[1]]
+        self.cold_item = item
+        return item[3]
+
+    def push_cold(self, entry):
+        item = self.cold_item
+        assert item is not None and item[3] is entry
+        self.cold_item = None
+        self.push_item(item[0], -item[1], entry)
+
+    def iter_cold(self):
+        return (item[3] for item in sorted(self.cold)
+                if self.tokens.get(-item[1]) is item[2])
+
+
+class RequestsQueue(PriorityQueue):
+    """ Entries with the fewest pending requests first """
+
+    def priority(self, entry):
+        node, gstate, action = entry
+        return -sum(len(state.active_requests) for state in gstate.states)
+
+
+class DeepQueue(PriorityQueue):
+    """ The deepest entries first, entries in the same depth in BFS order
+        (the default priority) """
+
+
+class CachedQueue(PriorityQueue):
+    """ Entries with the most processes whose Valgrind states were already
+        present in the worker's state cache when they were saved or
+        received, i.e. processes that do not hold an additional saved state.
+        Finished processes have no state, so they are counted as well.
+        It is a heuristic evaluated when the entry is pushed, the states
+        may be shared by more entries later. """
+
+    def priority(self, entry):
+        node, gstate, action = entry
+        return sum(1 for state in gstate.states
+                   if state.vg_state is None or state.vg_state.cache_hits)
+
+
+search_queues = {
+    "dfs": DfsQueue,
+    "bfs": BfsQueue,
+    "adaptive": AdaptiveQueue,
+    "requests": RequestsQueue,
+    "deep": DeepQueue,
+    "cached": CachedQueue,
+}
+
+
+def get_search_queue_class(name):
+    """ Returns a class for the search strategy 'name' or None.
+        Besides the names in 'search_queues', a plugin in the form
+        'module:class' may be used, class has to implement interface
+        of SearchQueue (it is usually a subclass of PriorityQueue) """
+    if name in search_queues:
+        return search_queues[name]
+    if ":" not in name:
+        return None
+    module_name, class_name = name.split(":", 1)
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError:
+        return None
+    return getattr(module, class_name, None)
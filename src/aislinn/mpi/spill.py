@@ -0,0 +1,161 @@
+#
+#    Copyright (C) 2015 Stanislav Bohm
+#
+#    This file is part of Aislinn.
+#
+#    Aislinn is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 2 of the License, or
+#    (at your option) any later version.
+#
+#    Aislinn is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Aislinn.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import shutil
+import tempfile
+
+
+class SpilledState:
+    """ Placeholder of a Valgrind state written into a file,
+        ref_count is the number of queue entries that use the file """
+
+    def __init__(self, queue, pid, hash, filename):
+        self.queue = queue
+        self.pid = pid
+        self.hash = hash
+        self.filename = filename
+        self.ref_count = 0
+
+    def dec_ref(self):
+        # Called also when a spilled entry is disposed
+        self.ref_count -= 1
+        if self.ref_count == 0:
+            os.remove(self.filename)
+            del self.queue.spilled_states[(self.pid, self.hash)]
+
+    def __repr__(self):
+        return "<SpilledState {0.filename} ref={0.ref_count}>".format(self)
+
+
+class SpillingQueue:
+    """ Wraps a search queue of a worker. When more than 'limit' entries
+        in the queue keep their Valgrind states, states of the coldest
+        entries are written into files and freed in Valgrind.
+        States are loaded back when their entry leaves the queue. """
+
+    def __init__(self, worker, queue, limit, directory=None):
+        self.worker = worker
+        self.queue = queue
+        self.limit = limit
+        self.directory = directory
+        self.spill_directory = None
+        self.spilled_states = {}  # (pid, hash) -> SpilledState
+        self.spilled = set()  # ids of spilled gstates
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, entry):
+        self.queue.push(entry)
+        if len(self.queue) - len(self.spilled) > self.limit:
+            self.spill()
+
+    def pop(self):
+        return self.restore(self.queue.pop())
+
+    def peek(self):
+        # States are not restored, the entry stays in the queue
+        return self.queue.peek()
+
+    def pop_cold(self):
+        return self.restore(self.queue.pop_cold())
+
+    def pop_to_dispose(self):
+        """ Pops an entry whose gstate is only disposed,
+            spilled states are not loaded back """
+        entry = self.queue.pop()
+        self.spilled.discard(id(entry[1]))
+        return entry
+
+    def push_cold(self, entry):
+        self.queue.push_cold(entry)
+
+    def iter_cold(self):
+        return self.queue.iter_cold()
+
+    def close(self):
+        self.queue.close()
+        self.spilled = set()
+        self.spilled_states = {}
+        if self.spill_directory is not None:
+            shutil.rmtree(self.spill_directory, ignore_errors=True)
+            self.spill_directory = None
+
+    def spill(self):
+        # Entries are spilled until only a half of the limit is kept,
+        # so spilling does not happen at each push
+        count = len(self.queue) - len(self.spilled) - self.limit / 2
+        logging.debug("Spilling %s entries of %s", count, self.worker)
+        for entry in self.queue.iter_cold():
+            if count <= 0:
+                return
+            if self.spill_entry(entry):
+                count -= 1
+
+    def spill_entry(self, entry):
+        gstate = entry[1]
+        if id(gstate) in self.spilled:
+            return False
+        # Controllers running a process cannot write states now
+        if any(state.vg_state is not None and
+               state.vg_state.controller.running for state in gstate.states):
+            return False
+        self.spilled.add(id(gstate))
+        for state in gstate.states:
+            if state.vg_state is not None and state.vg_state.hash is not None:
+                state.vg_state = self.spill_state(state.pid, state.vg_state)
+        return True
+
+    def spill_state(self, pid, vg_state):
+        key = (pid, vg_state.hash)
+        spilled = self.spilled_states.get(key)
+        if spilled is None:
+            if self.spill_directory is None:
+                self.spill_directory = tempfile.mkdtemp(
+                    prefix="aislinn-spill-", dir=self.directory)
+            filename = os.path.join(
+                self.spill_directory, "{0}-{1}".format(pid, vg_state.hash))
+            vg_state.controller.spill_state(vg_state, filename)
+            spilled = SpilledState(self, pid, vg_state.hash, filename)
+            self.spilled_states[key] = spilled
+        spilled.ref_count += 1
+        vg_state.dec_ref()
+        if vg_state.ref_count == 0:
+            vg_state.controller.free_not_used_state(vg_state)
+        return spilled
+
+    def restore(self, entry):
+        gstate = entry[1]
+        if id(gstate) not in self.spilled:
+            return entry
+        self.spilled.remove(id(gstate))
+        for state in gstate.states:
+            if isinstance(state.vg_state, SpilledState):
+                state.vg_state = self.load_state(state.pid, state.vg_state)
+        return entry
+
+    def load_state(self, pid, spilled):
+        controller = self.worker.controllers[pid]
+        vg_state = controller.use_cached_state(spilled.hash)
+        if vg_state is None:
+            vg_state = controller.load_state(spilled.filename, spilled.hash)
+        spilled.dec_ref()
+        return vg_state
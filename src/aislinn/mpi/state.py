@@ -375,7 +375,9 @@ class State:
             context.event.new_request = [context.event.new_request, request.id]
 
         if not immediate:
-            request.stacktrace = context.event.stacktrace
+            if context.gcontext.generator.event_stacktraces:
+                # Shown in errors of writes into the locked memory
+                request.stacktrace = context.get_event_stacktrace()
             regions = []
             request.datatype.memory_regions(
                 request.data_ptr, request.count, regions)
@@ -0,0 +1,67 @@
+#
+#    Copyright (C) 2015 Stanislav Bohm
+#
+#    This file is part of Aislinn.
+#
+#    Aislinn is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 2 of the License, or
+#    (at your option) any later version.
+#
+#    Aislinn is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Aislinn.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+class StealPolicy:
+    """ Decides which entries an idle worker steals from a busy one.
+
+        Entries are taken from the cold end of the victim's queue,
+        at most half of the queue and at most 'batch_size' entries at once.
+        An entry is stolen only when the estimated time of transferring its
+        Valgrind states is lower than the average time of expanding an entry;
+        otherwise it is cheaper to leave it to the victim. """
+
+    batch_size = 8
+
+    def __init__(self):
+        self.transfer_time = 0.0
+        self.transfers_count = 0
+        self.expansion_time = 0.0
+        self.expansions_count = 0
+
+    def record_state_transfer(self, seconds, count=1):
+        self.transfer_time += seconds
+        self.transfers_count += count
+
+    def record_expansion(self, seconds):
+        self.expansion_time += seconds
+        self.expansions_count += 1
+
+    def transfer_cost(self, uncached_states):
+        if not self.transfers_count:
+            return 0.0
+        return uncached_states * self.transfer_time / self.transfers_count
+
+    def is_worth_stealing(self, uncached_states):
+        if not self.expansions_count:
+            return True
+        return (self.transfer_cost(uncached_states) <
+                self.expansion_time / self.expansions_count)
+
+    def select_batch(self, victim, thief=None):
+        size = min(self.batch_size, len(victim.queue) / 2)
+        batch = []
+        while len(batch) < size:
+            entry = victim.pop_cold_entry()
+            if not self.is_worth_stealing(
+                    victim.count_uncached_states(entry[1], thief)):
+                victim.push_cold_entry(entry)
+                break
+            batch.append(entry)
+        return batch
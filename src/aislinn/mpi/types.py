@@ -168,11 +168,13 @@ class VectorType(Datatype):
             pointer -= self.stride
 
     def memory_regions(self, pointer, count, regions):
+        step_index = self.datatype.size * self.blocksize
         for i in xrange(count):
             for j in xrange(self.count):
                 self.datatype.memory_regions(pointer, self.blocksize, regions)
                 pointer += self.stride
             pointer -= self.stride
+            pointer += step_index
 
 
 class IndexedType(Datatype):
@@ -16,7 +16,8 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Aislinn.  If not, see <http://www.gnu.org/licenses/>.
 #
-from action import (ActionMatching,
+from action import (is_independent,
+                    ActionMatching,
                     ActionWaitAny,
                     ActionWaitSome,
                     ActionFlag0,
@@ -27,16 +28,72 @@ from base.node import Node
 from base.utils import power_set
 from gcontext import GlobalContext
 from globalstate import GlobalState
-from collections import deque
+from spill import SpillingQueue, SpilledState
 from state import State
-from vgtool.controller import BufferManager, make_interconnection_pairs
+from vgtool.controller import (BufferManager,
+                               SharedSegment,
+                               make_interconnection_pairs,
+                               poll_controllers)
 import base.paths
 import consts
 import errormsg
 import logging
+import mpicalls
 from datetime import datetime
 
 
+CAPTURE_SYSCALLS = ("write",)
+
+
+def configure_controller(controller, aislinn_args):
+    """ Sets options of AVT given by the command line """
+    controller.profile = aislinn_args.profile
+
+    if aislinn_args.vgv:
+        controller.verbose = aislinn_args.vgv
+
+    if aislinn_args.debug_text_protocol:
+        controller.binary_protocol = False
+
+    if aislinn_args.heap_size is not None:
+        controller.heap_size = aislinn_args.heap_size
+
+    if aislinn_args.redzone_size is not None:
+        controller.redzone_size = aislinn_args.redzone_size
+
+    if aislinn_args.shm_size is not None:
+        controller.shm_size = aislinn_args.shm_size
+
+    if aislinn_args.debug_by_valgrind_tool:
+        controller.debug_by_valgrind_tool = \
+            aislinn_args.debug_by_valgrind_tool
+
+
+class ControllerBusy(Exception):
+    """ Raised when a controller is needed by a global context,
+        but it runs a process of another global context of the worker """
+    pass
+
+
+def run_initial_runs(runs):
+    """ Processes initial runs of all contexts concurrently,
+        'runs' is a list of pairs (context, first_worker) """
+    runs = dict((context.controller, (context, first_worker))
+                for context, first_worker in runs)
+    while runs:
+        for controller in poll_controllers(runs.keys()):
+            context, first_worker = runs[controller]
+            if controller.running:
+                result = controller.finish_async()
+            else:
+                result = controller.receive_line()
+            if result is None:
+                return False
+            finished = context.process_initial_result(result, first_worker)
+            if finished:
+                del runs[controller]
+    return True
+
 
 class TransferContext:
 
@@ -54,24 +111,25 @@ class TransferContext:
     def transfer_state(self, pid, vg_state):
         logging.debug("Transferring state: %s pid: %s", vg_state, pid)
         controller = self.target_worker.controllers[pid]
-        state = controller.get_cached_state(vg_state.hash)
+        state = controller.use_cached_state(vg_state.hash)
         if state is not None:
-            state.inc_ref_revive()
             return state
+        start = datetime.now()
         self.worker.controllers[pid].push_state(self.sockets[pid], vg_state)
-        return controller.pull_state(self.target_sockets[pid], vg_state.hash)
+        state = controller.pull_state(self.target_sockets[pid], vg_state.hash)
+        self.worker.generator.steal_policy.record_state_transfer(
+            (datetime.now() - start).total_seconds())
+        return state
 
     def transfer_buffer(self, vg_buffer):
         logging.debug("Transferring buffer: %s", vg_buffer)
         assert vg_buffer.data is None  # Data are already pushed in clients
         controllers = self.worker.controllers
         pids = [controllers.index(c) for c in vg_buffer.controllers]
-        data = vg_buffer.controllers[0].read_buffer(vg_buffer.id)
-        buffer = self.target_worker.buffer_manager.new_buffer(data)
-        buffer.remaining_controllers = len(pids)
-        for pid in pids:
-            self.target_worker.controllers[pid].add_buffer(buffer)
-        return buffer
+        data = vg_buffer.controllers[0].read_buffer(
+            vg_buffer.id, vg_buffer.size)
+        return self.target_worker.buffer_manager.new_buffer(
+            data, [self.target_worker.controllers[pid] for pid in pids])
 
 
 class Worker:
@@ -80,7 +138,13 @@ class Worker:
             self, worker_id, workers_count, generator, args, aislinn_args):
         self.generator = generator
         self.worker_id = worker_id
-        self.gcontext = None
+        # Global contexts in progress, their running pids do not overlap
+        self.gcontexts = []
+        self.max_gcontexts = aislinn_args.gcontexts
+        self.cleanup_interval = aislinn_args.cleanup_interval
+        self.expands_since_cleanup = 0
+        # Number of calls answered by AVT
+        self.local_calls = 0
         self.buffer_manager = BufferManager(10 + worker_id, workers_count)
         self.controllers = [Controller(base.paths.VALGRIND_BIN, args)
                             for i in xrange(generator.process_count)]
@@ -88,20 +152,10 @@ class Worker:
 
         for i, controller in enumerate(self.controllers):
             controller.name = i + worker_id * generator.process_count
-            controller.profile = generator.profile
-
-            if aislinn_args.vgv:
-                controller.verbose = aislinn_args.vgv
-
-            if aislinn_args.heap_size is not None:
-                controller.heap_size = aislinn_args.heap_size
-
-            if aislinn_args.redzone_size is not None:
-                controller.redzone_size = aislinn_args.redzone_size
-
-            if aislinn_args.debug_by_valgrind_tool:
-                controller.debug_by_valgrind_tool = \
-                    aislinn_args.debug_by_valgrind_tool
+            controller.poller = generator.poller
+            configure_controller(controller, aislinn_args)
+            controller.memory_limit = aislinn_args.state_memory
+            controller.evict_dir = aislinn_args.spill_dir
 
             if aislinn_args.debug_vglogfile is not None:
                 prefix = aislinn_args.debug_vglogfile
@@ -122,67 +176,193 @@ class Worker:
             for controller in self.controllers:
                 controller.extra_env = {"LD_BIND_NOW": "1"}
 
-        self.queue = deque()
+        self.queue = generator.search_queue_class()
+        self.queue.worker = self
+        # Pairs (time, mode) of switches of adaptive search
+        self.search_switches = []
+        if aislinn_args.spill_queue:
+            self.queue = SpillingQueue(self,
+                                       self.queue,
+                                       aislinn_args.spill_queue,
+                                       aislinn_args.spill_dir)
 
         if aislinn_args.debug_stats:
             self.stats_time = []
             self.stats_queue_len = []
             self.stats_controller_start = [[] for c in self.controllers]
             self.stats_controller_stop = [[] for c in self.controllers]
+            self.stats_steals = 0
+            self.stats_idle_time = 0.0
+            self.stats_idle_start = None
         else:
             self.stats_time = None
 
-    def get_controller(self, pid):
-        return self.controllers[pid]
+    def get_controller(self, pid, gcontext):
+        """ Returns the controller of 'pid' for a context of 'gcontext' """
+        controller = self.controllers[pid]
+        context = controller.context
+        if context is not None and context.gcontext is not gcontext:
+            if controller.running:
+                raise ControllerBusy()
+            # The controller holds a paused process of another
+            # global context, its state is saved and restored later
+            context.release_controller()
+        return controller
+
+    def is_controller_free(self, pid):
+        return not self.controllers[pid].running
 
     def start_controllers(self):
+        zygote = self.generator.zygote
+        if zygote is not None and \
+                zygote.attach_controllers(self.controllers, CAPTURE_SYSCALLS):
+            return
+        shm_size = self.controllers[0].shm_size
+        if shm_size and len(self.controllers) > 1:
+            # Messages for more processes are uploaded only once
+            self.buffer_manager.segment = SharedSegment(shm_size)
         # We do actions separately to allow parallel initialization
         for controller in self.controllers:
-            controller.start(capture_syscalls=["write"])
+            controller.segment = self.buffer_manager.segment
+            controller.start(capture_syscalls=CAPTURE_SYSCALLS)
+
+    def clone_controllers(self, worker):
+        """ Controllers are created as clones of controllers of 'worker'
+            that are paused at their first event """
+        # Clones keep the mapping of the segment
+        self.buffer_manager.segment = worker.buffer_manager.segment
+        for source, controller in zip(worker.controllers, self.controllers):
+            lines = [source.receive_line()]
+            while lines[-1].startswith("PROFILE"):
+                lines.append(source.receive_line())
+            output = "".join(line + "\n" for line in lines)
+            if lines[-1].startswith("CALL"):
+                source.clone(controller)
+                controller.socket.unread(output)
+            else:
+                # The process cannot be cloned,
+                # the initial run reports the problem
+                controller.segment = self.buffer_manager.segment
+                controller.start(capture_syscalls=CAPTURE_SYSCALLS)
+            source.socket.unread(output)
 
     def connect_controllers(self):
         for controller in self.controllers:
             controller.connect()
 
-    def make_initial_node(self):
-        initial_node = Node("init", None)
-        self.generator.statespace.add_node(initial_node)
-        self.generator.statespace.initial_node = initial_node
-
+    def start_initial_run(self, first_worker=True):
+        if first_worker:
+            initial_node = self.generator.create_initial_node()
+        else:
+            initial_node = Node("init", None)
         gstate = GlobalState(self.generator.process_count)
         gcontext = GlobalContext(self, initial_node, gstate)
-
-        # TODO: Do it in parallel
+        self.gcontexts.append(gcontext)
+        runs = []
         for i in xrange(self.generator.process_count):
             context = gcontext.get_context(i)
-            if not context.initial_run():
-                return False
+            context.start_initial_run()
+            runs.append((context, first_worker))
+        return runs
+
+    def finish_initial_run(self, first_worker=True):
+        gcontext = self.gcontexts.pop()
+        if first_worker:
+            gcontext.make_node()
+            gcontext.add_to_queue(None, False)
+        else:
+            gcontext.release_controllers()
 
-        gcontext.make_node()
-        gcontext.add_to_queue(None, False)
+    def make_initial_node(self):
+        if not run_initial_runs(self.start_initial_run()):
+            return False
+        self.set_local_answers()
+        self.finish_initial_run()
         return True
 
     def init_nonfirst_worker(self):
-        initial_node = Node("init", None)
-        gstate = GlobalState(self.generator.process_count)
-        gcontext = GlobalContext(self, initial_node, gstate)
-        for i in xrange(self.generator.process_count):
-            context = gcontext.get_context(i)
-            if not context.initial_run(False):
-                return False
-        return True
+        result = run_initial_runs(self.start_initial_run(False))
+        if result:
+            self.set_local_answers()
+        self.finish_initial_run(False)
+        return result
+
+    def set_local_answers(self):
+        if not self.generator.local_answers:
+            return
+        for pid, controller in enumerate(self.controllers):
+            controller.start_batch()
+            for name, args, value in mpicalls.local_answers(
+                    pid, self.generator.process_count):
+                controller.set_local_answer(name, args, value)
+            controller.finish_batch()
+
+    def initial_states(self):
+        node, gstate, action = self.queue.peek()
+        return [(state.pid, state.vg_state) for state in gstate.states
+                if state.vg_state is not None]
+
+    def share_initial_states(self, worker):
+        # Processes of non-first workers are stopped at their first call,
+        # their post MPI_Init states are obtained from the first worker,
+        # so they do not have to be computed again
+        self.interconnect(worker)
+        transfer_context = TransferContext(
+            self,
+            self.interconnect_sockets[worker.worker_id],
+            worker,
+            worker.interconnect_sockets[self.worker_id])
+        for pid, vg_state in self.initial_states():
+            transfer_context.transfer_state(pid, vg_state).dec_ref()
 
     def add_to_queue(self, node, gstate, action):
-        self.queue.append((node, gstate, action))
+        self.queue.push((node, gstate, action))
+
+    def pop_from_queue(self):
+        return self.queue.pop()
+
+    def pop_cold_entry(self):
+        # Entry that would be popped as the last one
+        return self.queue.pop_cold()
+
+    def push_cold_entry(self, entry):
+        self.queue.push_cold(entry)
+
+    def count_uncached_states(self, gstate, target=None):
+        # Number of Valgrind states that has to be pushed to transfer
+        # gstate into target, if target is None, all states are counted
+        count = 0
+        for state in gstate.states:
+            if state.vg_state is None:
+                continue
+            if target is None or \
+                    target.controllers[state.pid].get_cached_state(
+                        state.vg_state.hash) is None:
+                count += 1
+        return count
 
     def start_gcontext(self, node, gstate, action):
         logging.debug("Starting gcontext %s %s %s", self, node, gstate)
         gcontext = GlobalContext(self, node, gstate)
-        self.gcontext = gcontext
+        self.gcontexts.append(gcontext)
+        gcontext.start_time = datetime.now()
+        if self.generator.por:
+            gcontext.sleep_set = action.sleep_set if action else frozenset()
         if action:
             action.apply_action(gcontext)
             gcontext.action = action
-        return self.continue_in_execution()
+        return self.continue_in_execution(gcontext)
+
+    def can_start_entry(self, entry):
+        # Controllers used before the first run of the entry has to be free,
+        # i.e. controllers of pids touched by the action
+        # and controllers that load spilled states
+        node, gstate, action = entry
+        pids = [state.pid for state in gstate.states
+                if isinstance(state.vg_state, SpilledState)]
+        if action is not None:
+            pids.extend(action.key[1])
+        return all(self.is_controller_free(pid) for pid in pids)
 
     def check_collective_requests(self, gcontext):
         for state in gcontext.gstate.states:
@@ -252,8 +432,7 @@ class Worker:
                     return True
         return False
 
-    def fast_expand(self):
-        gcontext = self.gcontext
+    def fast_expand(self, gcontext):
         while True:
             matching = gcontext.find_deterministic_match()
             if matching:
@@ -276,12 +455,18 @@ class Worker:
 
             running = False
             for state in gcontext.gstate.states:
-                if not gcontext.is_pid_running(state.pid):
+                if gcontext.is_pid_running(state.pid):
+                    running = True
+                    continue
+                try:
                     running |= self.fast_expand_state(gcontext, state)
-                else:
+                except ControllerBusy:
+                    # The state is checked again when a process of
+                    # another global context stops
+                    gcontext.blocked = True
                     running = True
 
-            self.buffer_manager.cleanup()
+            self.cleanup_buffers()
             return running
 
     def expand_waitsome(self, gcontext, state, actions):
@@ -344,45 +529,82 @@ class Worker:
                 self.expand_testall(gcontext, state, actions)
         return actions
 
-    def slow_expand(self, gcontext):
+    def slow_expand(self, gcontext, sleep_set=None, awoken=None):
         actions = self.get_actions(gcontext)
         if actions:
             for i, action in enumerate(actions):
                 action.action_index = i
-                gcontext.add_to_queue(action, True)
+            if sleep_set is None:
+                for action in self.generator.select_actions(self, actions):
+                    gcontext.add_to_queue(action, True)
+            else:
+                self.expand_sleep_set(gcontext, actions, sleep_set, awoken)
         return bool(actions)
 
-    def continue_in_execution(self):
-        if self.fast_expand():
+    def expand_sleep_set(self, gcontext, actions, sleep_set, awoken):
+        # Actions in the sleep set were explored from some previous state
+        # and nothing dependent on them was executed since then, hence
+        # they lead to already explored states.
+        # If awoken is not None, only actions from awoken are explored
+        explored = []
+        for action in actions:
+            key = action.key
+            if key in sleep_set or (awoken is not None and key not in awoken):
+                continue
+            action.sleep_set = frozenset(
+                k for k in sleep_set.union(explored)
+                if is_independent(k, key))
+            explored.append(key)
+            gcontext.add_to_queue(action, True)
+
+    def continue_in_execution(self, gcontext):
+        gcontext.blocked = False
+        if self.fast_expand(gcontext):
             return True
 
-        gcontext = self.gcontext
         gstate = gcontext.gstate
 
         # We will plan some computation but leaving this function,
         # current gcontext is finished
-        self.gcontext = None
-
-        if not gcontext.make_node():
-            gcontext.gstate.dispose()  # Node already explored
+        self.gcontexts.remove(gcontext)
+        self.generator.steal_policy.record_expansion(
+            (datetime.now() - gcontext.start_time).total_seconds())
+
+        sleep_set = gcontext.sleep_set
+        is_new = gcontext.make_node()
+        if sleep_set is not None:
+            expansion = self.generator.update_sleep_set(
+                gcontext.node, sleep_set, is_new)
+
+        if not is_new:
+            # Node already explored, but actions that were asleep
+            # during the previous visits may have to be explored now
+            if sleep_set is not None and expansion is not None:
+                self.slow_expand(gcontext, *expansion)
+            gcontext.gstate.dispose()
             return False
 
-        if not self.slow_expand(gcontext):
-            node = gcontext.node
-            if any(state.status != State.StatusFinished
-                   for state in gstate.states):
-                active_pids = [state.pid for state in gstate.states
-                               if state.status != State.StatusFinished]
-                gcontext = GlobalContext(self, node, gstate)
-                message = errormsg.Deadlock(None,
-                                            gcontext=gcontext,
-                                            active_pids=active_pids)
-                gcontext.add_error_and_throw(message)
-            else:
-                gstate.mpi_leak_check(self, node)
-                node.allocations = sum((state.allocations
-                                        for state in gstate.states), [])
-        gstate.dispose()
+        try:
+            if not self.slow_expand(gcontext, sleep_set):
+                node = gcontext.node
+                if any(state.status != State.StatusFinished
+                       for state in gstate.states):
+                    active_pids = [state.pid for state in gstate.states
+                                   if state.status != State.StatusFinished]
+                    gcontext = GlobalContext(self, node, gstate)
+                    message = errormsg.Deadlock(None,
+                                                gcontext=gcontext,
+                                                active_pids=active_pids)
+                    gcontext.add_error_and_throw(message)
+                else:
+                    gstate.mpi_leak_check(self, node)
+                    self.generator.set_final_allocations(
+                        node, sum((state.allocations
+                                   for state in gstate.states), []))
+        finally:
+            # Disposed also when an error is found,
+            # random walks continue after errors
+            gstate.dispose()
         return False
 
         """
@@ -396,16 +618,42 @@ class Worker:
     def running_controllers(self):
         return [c for c in self.controllers if c.running]
 
+    def process_event(self, controller):
+        context = controller.context
+        logging.debug("Ready controller %s", context)
+        context.process_run_result(controller.finish_async())
+        gcontext = context.gcontext
+        # Global contexts waiting for a controller are continued first,
+        # to not starve them
+        for g in self.gcontexts[:]:
+            if g.blocked and g is not gcontext:
+                self.continue_in_execution(g)
+        self.continue_in_execution(gcontext)
+
+    def can_start_gcontext(self):
+        return len(self.gcontexts) < self.max_gcontexts
+
     def kill_controllers(self):
         for controller in self.controllers:
             controller.kill()
+        if self.buffer_manager.segment is not None:
+            self.buffer_manager.segment.close()
+        self.queue.close()
 
     def make_context(self, node, state):
         # This function exists to avoid importing GlobalContext in state.py
         gcontext = GlobalContext(self, node, state.gstate)
         return gcontext.get_context(state.pid)
 
+    def cleanup_buffers(self):
+        # Buffers are freed in groups, see --cleanup-interval
+        self.expands_since_cleanup += 1
+        if self.expands_since_cleanup >= self.cleanup_interval:
+            self.expands_since_cleanup = 0
+            self.buffer_manager.cleanup()
+
     def cleanup(self):
+        self.expands_since_cleanup = 0
         self.buffer_manager.cleanup()
         for controller in self.controllers:
             controller.cleanup_states()
@@ -465,41 +713,33 @@ class Worker:
         if self.stats_time is not None:
             self.record_stats()
 
-        if not self.queue:
-            return
-
-        while True:
-            while True:
-
-                if self.generator.search == "dfs":
-                    node, gstate, action = self.queue.pop()
-                else:  # bfs
-                    node, gstate, action = self.queue.popleft()
-
-                if not self.queue:
-                    break
+        if self.queue and not self.running_controllers():
+            # States of entries are transferred by controllers,
+            # so work is given away only when no process is running
+            self.generator.distribute_work(self)
 
-                worker = self.generator.sleeping_neighbours_of(self.worker_id)
+        while self.queue and self.can_start_gcontext():
+            if self.gcontexts and not self.can_start_entry(self.queue.peek()):
+                return
+            node, gstate, action = self.pop_from_queue()
+            self.start_gcontext(node, gstate, action)
 
-                if worker is None:
-                    break
+        if self.gcontexts:
+            return
 
-                for controller in self.controllers:
-                    controller.make_buffers()
+        if self.stats_time is not None and self.stats_idle_start is None:
+            self.stats_idle_start = datetime.now()
 
-                logging.debug("---- Transfer %s ==> %s ----", self, worker)
+    def record_steal(self):
+        self.stats_steals += 1
+        if self.stats_idle_start is not None:
+            time = datetime.now() - self.stats_idle_start
+            self.stats_idle_time += time.total_seconds()
+            self.stats_idle_start = None
 
-                self.interconnect(worker)
-                new_gstate, new_action = self.transfer_gstate_and_action(
-                    worker, gstate, action)
-                gstate.dispose()
-                logging.debug("---- End of transfer ----")
-                for controller in worker.controllers:
-                    controller.make_buffers()
-                if not worker.start_gcontext(node, new_gstate, new_action):
-                    worker.start_next_in_queue()
-            if self.start_gcontext(node, gstate, action):
-                break
+    def record_search_switch(self, mode):
+        time = datetime.now() - self.generator.init_time
+        self.search_switches.append((time.total_seconds(), mode))
 
     def record_stats(self):
         time = datetime.now() - self.generator.init_time
@@ -0,0 +1,643 @@
+#
+#    Copyright (C) 2015 Stanislav Bohm
+#
+#    This file is part of Aislinn.
+#
+#    Aislinn is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 2 of the License, or
+#    (at your option) any later version.
+#
+#    Aislinn is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Aislinn.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Workers running in separate processes
+#
+# The main process (ProcessGenerator) owns the statespace, i.e. the table
+# of visited states, and collects error messages. Each worker process
+# (RemoteGenerator) explores states with its own controllers and asks
+# the main process for nodes that it has not met yet; nodes are never
+# removed from the statespace, so nodes already met are resolved by
+# the worker itself. When a worker becomes idle,
+# the main process asks a busy worker to donate entries of its queue;
+# Valgrind states are sent directly between controllers through
+# interconnection sockets, the rest of the global state is pickled.
+
+from base.arc import (Arc,
+                      ArcData,
+                      STREAM_STDOUT,
+                      STREAM_STDERR,
+                      COUNTER_INSTRUCTIONS,
+                      COUNTER_ALLOCATIONS,
+                      COUNTER_SIZE_ALLOCATIONS,
+                      COUNTER_MPICALLS)
+from base.node import Node
+from gcontext import ErrorFound
+from generator import Generator
+from vgtool.controller import (Controller, ControllerPoller,
+                               VgState, VgBuffer)
+
+import ops
+import copy
+import cPickle
+import cStringIO
+import datetime
+import logging
+import multiprocessing
+import select
+import traceback
+
+
+# Names of arc data are singletons, they are sent as indices into this tuple
+ARC_DATA_NAMES = (STREAM_STDOUT,
+                  STREAM_STDERR,
+                  COUNTER_INSTRUCTIONS,
+                  COUNTER_ALLOCATIONS,
+                  COUNTER_SIZE_ALLOCATIONS,
+                  COUNTER_MPICALLS)
+
+
+class ActionLabel:
+
+    def __init__(self, name, action_index):
+        self.name = name
+        self.action_index = action_index
+
+
+class RemoteNode:
+
+    def __init__(self, generator, uid):
+        self.generator = generator
+        self.uid = uid
+
+    def add_arc(self, arc):
+        self.generator.send_arc(self, arc)
+
+    def __repr__(self):
+        return "<RemoteNode uid={0.uid}>".format(self)
+
+
+class WorkPickler:
+
+    def __init__(self, worker, sockets):
+        self.worker = worker
+        self.sockets = sockets
+        self.persistent_ids = {}
+        self.pushed_states = []
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, (VgState, VgBuffer)):
+            return None
+        key = id(obj)
+        persistent = self.persistent_ids.get(key)
+        if persistent is not None:
+            return persistent
+        controllers = self.worker.controllers
+        if isinstance(obj, VgState):
+            pid = controllers.index(obj.controller)
+            self.pushed_states.append((pid, obj))
+            persistent = ("state", key, pid, obj.hash)
+        else:
+            assert obj.data is None  # Data are already pushed in clients
+            pids = [controllers.index(c) for c in obj.controllers]
+            data = obj.controllers[0].read_buffer(obj.id, obj.size)
+            persistent = ("buffer", key, data, pids)
+        self.persistent_ids[key] = persistent
+        return persistent
+
+    def dumps(self, obj):
+        f = cStringIO.StringIO()
+        pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self.persistent_id
+        pickler.dump(obj)
+        return f.getvalue()
+
+    def push_states(self):
+        # States are pushed after the data are sent, otherwise a controller
+        # may block on a full socket before the receiver starts pulling
+        for pid, state in self.pushed_states:
+            state.controller.push_state(self.sockets[pid], state)
+
+
+class WorkUnpickler:
+
+    def __init__(self, worker, sockets):
+        self.worker = worker
+        self.sockets = sockets
+        self.objects = {}
+        self.resources = []
+
+    def persistent_load(self, persistent):
+        obj = self.objects.get(persistent[1])
+        if obj is not None:
+            return obj
+        if persistent[0] == "state":
+            _, key, pid, hash = persistent
+            obj = self.pull_state(pid, hash)
+        else:
+            _, key, data, pids = persistent
+            obj = self.worker.buffer_manager.new_buffer(
+                data, [self.worker.controllers[pid] for pid in pids])
+        self.objects[key] = obj
+        self.resources.append(obj)
+        return obj
+
+    def pull_state(self, pid, hash):
+        controller = self.worker.controllers[pid]
+        state = controller.use_cached_state(hash)
+        if state is None:
+            return controller.pull_state(self.sockets[pid], hash)
+        # State is already cached, so the received copy is thrown away
+        controller.free_state(Controller.pull_state(controller,
+                                                    self.sockets[pid]))
+        return state
+
+    def loads(self, data):
+        unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+        unpickler.persistent_load = self.persistent_load
+        return unpickler.load()
+
+    def release_resources(self):
+        # Loaded global states are copied, copies take their own references
+        for resource in self.resources:
+            resource.dec_ref()
+
+
+def run_worker_process(generator, worker_id, connection):
+    RemoteGenerator(generator, worker_id, connection).run()
+
+
+class RemoteGenerator(Generator):
+
+    def __init__(self, generator, worker_id, connection):
+        # Configuration is inherited from the generator of the main process
+        self.__dict__.update(generator.__dict__)
+        self.statespace = None
+        self.connection = connection
+        self.worker = self.workers[worker_id]
+        self.worker.generator = self
+        # epoll cannot be shared with the main process
+        self.poller = ControllerPoller()
+        for controller in self.worker.controllers:
+            controller.poller = self.poller
+        self.donation_targets = []
+        self.allocations_counter = 0
+        self.quit_received = False
+        # Hashes of nodes known by the worker -> uids
+        self.known_nodes = {}
+
+    def send(self, message):
+        self.connection.send(message)
+
+    def receive(self):
+        message = self.connection.recv()
+        if message[0] == "quit":
+            self.quit_received = True
+            raise ErrorFound()
+        return message
+
+    def run(self):
+        worker = self.worker
+        try:
+            if self.start() and self.main_cycle():
+                worker.before_final_check()
+                worker.final_check()
+        except ErrorFound:
+            logging.debug("ErrorFound catched")
+            if not self.quit_received:
+                self.send(("stopped",))
+        except Exception:
+            self.send(("exception", traceback.format_exc()))
+        finally:
+            worker.kill_controllers()
+
+        self.send(("exit", self.get_worker_statistics()))
+        while not self.quit_received:
+            self.quit_received = self.connection.recv()[0] == "quit"
+
+    def start(self):
+        worker = self.worker
+        worker.start_controllers()
+        worker.connect_controllers()
+        self.send(("started",))
+        while True:
+            message = self.receive()
+            name = message[0]
+            if name == "listen":
+                self.interconnect_listen(message[1], message[2])
+            elif name == "connect":
+                self.interconnect_connect(message[1], message[2], message[3])
+            elif name == "init":
+                if not worker.make_initial_node():
+                    return False
+                fn_ptrs = dict((op_id, op.fn_ptr) for op_id, op
+                               in ops.buildin_operations.items())
+                self.send(("init_info", self.consts_pool, fn_ptrs))
+            elif name == "init_nonfirst":
+                if not worker.init_nonfirst_worker():
+                    return False
+                self.send(("ready",))
+            elif name == "share_initial_states":
+                self.share_initial_states(message[1])
+            elif name == "pull_initial_states":
+                self.consts_pool = message[3]
+                for op_id, fn_ptr in message[4].items():
+                    ops.buildin_operations[op_id].fn_ptr = fn_ptr
+                self.pull_initial_states(message[1], message[2])
+                self.send(("ready",))
+            elif name == "explore":
+                return True
+            else:
+                assert 0, "Invalid message " + repr(message)
+
+    def share_initial_states(self, worker_id):
+        sockets = self.worker.interconnect_sockets[worker_id]
+        states = self.worker.initial_states()
+        for pid, vg_state in states:
+            self.worker.controllers[pid].push_state(sockets[pid], vg_state)
+        self.send(("initial_states",
+                   [(pid, vg_state.hash) for pid, vg_state in states]))
+
+    def pull_initial_states(self, source, states):
+        sockets = self.worker.interconnect_sockets[source]
+        for pid, hash in states:
+            self.worker.controllers[pid].pull_state(
+                sockets[pid], hash).dec_ref()
+
+    def interconnect_listen(self, worker_id, local):
+        controllers = self.worker.controllers
+        if local:
+            ports = [c.interconn_listen_unix() for c in controllers]
+        else:
+            ports = [c.interconn_listen() for c in controllers]
+        self.send(("ports", ports))
+        self.worker.interconnect_sockets[worker_id] = \
+            [c.interconn_listen_finish() for c in controllers]
+
+    def interconnect_connect(self, worker_id, host, ports):
+        controllers = self.worker.controllers
+        for port, c in zip(ports, controllers):
+            if host is None:
+                # Paths of AF_UNIX sockets
+                c.interconn_connect(port)
+            else:
+                c.interconn_connect("{0}:{1}".format(host, port))
+        self.worker.interconnect_sockets[worker_id] = \
+            [c.interconn_connect_finish() for c in controllers]
+        self.send(("connected",))
+
+    def main_cycle(self):
+        worker = self.worker
+        while True:
+            if not worker.gcontexts:
+                worker.start_next_in_queue()
+                if not worker.gcontexts:
+                    if not self.wait_for_work():
+                        return True
+                    continue
+            for c in self.poller.poll():
+                worker.process_event(c)
+            if worker.gcontexts and worker.can_start_gcontext():
+                worker.start_next_in_queue()
+
+    def wait_for_work(self):
+        for target in self.donation_targets:
+            self.send(("no_work", target))
+        self.donation_targets = []
+        self.send(("idle",))
+        message = self.receive()
+        if message[0] == "finish":
+            return False
+        assert message[0] == "work"
+        self.receive_work(message[1], message[2])
+        return True
+
+    def receive_work(self, source, data):
+        worker = self.worker
+        logging.debug("---- Receiving work %s <== %s ----", worker, source)
+        unpickler = WorkUnpickler(worker, worker.interconnect_sockets[source])
+        for uid, gstate, action in unpickler.loads(data):
+            worker.add_to_queue(RemoteNode(self, uid), gstate.copy(), action)
+        unpickler.release_resources()
+        if worker.stats_time is not None:
+            worker.record_steal()
+        logging.debug("---- End of transfer ----")
+
+    def distribute_work(self, worker):
+        while self.donation_targets:
+            batch = self.steal_policy.select_batch(worker)
+            if not batch:
+                # Let the main process find another donor
+                for target in self.donation_targets:
+                    self.send(("no_work", target))
+                self.donation_targets = []
+                return
+            self.transfer_batch(worker, self.donation_targets.pop(), batch)
+
+    def transfer_batch(self, worker, target, batch):
+        for controller in worker.controllers:
+            controller.make_buffers()
+
+        logging.debug("---- Transfer %s ==> %s (%s entries) ----",
+                      worker, target, len(batch))
+        start = datetime.datetime.now()
+        for node, gstate, action in batch:
+            for state in gstate.states:
+                self.tag_allocations(state.allocations)
+        pickler = WorkPickler(worker, worker.interconnect_sockets[target])
+        data = pickler.dumps([(node.uid, gstate, action)
+                              for node, gstate, action in batch])
+        self.send(("transfer", target, data))
+        pickler.push_states()
+        for node, gstate, action in batch:
+            gstate.dispose()
+        if pickler.pushed_states:
+            time = datetime.datetime.now() - start
+            self.steal_policy.record_state_transfer(
+                time.total_seconds(), len(pickler.pushed_states))
+        logging.debug("---- End of transfer ----")
+
+    def tag_allocations(self, allocations):
+        for allocation in allocations:
+            if allocation.key is None:
+                allocation.key = (self.worker.worker_id,
+                                  self.allocations_counter)
+                self.allocations_counter += 1
+
+    def create_initial_node(self):
+        self.send(("initial_node",))
+        return RemoteNode(self, "init")
+
+    def set_final_allocations(self, node, allocations):
+        self.tag_allocations(allocations)
+        self.send(("allocations", node.uid, allocations))
+
+    def add_node(self, prev, worker, gstate, do_hash=True):
+        if do_hash:
+            hash = gstate.compute_hash()
+            uid = self.known_nodes.get(hash)
+            if uid is not None:
+                return (RemoteNode(self, uid), False)
+        else:
+            hash = None
+        self.send(("add_node", prev.uid, hash))
+        name, uid, is_new, target = self.receive()
+        assert name == "node"
+        if target is not None:
+            self.donation_targets.append(target)
+        if hash is not None:
+            self.known_nodes[hash] = uid
+        return (RemoteNode(self, uid), is_new)
+
+    def update_sleep_set(self, node, sleep_set, is_new):
+        self.send(("sleep_set", node.uid, sleep_set, is_new))
+        name, expansion = self.receive()
+        assert name == "sleep_set"
+        return expansion
+
+    def send_arc(self, node, arc):
+        if arc.action:
+            action = ActionLabel(arc.action.name, arc.action.action_index)
+        else:
+            action = None
+        if arc.data:
+            data = [(ARC_DATA_NAMES.index(d.name), d.pid, d.value)
+                    for d in arc.data]
+        else:
+            data = arc.data
+        self.send(("arc",
+                   node.uid,
+                   arc.node.uid,
+                   action,
+                   arc.events,
+                   data,
+                   arc.time,
+                   self.worker.worker_id))
+
+    def add_error_message(self, error_message):
+        error_message = copy.copy(error_message)
+        if error_message.node is not None:
+            error_message.node = error_message.node.uid
+        self.send(("error", error_message))
+
+    def get_worker_statistics(self):
+        worker = self.worker
+        if worker.stats_time is None:
+            stats = None
+        else:
+            stats = (worker.stats_time,
+                     worker.stats_queue_len,
+                     worker.stats_controller_start,
+                     worker.stats_controller_stop,
+                     worker.stats_steals,
+                     worker.stats_idle_time)
+        store_counters = [(c.store_hits, c.store_misses, c.store_evictions)
+                          for c in worker.controllers]
+        return (stats, self.message_sizes, worker.search_switches,
+                store_counters, worker.local_calls)
+
+
+class ProcessGenerator(Generator):
+
+    def __init__(self, args, process_count, aislinn_args):
+        Generator.__init__(self, args, process_count, aislinn_args)
+        self.nodes = {}
+        self.allocations = {}
+        self.connections = []
+        self.processes = []
+        # Addresses where controllers of workers accept interconnections,
+        # None for workers on this host
+        self.hosts = []
+        # Idle workers that were not offered to any busy worker
+        self.idle_workers = set()
+        # Idle workers that wait for a donation
+        self.waiting_workers = set()
+        self.exited_workers = set()
+
+    def spawn_workers(self):
+        for worker in self.workers:
+            connection, child_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_worker_process,
+                args=(self, worker.worker_id, child_connection))
+            process.start()
+            child_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+            self.hosts.append(None)
+
+    def start_workers(self):
+        self.spawn_workers()
+
+        workers_count = len(self.workers)
+        for i in xrange(workers_count):
+            if not self.wait_for(i, "started"):
+                return False
+
+        for i in xrange(workers_count):
+            for j in xrange(i + 1, workers_count):
+                self.connections[i].send(
+                    ("listen", j, self.hosts[i] is None))
+                message = self.wait_for(i, "ports")
+                if not message:
+                    return False
+                self.connections[j].send(
+                    ("connect", i, self.hosts[i], message[1]))
+                if not self.wait_for(j, "connected"):
+                    return False
+
+        # All workers are initialized concurrently,
+        # non-first workers then obtain post MPI_Init states from worker 0
+        for i in xrange(1, workers_count):
+            self.connections[i].send(("init_nonfirst",))
+        self.connections[0].send(("init",))
+        info = self.wait_for(0, "init_info")
+        if not info:
+            return False
+        for i in xrange(1, workers_count):
+            if not self.wait_for(i, "ready"):
+                return False
+            self.connections[0].send(("share_initial_states", i))
+            message = self.wait_for(0, "initial_states")
+            if not message:
+                return False
+            self.connections[i].send(
+                ("pull_initial_states", 0, message[1], info[1], info[2]))
+            if not self.wait_for(i, "ready"):
+                return False
+
+        for connection in self.connections:
+            connection.send(("explore",))
+        return True
+
+    def wait_for(self, worker_id, name):
+        connection = self.connections[worker_id]
+        while True:
+            message = connection.recv()
+            if message[0] == name and name != "exit":
+                return message
+            self.process_message(worker_id, message)
+            if message[0] == "exit":
+                return message if name == "exit" else None
+
+    def main_cycle(self):
+        while len(self.idle_workers) < len(self.workers):
+            connections, _, _ = select.select(self.connections, (), ())
+            for connection in connections:
+                worker_id = self.connections.index(connection)
+                self.process_message(worker_id, connection.recv())
+
+    def process_message(self, worker_id, message):
+        name = message[0]
+        if name == "add_node":
+            self.connections[worker_id].send(
+                self.process_add_node(message[1], message[2]))
+        elif name == "sleep_set":
+            node = self.nodes[message[1]]
+            self.connections[worker_id].send(
+                ("sleep_set",
+                 self.update_sleep_set(node, message[2], message[3])))
+        elif name == "arc":
+            self.process_arc(*message[1:])
+        elif name == "initial_node":
+            node = self.create_initial_node()
+            self.nodes[node.uid] = node
+        elif name == "allocations":
+            self.nodes[message[1]].allocations = \
+                [self.allocations.setdefault(a.key, a) for a in message[2]]
+        elif name == "error":
+            error_message = message[1]
+            if error_message.node is not None:
+                error_message.node = self.nodes[error_message.node]
+            self.add_error_message(error_message)
+        elif name == "idle":
+            self.idle_workers.add(worker_id)
+        elif name == "no_work":
+            self.waiting_workers.remove(message[1])
+            self.idle_workers.add(message[1])
+        elif name == "transfer":
+            target = message[1]
+            self.waiting_workers.remove(target)
+            self.connections[target].send(("work", worker_id, message[2]))
+        elif name == "stopped":
+            raise ErrorFound()
+        elif name == "exception":
+            raise Exception("Worker {0} failed:\n{1}"
+                            .format(worker_id, message[1]))
+        elif name == "exit":
+            self.exited_workers.add(worker_id)
+            self.set_worker_statistics(self.workers[worker_id], message[1])
+        else:
+            assert 0, "Invalid message " + repr(message)
+
+    def process_add_node(self, prev_uid, hash):
+        if hash is not None:
+            node = self.statespace.get_node_by_hash(hash)
+            if node is not None:
+                return ("node", node.uid, False, self.pick_idle_worker())
+        uid = str(self.statespace.nodes_count)
+        node = Node(uid, hash)
+        logging.debug("New node %s", node.uid)
+        node.prev = self.nodes[prev_uid]
+        self.statespace.add_node(node)
+        self.nodes[uid] = node
+
+        if self.statespace.nodes_count > self.max_states:
+            logging.info("Maximal number of states reached")
+            raise ErrorFound()
+        return ("node", uid, True, self.pick_idle_worker())
+
+    def pick_idle_worker(self):
+        if not self.idle_workers:
+            return None
+        worker_id = self.idle_workers.pop()
+        self.waiting_workers.add(worker_id)
+        return worker_id
+
+    def process_arc(self, uid, target_uid, action, events, data, time, worker):
+        if data:
+            data = [ArcData(ARC_DATA_NAMES[name], pid, value)
+                    for name, pid, value in data]
+        arc = Arc(self.nodes[target_uid], action, events, data)
+        arc.time = time
+        arc.worker = worker
+        self.nodes[uid].add_arc(arc)
+
+    def set_worker_statistics(self, worker, statistics):
+        (stats, message_sizes, worker.search_switches, store_counters,
+         worker.local_calls) = statistics
+        self.message_sizes.update(message_sizes)
+        for c, counters in zip(worker.controllers, store_counters):
+            c.store_hits, c.store_misses, c.store_evictions = counters
+        if stats is not None:
+            (worker.stats_time,
+             worker.stats_queue_len,
+             worker.stats_controller_start,
+             worker.stats_controller_stop,
+             worker.stats_steals,
+             worker.stats_idle_time) = stats
+
+    def final_check(self):
+        for connection in self.connections:
+            connection.send(("finish",))
+        for worker_id in xrange(len(self.workers)):
+            self.wait_for(worker_id, "exit")
+
+    def stop_workers(self):
+        for worker_id, connection in enumerate(self.connections):
+            try:
+                connection.send(("quit",))
+                while worker_id not in self.exited_workers:
+                    message = connection.recv()
+                    if message[0] == "exit":
+                        self.process_message(worker_id, message)
+            except (IOError, EOFError):
+                logging.error("Worker %s terminated unexpectedly", worker_id)
+        for process in self.processes:
+            process.join()
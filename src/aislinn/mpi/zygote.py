@@ -0,0 +1,256 @@
+#
+#    Copyright (C) 2014 Stanislav Bohm
+#
+#    This file is part of Aislinn.
+#
+#    Aislinn is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 2 of the License, or
+#    (at your option) any later version.
+#
+#    Aislinn is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Aislinn.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Controllers started in advance by a zygote server
+#
+# 'aislinn --zygote-server=PATH PROGRAM' starts AVTs for the program,
+# lets them run to the first event and saves the state at this point.
+# Aislinn started with --zygote=PATH asks the server for AVTs instead of
+# starting new ones. The server moves control connections of AVTs to
+# AF_UNIX sockets created by the client (command RECONNECT).
+# When the client finishes, AVTs are reset to the saved state (command
+# RESET) and moved back to the server that keeps them for the next run.
+# Processes of AVTs are always owned by the server.
+
+from vgtool.controller import Controller
+from worker import configure_controller, CAPTURE_SYSCALLS
+
+import base.paths as paths
+import itertools
+import logging
+import multiprocessing.connection
+import os
+import shutil
+import socket
+import tempfile
+
+
+# Seconds for which the server waits for a returned AVT
+RELEASE_TIMEOUT = 10
+
+
+def controller_key(controller, capture_syscalls):
+    """ AVTs of the server can be used only by a client
+        that would start them in the same way """
+    return (controller.valgrind_bin,
+            tuple(controller.args),
+            os.getcwd(),
+            tuple(capture_syscalls),
+            controller.profile,
+            controller.heap_size,
+            controller.redzone_size,
+            controller.verbose,
+            controller.binary_protocol)
+
+
+def listen_unix(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    return sock
+
+
+class ZygoteServer:
+
+    def __init__(self, path, args, pool_size, aislinn_args):
+        self.path = path
+        self.args = args
+        self.pool_size = pool_size
+        self.aislinn_args = aislinn_args
+        # Triplets (controller, output of the first event, state_id)
+        self.pool = []
+        # Entries of the pool used by clients, indexed by tokens
+        self.attached = {}
+        self.tokens = itertools.count()
+        self.key = controller_key(self.make_controller(), CAPTURE_SYSCALLS)
+        self.directory = None
+
+    def make_controller(self):
+        controller = Controller(paths.VALGRIND_BIN, self.args)
+        configure_controller(controller, self.aislinn_args)
+        # Memory shared with the server is not accessible for clients
+        controller.shm_size = 0
+        return controller
+
+    def kill_controller(self, controller):
+        process = controller.process
+        controller.kill()
+        if process is not None:
+            process.wait()
+
+    def fill_pool(self, size):
+        controllers = [self.make_controller()
+                       for i in xrange(size - len(self.pool))]
+        for controller in controllers:
+            controller.start(capture_syscalls=CAPTURE_SYSCALLS)
+        for controller in controllers:
+            lines = [controller.receive_line()]
+            while lines[-1].startswith("PROFILE"):
+                lines.append(controller.receive_line())
+            state_id = controller.save_state()
+            self.pool.append(
+                (controller, "".join(line + "\n" for line in lines),
+                 state_id))
+        while len(self.pool) > size:
+            self.kill_controller(self.pool.pop()[0])
+
+    def serve(self):
+        self.directory = tempfile.mkdtemp(prefix="aislinn-zygote-")
+        listener = multiprocessing.connection.Listener(
+            self.path, family="AF_UNIX")
+        try:
+            while True:
+                # AVTs used by clients are returned to the pool later
+                self.fill_pool(max(0, self.pool_size - len(self.attached)))
+                logging.info("Zygote server is ready on %s", self.path)
+                connection = listener.accept()
+                try:
+                    self.process_request(connection)
+                except (EOFError, IOError):
+                    logging.warning("Connection with a client was lost")
+                finally:
+                    connection.close()
+        finally:
+            listener.close()
+            for controller, output, state_id in self.pool:
+                self.kill_controller(controller)
+            for controller, output, state_id in self.attached.values():
+                self.kill_controller(controller)
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def process_request(self, connection):
+        message = connection.recv()
+        if message[0] == "attach":
+            self.attach(connection, message[1], message[2])
+        elif message[0] == "release":
+            self.release(connection, message[1])
+
+    def attach(self, connection, key, addresses):
+        if key != self.key:
+            connection.send(("error",
+                             "Server runs a different program or options"))
+            return
+        if len(addresses) > len(self.pool):
+            self.fill_pool(len(addresses))
+        result = []
+        for path in addresses:
+            entry = self.pool.pop()
+            controller, output, state_id = entry
+            controller.reconnect(path)
+            token = next(self.tokens)
+            self.attached[token] = entry
+            result.append((token, output, state_id))
+        connection.send(("ok", result))
+
+    def release(self, connection, tokens):
+        addresses = [os.path.join(self.directory, str(token))
+                 for token in tokens]
+        sockets = [listen_unix(path) for path in addresses]
+        try:
+            connection.send(("ok", addresses))
+            released = connection.recv()[1]
+            for token, sock in zip(tokens, sockets):
+                entry = self.attached.pop(token)
+                controller = entry[0]
+                if token not in released:
+                    self.kill_controller(controller)
+                    continue
+                sock.settimeout(RELEASE_TIMEOUT)
+                try:
+                    s, address = sock.accept()
+                except socket.timeout:
+                    self.kill_controller(controller)
+                    continue
+                s.settimeout(None)
+                controller.attach(s, "")
+                self.pool.append(entry)
+        finally:
+            for sock in sockets:
+                sock.close()
+            for path in addresses:
+                os.unlink(path)
+
+
+class ZygoteClient:
+
+    def __init__(self, path):
+        self.path = path
+        # Triplets (controller, token, state_id)
+        self.attached = []
+        self.attached_count = 0
+
+    def attach_controllers(self, controllers, capture_syscalls):
+        """ Returns False if AVTs cannot be obtained from the server """
+        key = controller_key(controllers[0], capture_syscalls)
+        directory = tempfile.mkdtemp(prefix="aislinn-")
+        sockets = []
+        try:
+            addresses = [os.path.join(directory, str(i))
+                     for i in xrange(len(controllers))]
+            sockets = [listen_unix(path) for path in addresses]
+            try:
+                connection = multiprocessing.connection.Client(
+                    self.path, family="AF_UNIX")
+            except socket.error:
+                logging.warning("Cannot connect to zygote server %s",
+                                self.path)
+                return False
+            try:
+                connection.send(("attach", key, addresses))
+                message = connection.recv()
+            finally:
+                connection.close()
+            if message[0] != "ok":
+                logging.warning("Zygote server: %s", message[1])
+                return False
+            for controller, sock, (token, output, state_id) \
+                    in zip(controllers, sockets, message[1]):
+                s, address = sock.accept()
+                controller.attach(s, output)
+                self.attached.append((controller, token, state_id))
+                self.attached_count += 1
+            logging.debug("Controllers attached from zygote server")
+            return True
+        finally:
+            for sock in sockets:
+                sock.close()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def release_controllers(self):
+        if not self.attached:
+            return
+        connection = multiprocessing.connection.Client(
+            self.path, family="AF_UNIX")
+        try:
+            connection.send(("release",
+                             [token for c, token, s in self.attached]))
+            addresses = connection.recv()[1]
+            released = []
+            for (controller, token, state_id), path \
+                    in zip(self.attached, addresses):
+                if controller.running or not controller.reset(state_id):
+                    # AVT exits when the connection is closed
+                    controller.socket.socket.close()
+                else:
+                    controller.reconnect(path)
+                    released.append(token)
+            connection.send(("released", released))
+        finally:
+            connection.close()
+        self.attached = []
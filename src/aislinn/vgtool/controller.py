@@ -25,7 +25,16 @@ import subprocess
 import logging
 import hashlib
 import select
+import struct
 import os
+import fcntl
+import mmap
+import shutil
+import signal
+import tempfile
+import zlib
+import collections
+import bisect
 
 
 class UnexpectedOutput(Exception):
@@ -37,6 +46,80 @@ class UnexpectedOutput(Exception):
         return self.output
 
 
+def open_shm(size):
+    """ Returns a descriptor of an anonymous file with 'size' bytes
+        that can be mapped as shared memory """
+    if os.path.isdir("/dev/shm"):
+        directory = "/dev/shm"
+    else:
+        directory = None
+    fd, path = tempfile.mkstemp(prefix="aislinn-", dir=directory)
+    os.unlink(path)
+    os.ftruncate(fd, size)
+    # AVT inherits the descriptor
+    fcntl.fcntl(fd, fcntl.F_SETFD, 0)
+    return fd
+
+
+class SharedSegment:
+    """ Memory mapped by all AVTs of a worker, data written into it once
+        can be copied into buffers of all of them (NEW_BUFFER_SEGMENT) """
+
+    def __init__(self, size):
+        self.size = size
+        self.fd = open_shm(size)
+        self.mmap = mmap.mmap(self.fd, size)
+        # Sorted pairs (offset, size) of free parts, blocks are
+        # allocated by the first fit and released blocks are merged
+        self.free = [(0, size)]
+
+    def alloc(self, size):
+        """ Returns an offset of a new block or None if it does not fit """
+        for i, (offset, free_size) in enumerate(self.free):
+            if free_size >= size:
+                if free_size == size:
+                    del self.free[i]
+                else:
+                    self.free[i] = (offset + size, free_size - size)
+                return offset
+        return None
+
+    def release(self, offset, size):
+        i = bisect.bisect(self.free, (offset, size))
+        if i < len(self.free) and offset + size == self.free[i][0]:
+            size += self.free[i][1]
+            del self.free[i]
+        if i > 0 and sum(self.free[i - 1]) == offset:
+            i -= 1
+            offset, prev_size = self.free.pop(i)
+            size += prev_size
+        self.free.insert(i, (offset, size))
+
+    def close(self):
+        if self.fd is not None:
+            self.mmap.close()
+            os.close(self.fd)
+            self.fd = None
+
+
+def compress_file(source, target):
+    compressor = zlib.compressobj(1)
+    with open(source, "rb") as fin:
+        with open(target, "wb") as fout:
+            for data in iter(lambda: fin.read(1024 * 1024), ""):
+                fout.write(compressor.compress(data))
+            fout.write(compressor.flush())
+
+
+def decompress_file(source, target):
+    decompressor = zlib.decompressobj()
+    with open(source, "rb") as fin:
+        with open(target, "wb") as fout:
+            for data in iter(lambda: fin.read(1024 * 1024), ""):
+                fout.write(decompressor.decompress(data))
+            fout.write(decompressor.flush())
+
+
 def check_str(value):
     if value:
         return "check"
@@ -74,18 +157,37 @@ class Controller:
     heap_size = None
     redzone_size = None
     verbose = None
+    binary_protocol = True
+    # Size of memory shared with AVT for bulk data, 0 = only the socket
+    shm_size = 8 * 1024 * 1024
+    # SharedSegment mapped by AVT when it is started or cloned
+    segment = None
+    # ControllerPoller that is notified when the controller starts/stops
+    poller = None
+    # Maximal number of ids in one FREE_STATES/FREE_BUFFERS command
+    FREE_IDS_LIMIT = 500
+    # Maximal number of memory regions in one PACK_SEGMENT command
+    PACK_REGIONS_LIMIT = 500
 
     name = ""  # For debug purpose
 
     def __init__(self, valgrind_bin, args, cwd=None):
         self.process = None
+        # Pid of AVT created by 'clone' (it is not a child of this process)
+        self.pid = None
         self.socket = None
-        self.recv_buffer = ""
         self.args = tuple(args)
         self.cwd = cwd
-        self.server_socket = None
         self.running = False
         self.valgrind_bin = valgrind_bin
+        # Commands waiting for sending in the batch mode
+        self.batch = None
+        self.batch_acks = 0
+        # Directory of AF_UNIX socket of 'interconn_listen_unix'
+        self.listen_dir = None
+        self.shm = None
+        # Allocated part of shm by commands waiting in the batch
+        self.shm_used = 0
 
     def start(self, capture_syscalls=()):
         """ Start Valgrind with Aislinn plugin (AVT)
@@ -93,23 +195,30 @@ class Controller:
         assert self.process is None  # Nothing is running
         assert self.socket is None
 
-        self.server_socket = self._start_server()
-        port = self.server_socket.getsockname()[1]
-        self._start_valgrind(port, capture_syscalls)
+        # AVT inherits one end of the socketpair
+        sock, client_sock = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_STREAM)
+        fcntl.fcntl(sock, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        if self.shm_size:
+            shm_fd = open_shm(self.shm_size)
+        else:
+            shm_fd = None
+        try:
+            self._start_valgrind(
+                client_sock.fileno(), shm_fd, capture_syscalls)
+            if shm_fd is not None:
+                self.shm = mmap.mmap(shm_fd, self.shm_size)
+        finally:
+            client_sock.close()
+            if shm_fd is not None:
+                os.close(shm_fd)
+        self.socket = SocketWrapper(sock, self.binary_protocol)
 
     def connect(self):
         """ Connect to AVT """
-        self.server_socket.settimeout(5.0)
-        try:
-            sock, addr = self.server_socket.accept()
-        except socket.timeout:
-            logging.error("Aislinn client was not started")
-            return False
-        self.socket = SocketWrapper(sock)
-        self.socket.set_no_delay()
-        self.server_socket.close()
-        self.server_socket = None
-        return True
+        # The connection is already created by 'start',
+        # the method is kept for interface compatibility
+        return self.socket is not None
         # User has to call receive_line after calling this method
         # But it may take some time to initialize vgclient, hence
         # it is not build in in connect to allow polling
@@ -122,103 +231,217 @@ class Controller:
             return None
         return self.receive_line()
 
+    def attach(self, sock, output):
+        """ Takes over AVT started by another controller that was moved
+            to 'sock' by 'reconnect'; 'output' (lines not processed by
+            the previous controller) is received as if it came from AVT """
+        assert self.socket is None
+        self.socket = SocketWrapper(sock, self.binary_protocol)
+        line = self.receive_line()
+        if line != "Ok":
+            raise UnexpectedOutput(line)
+        self.socket.unread(output)
+
+    def reconnect(self, path):
+        """ Moves the control connection of AVT to the AF_UNIX socket
+            listening on 'path'; the controller cannot be used
+            anymore (but the process is still owned by it) """
+        self.flush_batch()
+        self.send_command(self.make_command("RECONNECT", path))
+        self.socket.socket.close()
+        self.socket = None
+
+    def clone(self, controller):
+        """ Forks AVT paused in a call; the copy is taken over
+            by 'controller' that was not started. Both processes
+            stay in the current state. """
+        # Fork is called by the client, its changes are reverted
+        state_id = Controller.save_state(self)
+        directory = tempfile.mkdtemp(prefix="aislinn-")
+        try:
+            path = os.path.join(directory, "clone")
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.bind(path)
+                sock.listen(1)
+                line = self.send_and_receive(
+                    self.make_command("CLONE", path))
+                args = line.split()
+                if args[0] != "CLONE" or int(args[1]) < 0:
+                    raise UnexpectedOutput(line)
+                s, address = sock.accept()
+            finally:
+                sock.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        controller.attach(s, "")
+        controller.pid = int(args[1])
+        # The mapping of the segment is inherited
+        controller.segment = self.segment
+        for c in (self, controller):
+            Controller.restore_state(c, state_id)
+            Controller.free_state(c, state_id)
+
+    def reset(self, state_id):
+        """ Frees all states except 'state_id' and all buffers,
+            then 'state_id' is restored. Returns False if AVT
+            cannot continue (e.g. an error was reported) """
+        return self.send_and_receive(
+            self.make_command("RESET", state_id)) == "Ok"
+
+    def fileno(self):
+        return self.socket.socket.fileno()
+
+    def set_running(self, value):
+        if self.running == value:
+            return
+        self.running = value
+        if self.poller is not None:
+            if value:
+                self.poller.register(self)
+            else:
+                self.poller.unregister(self)
+
     def kill(self):
         """ Kills running AVT """
         if self.process and self.process.poll() is None:
             self.process.kill()
             self.process = None
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.pid = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
 
     def set_capture_syscall(self, syscall, value):
         """ Switches on/off a capturing a syscall """
-        self.send_and_receive_ok(
-            "SET syscall {0} {1}\n".format(syscall, "on" if value else "off"))
+        self.send_and_receive_ok(self.make_command(
+            "SET", "syscall", syscall, "on" if value else "off"))
+
+    def set_local_answer(self, name, args, value):
+        """ AVT answers calls 'name(*args, int *result)' itself by
+            writing 'value'; they are reported by the line
+            "LOCAL name,arg,...,result ..." before the next event """
+        self.send_and_receive_ok(self.make_command(
+            "LOCAL_ANSWER", name, len(args), *(tuple(args) + (value,))))
 
     def save_state(self):
         """ Save a current process state """
-        return self.send_and_receive_int("SAVE\n")
+        return self.send_and_receive_int(self.make_command("SAVE"))
 
     def restore_state(self, state_id):
         """ Restores a saved process state """
-        self.send_and_receive_ok("RESTORE {0}\n".format(state_id))
+        self.send_and_receive_ok(self.make_command("RESTORE", state_id))
 
     def free_state(self, state_id):
         """ Frees a saved state """
-        self.send_command("FREE {0}\n".format(state_id))
+        self.send_command(self.make_command("FREE", state_id))
+
+    def free_states(self, state_ids):
+        """ Frees a list of saved states """
+        self._free_ids("FREE_STATES", state_ids)
 
     def run_process(self):
         """ Resumes the paused process and wait until new event,
         then returns the event """
-        return self.send_and_receive("RUN\n")
+        return self.send_and_receive(self.make_command("RUN"))
 
     def run_drop_syscall(self, return_value):
         """ When process is paused in syscall,
         it skips the syscall and then behaves as 'run' """
         return self.send_and_receive(
-            "RUN_DROP_SYSCALL {0}\n".format(return_value))
+            self.make_command("RUN_DROP_SYSCALL", return_value))
 
     def run_process_async(self):
         """ Asynchronous version of 'run'. It does not wait for the
            next event and returns immediately """
-        self.running = True
-        self.send_command("RUN\n")
+        self.set_running(True)
+        self.send_command(self.make_command("RUN"))
 
     def run_drop_syscall_async(self, return_value):
         """ Asynchornous version of 'run_drop_syscall'. It does not wait
            for the next event and retusn immediately. """
-        self.running = True
-        self.send_command("RUN_DROP_SYSCALL {0}\n".format(return_value))
+        self.set_running(True)
+        self.send_command(self.make_command("RUN_DROP_SYSCALL", return_value))
 
     def finish_async(self):
         """ Finishes an asynchronous call """
         assert self.running
-        self.running = False
+        self.set_running(False)
         return self.receive_line()
 
     def run_function(self, fn_pointer, fn_type, *args):
         """ Executes a function in client """
-        command = "RUN_FUNCTION {0} {1} {2} {3} \n".format(
-                  fn_pointer, fn_type, len(args), " ".join(map(str, args)))
+        command = self.make_command(
+            "RUN_FUNCTION", fn_pointer, fn_type, len(args), *args)
         return self.send_and_receive(command)
 
     def client_malloc(self, size):
         """ Calls "malloc" in client, i.e. allocate a memory
             that is visible for the verified process """
-        return self.send_and_receive_int("CLIENT_MALLOC {0}\n".format(size))
+        return self.send_and_receive_int(
+            self.make_command("CLIENT_MALLOC", size))
 
     def client_free(self, mem):
         """ Calls "free" in client (an opposite function to client_malloc) """
-        self.send_and_receive_ok("CLIENT_FREE {0}\n".format(mem))
+        self.send_and_receive_ok(self.make_command("CLIENT_FREE", mem))
 
     def client_malloc_from_buffer(self, buffer_id):
         """ Allocate a client's memory with the same size as buffer and
             copy buffer into this memory. """
         return self.send_and_receive_int(
-            "CLIENT_MALLOC_FROM_BUFFER {0}\n".format(buffer_id))
+            self.make_command("CLIENT_MALLOC_FROM_BUFFER", buffer_id))
 
     def memcpy(self, addr, source, size, check=True):
         """ Copies a non-overlapping block memory """
-        self.send_and_receive_ok("WRITE {0} {1} addr {2} {3}\n"
-                                 .format(check_str(check), addr, source, size))
+        self.send_and_receive_ok(self.make_command(
+            "WRITE", check_str(check), addr, "addr", source, size))
+
+    def make_buffer_from_segment(self, buffer_id, offset, size):
+        """ Creates a buffer with data placed in the shared segment """
+        self.send_and_receive_ok(self.make_command(
+            "NEW_BUFFER_SEGMENT", buffer_id, offset, size))
+        # The segment may be rewritten when the command is confirmed
+        self.flush_batch()
+
+    def pack_into_segment(self, offset, regions):
+        """ Copies regions (pairs addr, size) of client's memory into
+            the shared segment at 'offset', returns md5 of packed data """
+        assert len(regions) <= self.PACK_REGIONS_LIMIT
+        args = []
+        for addr, size in regions:
+            args.append(addr)
+            args.append(size)
+        return self.send_and_receive(self.make_command(
+            "PACK_SEGMENT", offset, len(regions), *args)).lower()
 
     def write_into_buffer(self, buffer_id, index, addr, size):
         """ Writes a client memory into a buffer """
         # Copy a memory from client addres to the buffer
-        self.send_and_receive_ok("WRITE_BUFFER {0} {1} {2} {3}\n"
-                                 .format(buffer_id, index, addr, size))
+        self.send_and_receive_ok(self.make_command(
+            "WRITE_BUFFER", buffer_id, index, addr, size))
 
     def write_data(self, addr, data, check=True):
         """ Writes data (str) into client's memory """
         size = len(data)
         if size == 0:
             return
+        offset = self.shm_alloc(size)
+        if offset is not None:
+            self.shm[offset:offset + size] = data
+            self.send_and_receive_ok(self.make_command(
+                "WRITE", check_str(check), addr, "shm", offset, size))
+            return
         # TODO: the following constant should be benchmarked
+        command = self.make_command(
+            "WRITE", check_str(check), addr, "mem", size)
         if size < 8192:
-            command = "WRITE {0} {1} mem {2}\n{3}" \
-                .format(check_str(check), addr, len(data), data)
-            self.send_data_and_receive_ok(command)
+            self.send_data_and_receive_ok(command + data)
         else:
-            command = "WRITE {0} {1} mem {2}" \
-                .format(check_str(check), addr, len(data))
             self.send_command(command)
             self.send_data_and_receive_ok(data)
 
@@ -227,109 +450,127 @@ class Controller:
         size = len(data)
         if size == 0:
             return
+        offset = self.shm_alloc(size)
+        if offset is not None:
+            self.shm[offset:offset + size] = data
+            self.send_and_receive_ok(self.make_command(
+                "WRITE_BUFFER_SHM", buffer_addr, index, offset, size))
+            return
         # TODO: the following constant should be benchmarked
+        command = self.make_command(
+            "WRITE_BUFFER_DATA", buffer_addr, index, size)
         if size < 8192:
-            self.send_data_and_receive_ok(
-                "WRITE_BUFFER_DATA {0} {1} {2}\n{3}"
-                .format(buffer_addr, index, len(data), data))
+            self.send_data_and_receive_ok(command + data)
         else:
-            self.send_command("WRITE_BUFFER_DATA {0} {1} {2}\n"
-                              .format(buffer_addr, index, len(data)))
+            self.send_command(command)
             self.send_data_and_receive_ok(data)
 
     def write_buffer(self, addr, buffer_addr,
                      index=None, size=None, check=True):
         """ Copies a buffer into client's memory """
         if index is None or size is None:
-            self.send_and_receive_ok(
-                "WRITE {0} {1} buffer {2}\n"
-                .format(check_str(check), addr, buffer_addr))
+            self.send_and_receive_ok(self.make_command(
+                "WRITE", check_str(check), addr, "buffer", buffer_addr))
         else:
             assert size is not None
             if size == 0:
                 return
-            self.send_and_receive_ok(
-                "WRITE {0} {1} buffer-part {2} {3} {4}\n"
-                .format(check_str(check), addr, buffer_addr, index, size))
+            self.send_and_receive_ok(self.make_command(
+                "WRITE", check_str(check), addr,
+                "buffer-part", buffer_addr, index, size))
 
     def write_int(self, addr, value, check=True):
         """ Writes int into client's memory """
-        self.send_and_receive_ok("WRITE {0} {1} int {2}\n"
-                                 .format(check_str(check), addr, value))
+        self.send_and_receive_ok(self.make_command(
+            "WRITE", check_str(check), addr, "int", value))
 
     def write_string(self, addr, value, check=True):
         """ Writes string into client's memory """
-        self.send_and_receive_ok("WRITE {0} {1} string {2}\n"
-                                 .format(check_str(check), addr, value))
+        self.send_and_receive_ok(self.make_command(
+            "WRITE", check_str(check), addr, "string", value))
 
     def write_pointer(self, addr, value, check=True):
         """ Writes pointer into client's memory """
-        self.send_and_receive_ok("WRITE {0} {1} pointer {2}\n"
-                                 .format(check_str(check), addr, value))
+        self.send_and_receive_ok(self.make_command(
+            "WRITE", check_str(check), addr, "pointer", value))
 
     def write_ints(self, addr, values, check=True):
         """ Writes an array of ints into client's memory """
-        self.send_and_receive_ok(
-            "WRITE {0} {1} ints {2} {3}\n"
-            .format(check_str(check),
-                    addr,
-                    len(values),
-                    " ".join(map(str, values))))
+        self.send_and_receive_ok(self.make_command(
+            "WRITE", check_str(check), addr, "ints", len(values), *values))
 
     def read_mem(self, addr, size):
         """ Reads client's memory """
-        return self.send_and_receive_data("READ {0} mem {1}\n"
-                                          .format(addr, size))
+        if self.shm is not None and size <= self.shm_size:
+            return self.send_and_receive_shm(
+                self.make_command("READ", addr, "shm", 0, size), size)
+        return self.send_and_receive_data(
+            self.make_command("READ", addr, "mem", size))
 
     def read_int(self, addr):
         """ Reads int from client's memory """
-        return self.send_and_receive_int("READ {0} int\n".format(addr))
+        return self.send_and_receive_int(self.make_command("READ", addr, "int"))
 
     def read_pointer(self, addr):
         """ Reads pointer from client's memory """
-        return self.send_and_receive_int("READ {0} pointer\n".format(addr))
+        return self.send_and_receive_int(
+            self.make_command("READ", addr, "pointer"))
 
     def read_ints(self, addr, count):
         """ Reads an array of ints from client's memory """
-        line = self.send_and_receive("READ {0} ints {1}\n".format(addr, count))
+        command = self.make_command("READ", addr, "ints", count)
+        if self.socket.binary:
+            return list(struct.unpack(
+                "={0}i".format(count), self.send_and_receive_data(command)))
+        line = self.send_and_receive(command)
         results = map(int, line.split())
         assert len(results) == count
         return results
 
     def read_pointers(self, addr, count):
         """ Reads an array of pointers from client's memory """
-        line = self.send_and_receive("READ {0} pointers {1}\n"
-                                     .format(addr, count))
+        command = self.make_command("READ", addr, "pointers", count)
+        if self.socket.binary:
+            return list(struct.unpack(
+                "={0}Q".format(count), self.send_and_receive_data(command)))
+        line = self.send_and_receive(command)
         results = map(int, line.split())
         assert len(results) == count
         return results
 
     def read_string(self, addr):
         """ Reads a string from client's memory """
-        return self.send_and_receive_data("READ {0} string\n".format(addr))
-
-    def read_buffer(self, buffer_id):
-        """ Reads a buffer """
-        return self.send_and_receive_data("READ_BUFFER {0}\n"
-                                          .format(buffer_id))
+        return self.send_and_receive_data(
+            self.make_command("READ", addr, "string"))
+
+    def read_buffer(self, buffer_id, size=None):
+        """ Reads a buffer, if its size is known, it may be transferred
+            through the shared memory """
+        if self.shm is not None and size is not None \
+                and size <= self.shm_size:
+            return self.send_and_receive_shm(
+                self.make_command("READ_BUFFER_SHM", buffer_id, 0), size)
+        return self.send_and_receive_data(
+            self.make_command("READ_BUFFER", buffer_id))
 
     def hash_state(self):
         """ Hashes current process state """
-        h = self.send_and_receive("HASH\n")
+        h = self.send_and_receive(self.make_command("HASH"))
         return h
 
     def hash_buffer(self, buffer_id):
         """ Hashes a buffer """
-        return self.send_and_receive("HASH_BUFFER {0}\n".format(buffer_id))
+        return self.send_and_receive(
+            self.make_command("HASH_BUFFER", buffer_id))
 
     def get_stacktrace(self):
         """ Returns stack trace (each item separeted by ';') """
-        return self.send_and_receive("STACKTRACE\n")
+        return self.send_and_receive(self.make_command("STACKTRACE"))
 
     def get_stats(self):
         """ Gets internal statistic from client
            (number of states, buffers, etc ...) """
-        self.send_command("STATS\n")
+        self.send_command(self.make_command("STATS"))
         result = {}
         for entry in self.receive_line().split("|"):
             name, value = entry.split()
@@ -338,24 +579,25 @@ class Controller:
 
     def is_writable(self, addr, size):
         """ Returns True if an client's address is writable """
-        return self.send_and_receive("CHECK write {0} {1}\n"
-                                     .format(addr, size))
+        return self.send_and_receive(
+            self.make_command("CHECK", "write", addr, size))
 
     def is_readable(self, addr, size):
         """ Returns True if an client's address is readable """
-        return self.send_and_receive("CHECK read {0} {1}\n".format(addr, size))
+        return self.send_and_receive(
+            self.make_command("CHECK", "read", addr, size))
 
     def lock_memory(self, addr, size):
         """ Marks a client's memory as read only """
-        self.send_and_receive_ok("LOCK {0} {1}\n".format(addr, size))
+        self.send_and_receive_ok(self.make_command("LOCK", addr, size))
 
     def unlock_memory(self, addr, size):
         """ Marks a client's memory as defined """
-        self.send_and_receive_ok("UNLOCK {0} {1}\n".format(addr, size))
+        self.send_and_receive_ok(self.make_command("UNLOCK", addr, size))
 
     def get_allocations(self):
         """ Get list of client's allocations on heap """
-        return self.send_and_receive("ALLOCATIONS\n")
+        return self.send_and_receive(self.make_command("ALLOCATIONS"))
 
     def interconn_listen(self):
         """ Clients start to listen for a connection on a free port,
@@ -363,22 +605,38 @@ class Controller:
             This blocks AVT but not controller.
             Method 'interconn_listen_finish' has to be called
             after this method """
-        port = self.send_and_receive_int("CONN_LISTEN\n")
-        self.running = True
+        port = self.send_and_receive_int(self.make_command("CONN_LISTEN"))
+        self.set_running(True)
         return port
 
+    def interconn_listen_unix(self):
+        """ The same as 'interconn_listen' but AVT listens on
+            an AF_UNIX socket in a private directory; it returns the path
+            of the socket, that is used for 'interconn_connect' """
+        assert self.listen_dir is None
+        self.listen_dir = tempfile.mkdtemp(prefix="aislinn-")
+        path = os.path.join(self.listen_dir, "conn")
+        self.send_and_receive_ok(self.make_command("CONN_LISTEN_UNIX", path))
+        self.set_running(True)
+        return path
+
     def interconn_listen_finish(self):
         """ This has to be called after interconn_listen.
             It blocks until the client is not connected and then
             returns socket id """
-        return int(self.finish_async())
+        result = int(self.finish_async())
+        if self.listen_dir is not None:
+            shutil.rmtree(self.listen_dir, ignore_errors=True)
+            self.listen_dir = None
+        return result
 
     def interconn_connect(self, host):
         """ Initializes a connection to another AVT that is listening by
-            'interconn_listen'. This has be followed by
-            'interconn_connect_finish'. """
-        self.running = True
-        return self.send_command("CONN_CONNECT {0}\n".format(host))
+            'interconn_listen' ('host' is "HOST:PORT") or by
+            'interconn_listen_unix' ('host' is a path).
+            This has be followed by 'interconn_connect_finish'. """
+        self.set_running(True)
+        return self.send_command(self.make_command("CONN_CONNECT", host))
 
     def interconn_connect_finish(self):
         """ This method has to follow 'interconn_connect'.
@@ -388,24 +646,101 @@ class Controller:
 
     def push_state(self, socket, state_id):
         """ Send a state through an AVT interconnection """
-        self.send_command("CONN_PUSH_STATE {0} {1}\n".format(socket, state_id))
+        self.send_command(
+            self.make_command("CONN_PUSH_STATE", socket, state_id))
 
     def pull_state(self, socket):
         """ Receives a state through an AVT interconnection """
-        return self.send_and_receive_int("CONN_PULL_STATE {0}\n"
-                                         .format(socket))
+        return self.send_and_receive_int(
+            self.make_command("CONN_PULL_STATE", socket))
+
+    def spill_state(self, state_id, filename):
+        """ Writes a saved state into a file, the state is not freed """
+        self.send_and_receive_ok(
+            self.make_command("SPILL_STATE", state_id, filename))
+
+    def load_state(self, filename):
+        """ Loads a state written by spill_state """
+        return self.send_and_receive_int(
+            self.make_command("LOAD_STATE", filename))
+
+    def start_batch(self):
+        """ Starts the batch mode. Commands are not sent immediately,
+            they are sent at once when an answer is expected, when
+            the process is resumed or by 'finish_batch'.
+            Confirmations ("Ok") are checked when the batch is sent. """
+        assert self.batch is None
+        self.batch = []
+
+    def finish_batch(self):
+        """ Sends remaining commands and leaves the batch mode """
+        try:
+            self.flush_batch()
+        finally:
+            self.cancel_batch()
+
+    def cancel_batch(self):
+        """ Leaves the batch mode, commands that were not sent yet
+            are thrown away """
+        self.batch = None
+        self.batch_acks = 0
+        self.shm_used = 0
+
+    def flush_batch(self):
+        if not self.batch:
+            return
+        data = "".join(self.batch)
+        acks = self.batch_acks
+        self.batch = []
+        self.batch_acks = 0
+        self.socket.send_data(data)
+        # All confirmations are received before an error is raised,
+        # so answers of following commands are not mixed with them
+        unexpected = None
+        for i in xrange(acks):
+            r = self.receive_line()
+            if r != "Ok" and unexpected is None:
+                unexpected = r
+        self.shm_used = 0
+        if unexpected is not None:
+            raise self.on_unexpected_output(unexpected)
+
+    def shm_alloc(self, size):
+        """ Returns an offset in shm where data of the next command
+            can be placed or None if data cannot be sent through shm """
+        if self.shm is None or size > self.shm_size:
+            return None
+        if self.batch is None:
+            return 0
+        # Data of commands waiting in the batch has to be kept
+        if self.shm_used + size > self.shm_size:
+            self.flush_batch()
+        offset = self.shm_used
+        self.shm_used += size
+        return offset
+
+    def make_command(self, *args):
+        """ Encodes a command with arguments (strings or ints)
+            for 'send_command' """
+        return self.socket.encode_command(args)
 
     def send_command(self, command):
         """ Send a command to AVT """
-        assert command[-1] == "\n", "Command does not end with new line"
-        self.socket.send_data(command)
+        self.send_data(command)
 
     def send_data(self, data):
         """ Send data to AVT """
-        self.socket.send_data(data)
+        if self.batch is None:
+            self.socket.send_data(data)
+            return
+        self.batch.append(data)
+        if self.running:
+            # Asynchronous commands are not delayed
+            self.flush_batch()
 
     def receive_line(self):
         """ Receives a line (string) from AVT """
+        self.flush_batch()
         line = self.socket.read_line()
         if line.startswith("Error:"):
             raise Exception("Received line: " + line)
@@ -413,6 +748,7 @@ class Controller:
 
     def receive_data(self):
         """ Receives a data from AVT """
+        self.flush_batch()
         args = self.socket.read_line().split()
         return self.socket.read_data(int(args[1]))
 
@@ -422,6 +758,13 @@ class Controller:
         assert not self.running
         return self.receive_line()
 
+    def send_and_receive_shm(self, command, size):
+        """ Sends a command that places its answer
+            at the beginning of shm """
+        self.send_and_receive_ok(command)
+        self.flush_batch()
+        return self.shm[:size]
+
     def send_and_receive_data(self, command):
         """ Sends a command and waits for the answer as data."""
         self.send_command(command)
@@ -432,6 +775,9 @@ class Controller:
         """ Sends a command and waits for its confirmation (string "Ok\n") """
         self.send_command(command)
         assert not self.running
+        if self.batch is not None:
+            self.batch_acks += 1
+            return
         r = self.receive_line()
         if r != "Ok":
             raise self.on_unexpected_output(r)
@@ -440,6 +786,9 @@ class Controller:
         """ Sends data and waits for its confirmation (string "Ok\n") """
         self.send_data(data)
         assert not self.running
+        if self.batch is not None:
+            self.batch_acks += 1
+            return
         r = self.receive_line()
         if r != "Ok":
             raise self.on_unexpected_output(r)
@@ -460,33 +809,54 @@ class Controller:
 
     def send_and_receive_int(self, command):
         """ Sends a command and waits for int """
-        return int(self.send_and_receive(command))
+        self.send_command(command)
+        assert not self.running
+        return self.receive_int()
+
+    def receive_int(self):
+        """ Receives int from AVT """
+        self.flush_batch()
+        if self.socket.binary:
+            value = self.socket.read_number()
+            if value is not None:
+                return value
+        return int(self.receive_line())
 
     def debug_compare(self, state_id1, state_id2):
         """ Compares two saved states in AVT """
-        self.send_and_receive_ok("DEBUG_COMPARE {0} {1}\n"
-                                 .format(state_id1, state_id2))
+        self.send_and_receive_ok(
+            self.make_command("DEBUG_COMPARE", state_id1, state_id2))
 
     def debug_dump_state(self, state_id):
         """ Dumps a saved state on stderr """
-        self.send_and_receive_ok("DEBUG_DUMP_STATE {0}\n"
-                                 .format(state_id))
+        self.send_and_receive_ok(
+            self.make_command("DEBUG_DUMP_STATE", state_id))
 
     def make_buffer(self, buffer_id, size):
         """ Creates a new buffer """
-        self.send_and_receive_ok("NEW_BUFFER {0} {1}\n"
-                                 .format(buffer_id, size))
+        self.send_and_receive_ok(
+            self.make_command("NEW_BUFFER", buffer_id, size))
 
     def free_buffer(self, buffer_id):
         """ Frees a buffer """
-        self.send_command("FREE_BUFFER {0}\n".format(buffer_id))
+        self.send_command(self.make_command("FREE_BUFFER", buffer_id))
 
-    def _start_valgrind(self, port, capture_syscalls):
+    def free_buffers(self, buffer_ids):
+        """ Frees a list of buffers """
+        self._free_ids("FREE_BUFFERS", buffer_ids)
+
+    def _free_ids(self, name, ids):
+        # Commands are split to fit into the command buffer of AVT
+        for i in xrange(0, len(ids), self.FREE_IDS_LIMIT):
+            chunk = ids[i:i + self.FREE_IDS_LIMIT]
+            self.send_command(self.make_command(name, len(chunk), *chunk))
+
+    def _start_valgrind(self, control_fd, shm_fd, capture_syscalls):
         args = (
             self.valgrind_bin,
             "-q",
             "--tool=aislinn",
-            "--port={0}".format(port),
+            "--control-fd={0}".format(control_fd),
             "--identification={0}".format(self.name),
         ) + tuple(["--capture-syscall=" + name for name in capture_syscalls])
 
@@ -502,6 +872,17 @@ class Controller:
         if self.verbose is not None:
             args += ("--verbose={0}".format(self.verbose),)
 
+        if self.binary_protocol:
+            args += ("--binary-protocol=yes",)
+
+        if shm_fd is not None:
+            args += ("--shm-fd={0}".format(shm_fd),
+                     "--shm-size={0}".format(self.shm_size))
+
+        if self.segment is not None:
+            args += ("--segment-fd={0}".format(self.segment.fd),
+                     "--segment-size={0}".format(self.segment.size))
+
         args += self.args
 
         if self.debug_by_valgrind_tool:
@@ -525,14 +906,6 @@ class Controller:
             args, cwd=self.cwd, env=env,
             stdout=self.stdout_file, stderr=self.stderr_file)
 
-    def _start_server(self):
-        HOST = "127.0.0.1"  # Connection only from localhost
-        PORT = 0  # Alloc arbirary empty port
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind((HOST, PORT))
-        s.listen(1)
-        return s
-
     def __repr__(self):
         return "<Controller '{0}'>".format(self.name)
 
@@ -543,6 +916,9 @@ class ControllerResourceManager(ResourceManager):
 
 class VgState(Resource):
     hash = None
+    cache_hits = 0
+    # Compressed file of an evicted state, the state has no id in AVT
+    filename = None
 
     @property
     def controller(self):
@@ -560,22 +936,51 @@ class BufferManager(ResourceManager):
         ResourceManager.__init__(self, VgBuffer)
         self.buffer_id_counter = init_value
         self.buffer_id_step = step
+        # Buffers that are not freed yet, indexed by hashes of their data
+        self.buffers = {}
+        # SharedSegment of controllers, None = data are sent to each of them
+        self.segment = None
 
     def cleanup(self):
         if self.not_used_resources:
+            # Buffers are freed by one command per controller
+            buffer_ids = {}
             for b in self.pickup_resources_to_clean():
-                b.cleanup()
-
-    def new_buffer(self, data):
-        buffer_id = self.buffer_id_counter
-        self.buffer_id_counter += self.buffer_id_step
-        buffer = self.new(buffer_id)
-        buffer.set_data(data)
-        # We add a special referece, this refence is
-        # removed when buffer is written into all controllers
-        # It may happen that state are disposed before this,
-        # (usually when an error is detected)
-        buffer.inc_ref()
+                logging.debug("Cleaning buffer: %s", b)
+                del self.buffers[b.hash]
+                for controller in b.controllers:
+                    buffer_ids.setdefault(controller, []).append(b.id)
+                b.controllers = None
+            for controller, ids in buffer_ids.items():
+                controller.free_buffers(ids)
+
+    def new_buffer(self, data, controllers):
+        """ Returns a buffer with 'data' that is created in 'controllers'
+            by their 'make_buffers'. Buffers with the same data are
+            shared, a controller that already has the buffer skips it. """
+        buffer = self._get_buffer(hashlib.md5(data).hexdigest(), len(data))
+        buffer.add_controllers(controllers, data, None)
+        return buffer
+
+    def new_buffer_from_segment(self, hash, size, offset, controllers):
+        """ The same as 'new_buffer' but data are the block of the shared
+            segment at 'offset', the buffer takes over the block """
+        buffer = self._get_buffer(hash, size)
+        buffer.add_controllers(controllers, None, offset)
+        return buffer
+
+    def _get_buffer(self, hash, size):
+        buffer = self.buffers.get(hash)
+        if buffer is None:
+            buffer_id = self.buffer_id_counter
+            self.buffer_id_counter += self.buffer_id_step
+            buffer = self.new(buffer_id)
+            buffer.hash = hash
+            buffer.size = size
+            self.buffers[hash] = buffer
+        else:
+            logging.debug("Buffer %s shared", buffer)
+            buffer.inc_ref_revive()
         return buffer
 
 
@@ -583,45 +988,81 @@ class VgBuffer(Resource):
 
     def __init__(self, manager, id):
         Resource.__init__(self, manager, id)
+        # Data are kept only until the buffer is written into controllers
         self.data = None
         self.size = None
         self.hash = None
+        # Controllers that have the buffer
         self.controllers = []
-        self.remaining_controllers = None
+        # Controllers where the buffer is not written yet
+        self.pending_controllers = []
+        # Offset of data in the shared segment
+        self.segment_offset = None
         logging.debug("New buffer: %s", self)
 
-    def cleanup(self):
-        logging.debug("Cleaning buffer: %s", self)
-        for controller in self.controllers:
-            controller.free_buffer(self.id)
-        self.controllers = None
-
-    def set_data(self, data):
-        self.data = data
-        hashthread = hashlib.md5()
-        hashthread.update(self.data)
-        self.hash = hashthread.hexdigest()
-        self.size = len(data)
+    def add_controllers(self, controllers, data, segment_offset):
+        """ Data are given as str or as an offset of a block
+            in the shared segment """
+        controllers = [c for c in controllers
+                       if c not in self.controllers and
+                       c not in self.pending_controllers]
+        if controllers and not self.pending_controllers:
+            self.data = data
+            self.segment_offset = segment_offset
+            # We add a special referece, this refence is
+            # removed when buffer is written into all controllers
+            # It may happen that state are disposed before this,
+            # (usually when an error is detected)
+            self.inc_ref()
+        elif segment_offset is not None:
+            # Data are already known
+            self.manager.segment.release(segment_offset, self.size)
+        for controller in controllers:
+            self.pending_controllers.append(controller)
+            controller.add_buffer(self)
 
     def write_data(self, controller):
         logging.debug("Writing buffer %s into %s", self, controller)
-        controller.make_buffer(self.id, self.size)
-        controller.write_data_into_buffer(self.id, 0, self.data)
+        segment = self.manager.segment
+        if self.segment_offset is None and segment is not None \
+                and self.size and \
+                sum(1 for c in self.pending_controllers
+                    if c.segment is segment) > 1:
+            # Data for more controllers are uploaded only once
+            self.segment_offset = segment.alloc(self.size)
+            if self.segment_offset is not None:
+                segment.mmap[self.segment_offset:
+                             self.segment_offset + self.size] = self.data
+        if self.segment_offset is not None and controller.segment is segment:
+            controller.make_buffer_from_segment(
+                self.id, self.segment_offset, self.size)
+        else:
+            data = self.data
+            if data is None:
+                data = segment.mmap[self.segment_offset:
+                                    self.segment_offset + self.size]
+            controller.make_buffer(self.id, self.size)
+            controller.write_data_into_buffer(self.id, 0, data)
         self.controllers.append(controller)
-        self.remaining_controllers -= 1
-        if self.remaining_controllers <= 0:
-            assert self.remaining_controllers == 0
+        self.pending_controllers.remove(controller)
+        if not self.pending_controllers:
             self.data = None
-            # Remove reference added in BufferManager.new_buffer()
+            if self.segment_offset is not None:
+                segment.release(self.segment_offset, self.size)
+                self.segment_offset = None
+            # Remove reference added in add_controllers()
             self.dec_ref()
 
     def __repr__(self):
         return "<VgBuffer id={0.id} size={0.size} ref_count={0.ref_count} " \
-               "rc={0.remaining_controllers}>".format(self)
+               "pending={1}>".format(self, len(self.pending_controllers))
 
 
 class ControllerWithResources(Controller):
 
+    # Number of saved states between two estimations
+    MEMORY_CHECK_INTERVAL = 50
+
     def __init__(self, args, cwd=None):
         Controller.__init__(self, args, cwd)
         self.states = ControllerResourceManager(VgState)
@@ -629,52 +1070,156 @@ class ControllerWithResources(Controller):
         self.state_cache = {}
         self.buffers_to_make = []
 
+        # When AVT uses more memory (bytes), the least recently used
+        # states are evicted into compressed files in 'evict_dir'
+        self.memory_limit = None
+        self.evict_dir = None
+        self.evict_directory = None
+        self.lru_states = collections.OrderedDict()
+        self.saved_since_check = 0
+        self.store_hits = 0
+        self.store_misses = 0
+        self.store_evictions = 0
+
     @property
     def states_count(self):
         assert len(self.state_cache) == self.states.resource_count
         return self.states.resource_count
 
+    def kill(self):
+        Controller.kill(self)
+        if self.evict_directory is not None:
+            shutil.rmtree(self.evict_directory, ignore_errors=True)
+            self.evict_directory = None
+
     def cleanup_states(self):
         if self.states.not_used_resources:
+            state_ids = []
             for state in self.states.pickup_resources_to_clean():
                 if state.hash:
                     del self.state_cache[state.hash]
-                self.free_state(state.id)
+                if self._forget_state(state):
+                    state_ids.append(state.id)
+            self.free_states(state_ids)
+
+    def _new_state(self, state_id, hash):
+        state = self.states.new(state_id)
+        if hash is not None:
+            state.hash = hash
+            self.state_cache[hash] = state
+        if self.memory_limit is not None:
+            self.lru_states[state] = None
+        return state
+
+    def _forget_state(self, state):
+        """ Returns True if the state has to be freed in AVT """
+        if state.filename is not None:
+            os.remove(state.filename)
+            return False
+        self.lru_states.pop(state, None)
+        return True
+
+    def check_memory(self):
+        """ Evicts the colder half of states when the memory of
+            pages and VAs allocated by AVT is over the limit """
+        self.saved_since_check = 0
+        if self.get_stats()["state-memory"] <= self.memory_limit:
+            return
+        states = self.lru_states.keys()
+        for state in states[:len(states) / 2]:
+            # States without references are freed by cleanup
+            if state.ref_count > 0:
+                self.evict_state(state)
+
+    def evict_state(self, state):
+        if self.evict_directory is None:
+            self.evict_directory = tempfile.mkdtemp(
+                prefix="aislinn-states-", dir=self.evict_dir)
+        filename = os.path.join(self.evict_directory, str(state.id))
+        Controller.spill_state(self, state.id, filename)
+        compress_file(filename, filename + ".z")
+        os.remove(filename)
+        self.free_state(state.id)
+        del self.lru_states[state]
+        state.id = None
+        state.filename = filename + ".z"
+        self.store_evictions += 1
+        logging.debug("State %s evicted", state)
+
+    def make_resident(self, state):
+        """ Loads an evicted state back into AVT """
+        if self.memory_limit is None:
+            return
+        if state.filename is None:
+            self.store_hits += 1
+            del self.lru_states[state]
+        else:
+            filename = state.filename[:-len(".z")]
+            decompress_file(state.filename, filename)
+            state.id = Controller.load_state(self, filename)
+            os.remove(filename)
+            os.remove(state.filename)
+            state.filename = None
+            self.store_misses += 1
+            logging.debug("State %s loaded", state)
+        self.lru_states[state] = None
 
     def save_state(self, hash=None):
         if hash:
-            state = self.state_cache.get(hash)
+            state = self.use_cached_state(hash)
             if state:
                 logging.debug("State %s retrieved from cache", hash)
-                state.inc_ref_revive()
                 return state
-        state = self.states.new(Controller.save_state(self))
-        if hash is not None:
-            state.hash = hash
-            self.state_cache[hash] = state
+        state = self._new_state(Controller.save_state(self), hash)
+        if self.memory_limit is not None:
+            self.saved_since_check += 1
+            if self.saved_since_check >= self.MEMORY_CHECK_INTERVAL:
+                self.check_memory()
         return state
 
     def get_cached_state(self, hash):
         return self.state_cache.get(hash)
 
+    def use_cached_state(self, hash):
+        state = self.state_cache.get(hash)
+        if state is not None:
+            state.cache_hits += 1
+            state.inc_ref_revive()
+        return state
+
     def pull_state(self, socket, hash=None):
-        state = self.states.new(Controller.pull_state(self, socket))
+        state = self._new_state(Controller.pull_state(self, socket), hash)
         if self.debug:
             self.restore_state(state)
             assert hash == self.hash_state()
-        if hash is not None:
-            state.hash = hash
-            self.state_cache[hash] = state
         return state
 
     def push_state(self, socket, state):
         self.hash_state()
+        self.make_resident(state)
         Controller.push_state(self, socket, state.id)
 
+    def spill_state(self, state, filename):
+        self.make_resident(state)
+        Controller.spill_state(self, state.id, filename)
+
+    def load_state(self, filename, hash):
+        return self._new_state(Controller.load_state(self, filename), hash)
+
+    def free_not_used_state(self, state):
+        # Frees a state immediately, not waiting for cleanup_states
+        assert state.ref_count == 0
+        self.states.not_used_resources.remove(state)
+        if state.hash:
+            del self.state_cache[state.hash]
+        if self._forget_state(state):
+            self.free_state(state.id)
+
     def save_state_with_hash(self):
         return self.save_state(self.hash_state())
 
     def restore_state(self, state):
+        self.make_resident(state)
         Controller.restore_state(self, state.id)
 
     def add_buffer(self, buffer):
@@ -686,13 +1231,52 @@ class ControllerWithResources(Controller):
                 buffer.write_data(self)
             self.buffers_to_make = []
 
-    def fileno(self):
-        return self.socket.socket.fileno()
+class ControllerPoller:
+    """ Running controllers registered in epoll. Controllers with this
+        poller (un)register themselves when they start/stop running,
+        hence waiting for an event does not scan all controllers """
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.controllers = {}  # fd -> controller
+        # Controllers that may have data in their receive buffers;
+        # such data are invisible for epoll
+        self.check = []
+
+    def register(self, controller):
+        fd = controller.fileno()
+        self.epoll.register(fd, select.EPOLLIN)
+        self.controllers[fd] = controller
+        self.check.append(controller)
+
+    def unregister(self, controller):
+        fd = controller.fileno()
+        self.epoll.unregister(fd)
+        del self.controllers[fd]
+
+    def has_running(self):
+        return bool(self.controllers)
+
+    def poll(self):
+        """ Waits until some of the running controllers have an event,
+            returns the list of such controllers """
+        while self.check:
+            c = self.check.pop()
+            if c.running and c.socket.has_buffered_data():
+                self.check.append(c)
+                return [c]
+        controllers = [self.controllers[fd]
+                       for fd, events in self.epoll.poll()]
+        self.check.extend(controllers)
+        return controllers
+
+    def close(self):
+        self.epoll.close()
 
 
 def poll_controllers(controllers):
     for c in controllers:
-        if c.socket.recv_buffer:
+        if c.socket.has_buffered_data():
             return [c]
     rlist, wlist, xlist = select.select(controllers, (), ())
     return rlist
@@ -703,9 +1287,7 @@ def make_interconnection(controllers):
     for i, c in enumerate(controllers):
         s = []
         for j, d in enumerate(controllers[:i]):
-            port = c.interconn_listen()
-            host = "127.0.0.1:{0}".format(port)
-            d.interconn_connect(host)
+            d.interconn_connect(c.interconn_listen_unix())
             s.append(c.interconn_listen_finish())
             sockets[j].append(d.interconn_connect_finish())
         s.append(None)
@@ -714,9 +1296,8 @@ def make_interconnection(controllers):
 
 
 def make_interconnection_pairs(controllers1, controllers2):
-    ports = [c.interconn_listen() for c in controllers1]
-    for port, c in zip(ports, controllers2):
-        host = "127.0.0.1:{0}".format(port)
-        c.interconn_connect(host)
+    paths = [c.interconn_listen_unix() for c in controllers1]
+    for path, c in zip(paths, controllers2):
+        c.interconn_connect(path)
     return ([c.interconn_listen_finish() for c in controllers1],
             [c.interconn_connect_finish() for c in controllers2])
@@ -18,49 +18,128 @@
 #
 
 import socket
+import struct
+
+
+# Binary protocol: a command is a frame (its size and then fields),
+# a numeric answer is '#' followed by a packed number
+FRAME_SIZE = struct.Struct("=I")
+NUMBER = struct.Struct("=q")
+NUMBER_ANSWER_SIZE = NUMBER.size + 1
 
 
 class SocketWrapper:
 
-    def __init__(self, socket):
+    # Initial size of the receive buffer, it grows for long lines
+    BUFFER_SIZE = 256 * 1024
+    MAX_LINE_LENGTH = 409600
+
+    def __init__(self, socket, binary=False):
         self.socket = socket
-        self.recv_buffer = ""
+        self.binary = binary
+        # Received data are kept in buffer[start:end]
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def encode_command(self, args):
+        if not self.binary:
+            return " ".join(map(str, args)) + "\n"
+        fields = []
+        for arg in args:
+            if isinstance(arg, str):
+                fields.append("S" + arg + "\0")
+            else:
+                fields.append("W" + NUMBER.pack(arg))
+        data = "".join(fields)
+        return FRAME_SIZE.pack(len(data)) + data
+
+    def has_buffered_data(self):
+        return self.start < self.end
 
     def is_line_buffered(self):
-        return "\n" in self.recv_buffer
+        return self.buffer.find("\n", self.start, self.end) != -1
+
+    def receive(self):
+        """ Receives data from the socket at the end of buffer """
+        size = self.end - self.start
+        if size == 0:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            if size == len(self.buffer):
+                # The buffer is full, a bigger one is needed;
+                # bytearray cannot be resized while the view exists
+                buffer = bytearray(2 * len(self.buffer))
+                buffer[:size] = self.buffer
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                self.buffer[:size] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = size
+        received = self.socket.recv_into(self.view[self.end:])
+        if not received:
+            raise Exception("Connection closed")
+        self.end += received
+
+    def unread(self, data):
+        """ Puts data in front of received data """
+        data = data + self.view[self.start:self.end].tobytes()
+        if len(data) > len(self.buffer):
+            self.buffer = bytearray(len(data))
+            self.view = memoryview(self.buffer)
+        self.buffer[:len(data)] = data
+        self.start = 0
+        self.end = len(data)
 
     def read_line(self):
-        b = self.recv_buffer
         while True:
-            p = b.find("\n")
+            p = self.buffer.find("\n", self.start, self.end)
             if p != -1:
-                self.recv_buffer = b[p + 1:]
-                return b[:p]
-            new = self.socket.recv(4096)
-            if not new:
-                raise Exception("Connection closed")
-            b += new
-            if len(b) > 409600:
+                line = self.view[self.start:p].tobytes()
+                self.start = p + 1
+                return line
+            if self.end - self.start > self.MAX_LINE_LENGTH:
                 raise Exception("Line too long")
+            self.receive()
+
+    def read_number(self):
+        """ Reads a numeric answer of the binary protocol,
+            returns None when a line is received instead """
+        while self.end - self.start < NUMBER_ANSWER_SIZE:
+            if self.start < self.end and self.buffer[self.start] != ord("#"):
+                return None
+            self.receive()
+        if self.buffer[self.start] != ord("#"):
+            return None
+        value = NUMBER.unpack_from(self.buffer, self.start + 1)[0]
+        self.start += NUMBER_ANSWER_SIZE
+        return value
 
     def read_data(self, size):
-        b = self.recv_buffer
-        if b:
-            if len(b) >= size:
-                self.recv_buffer = b[size:]
-                return b[:size]
-            data = [b]
-            size -= len(b)
-            self.recv_buffer = ""
-        else:
-            data = []
-        while size > 0:
-            new = self.socket.recv(size)
-            if not new:
+        if self.end - self.start >= size:
+            data = self.view[self.start:self.start + size].tobytes()
+            self.start += size
+            return data
+        data = bytearray(size)
+        self.read_data_into(data)
+        return str(data)
+
+    def read_data_into(self, target):
+        """ Reads len(target) bytes into a writable buffer
+            (e.g. bytearray, memoryview) """
+        target = memoryview(target)
+        size = len(target)
+        position = min(size, self.end - self.start)
+        target[:position] = self.view[self.start:self.start + position]
+        self.start += position
+        # Rest of data is received directly into the target
+        while position < size:
+            received = self.socket.recv_into(target[position:])
+            if not received:
                 raise Exception("Connection closed")
-            data.append(new)
-            size -= len(new)
-        return "".join(data)
+            position += received
 
     def send_data(self, data):
         self.socket.sendall(data)
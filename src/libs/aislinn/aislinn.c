@@ -3,6 +3,7 @@
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
+#include <unistd.h>
 
 void aislinn_call_0(const char *name) {
 	aislinn_call(name, NULL, 0);
@@ -47,6 +48,9 @@ static __attribute__((noinline)) void aislinn_function_call(Vg_AislinnCallAnswer
 				(void*)answer->args[4], (void*)answer->args[5]);
 			return;
 		}
+		case VG_AISLINN_FN_FORK:
+			answer->args[0] = fork();
+			return;
 		default:
 			fprintf(stderr, "Invalid function type\n");
 			exit(1);
@@ -22,6 +22,7 @@ typedef
 		VG_AISLINN_FN_4_POINTER,
 		VG_AISLINN_FN_2_INT_2_POINTER,
 		VG_AISLINN_FN_2_INT_4_POINTER,
+		VG_AISLINN_FN_FORK, // Process is forked, 'function' is not called
 	} Vg_AislinnFnType;
 
 typedef void (Vg_AislinnFnInt) (int);
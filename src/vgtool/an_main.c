@@ -227,8 +227,46 @@ static struct {
 static char message_buffer[MAX_MESSAGE_BUFFER_LENGTH];
 static Int message_buffer_size = 0;
 
+/* Binary protocol: a command is sent as a frame; UInt size of the frame
+   followed by fields, 'S' + zero terminated string or 'W' + UWord.
+   Numeric answers are sent as '#' + Long. */
+static Bool binary_protocol = False;
+static char *frame_position; // Next field in the current frame
+static char *frame_end;
+
 static Int server_port = -1;
+static Int control_fd = -1; // Inherited end of a socketpair
+
+/* Memory shared with the controller for bulk data,
+   commands carry only offsets and sizes */
+static Int shm_fd = -1;
+static SizeT shm_size = 0;
+static char *shm_base = NULL;
+/* Memory shared with all AVTs of a worker, data of a buffer that is
+   created in more processes are written into it only once */
+static Int segment_fd = -1;
+static SizeT segment_size = 0;
+static char *segment_base = NULL;
 static Int identification = 0; // For debugging purpose when verbose > 0
+static char clone_path[128]; // Socket of a controller for a process clone
+
+/* Answers of calls 'name(args..., int *result)' that are written
+   directly by the tool ("LOCAL_ANSWER" command); such calls are
+   reported to the controller together with the next event */
+#define MAX_LOCAL_ANSWERS 64
+#define MAX_LOCAL_ANSWER_ARGS 2
+#define LOCAL_CALLS_BUFFER_SIZE 16384
+typedef struct {
+   char name[32];
+   UWord args_count;
+   UWord args[MAX_LOCAL_ANSWER_ARGS];
+   Int value;
+} LocalAnswer;
+static LocalAnswer local_answers[MAX_LOCAL_ANSWERS];
+static Int local_answers_count = 0;
+static char local_calls[LOCAL_CALLS_BUFFER_SIZE]; // "LOCAL name,args ..."
+static SizeT local_calls_size = 0;
+static Int running_functions = 0; // Functions started by RUN_FUNCTION
 
 static VA *uniform_va[4];
 
@@ -247,6 +285,7 @@ static struct {
 static struct {
    Word pages; // Number of currently allocated pages
    Word vas; // Number of VAs
+   Word data_pages; // Number of pages with saved content
    Word buffers_size; // Sum of buffer sizes
 } stats;
 
@@ -260,6 +299,7 @@ typedef
    } CommandsEnterType;
 
 static void write_message(const char *str);
+static void write_event(const char *str);
 static void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer);
 static void* client_malloc (ThreadId tid, SizeT n);
 static void client_free (ThreadId tid, void *a);
@@ -289,7 +329,7 @@ static NOINLINE void report_error(const char *code)
 {
    char message[MAX_MESSAGE_BUFFER_LENGTH];
    VG_(snprintf)(message, MAX_MESSAGE_BUFFER_LENGTH, "REPORT %s\n", code);
-   write_message(message);
+   write_event(message);
    process_commands(CET_REPORT, NULL);
    tl_assert(0); // no return from process_commands
 }
@@ -769,6 +809,7 @@ static void page_dispose(Page *page)
       stats.pages--;
       if (page->data) {
          VG_(free)(page->data);
+         stats.data_pages--;
       }
       va_dispose(page->va);
       VG_(free)(page);
@@ -1266,6 +1307,7 @@ static void memimage_save_page_content(Page *page)
 
    if (page->data == NULL) {
       page->data = VG_(malloc)("an.page.data", PAGE_SIZE);
+      stats.data_pages++;
    }
 
    UChar *src = (UChar*) page->base;
@@ -1562,6 +1604,8 @@ static void state_restore(State *state)
 
    /* Restore memory image */
    memimage_restore(&state->memimage);
+
+   running_functions = 0;
 }
 
 static void prepare_for_write(Addr addr, SizeT size)
@@ -1703,6 +1747,55 @@ static Int connect_to_server(const HChar *server_addr)
    return s;
 }
 
+/* Creates a listening AF_UNIX socket on path or
+   connects to it; returns -1 on failure */
+static Int unix_socket(const char *path, Bool listen)
+{
+   struct vki_sockaddr_un addr;
+   SysRes res;
+   if (VG_(strlen)(path) >= sizeof(addr.sun_path)) {
+      return -1;
+   }
+   Int fd = VG_(socket)(VKI_AF_UNIX, VKI_SOCK_STREAM, 0);
+   if (fd < 0) {
+      return -1;
+   }
+   VG_(memset)(&addr, 0, sizeof(addr));
+   addr.sun_family = VKI_AF_UNIX;
+   VG_(strcpy)(addr.sun_path, path);
+   if (listen) {
+      res = VG_(do_syscall3)(__NR_bind, fd, (UWord) &addr, sizeof(addr));
+      if (!sr_isError(res)) {
+         res = VG_(do_syscall2)(__NR_listen, fd, 1);
+      }
+   } else {
+      res = VG_(do_syscall3)(__NR_connect, fd, (UWord) &addr, sizeof(addr));
+   }
+   if (sr_isError(res)) {
+      VG_(close)(fd);
+      return -1;
+   }
+   return fd;
+}
+
+static INLINE char* shm_get(UWord offset, SizeT size)
+{
+   if (UNLIKELY(shm_base == NULL || offset + size > shm_size)) {
+      write_message("Error: Invalid shared memory range\n");
+      VG_(exit)(1);
+   }
+   return shm_base + offset;
+}
+
+static INLINE char* segment_get(UWord offset, SizeT size)
+{
+   if (UNLIKELY(segment_base == NULL || offset + size > segment_size)) {
+      write_message("Error: Invalid shared segment range\n");
+      VG_(exit)(1);
+   }
+   return segment_base + offset;
+}
+
 static
 void read_data(SizeT size, Addr out)
 {
@@ -1713,7 +1806,7 @@ void read_data(SizeT size, Addr out)
         } else {
             s = message_buffer_size;
         }
-        VG_(memcpy)((void*)out, message_buffer, message_buffer_size);
+        VG_(memcpy)((void*)out, message_buffer, s);
         message_buffer_size -= s;
         size -= s;
         out += s;
@@ -1776,6 +1869,48 @@ Bool read_command(char *command)
     return True;
 }
 
+/* Reads at least 'size' bytes into message_buffer */
+static Bool fill_message_buffer(Int size)
+{
+   tl_assert(size <= MAX_MESSAGE_BUFFER_LENGTH);
+   while (message_buffer_size < size) {
+      Int len = VG_(read_socket)(control_socket,
+                                 message_buffer + message_buffer_size,
+                                 MAX_MESSAGE_BUFFER_LENGTH
+                                    - message_buffer_size);
+      if (UNLIKELY(len <= 0)) {
+         return False; // Connection closed
+      }
+      message_buffer_size += len;
+   }
+   return True;
+}
+
+static
+Bool read_frame(char *command)
+{
+   UInt size;
+   if (!fill_message_buffer(sizeof(UInt))) {
+      return False;
+   }
+   VG_(memcpy)(&size, message_buffer, sizeof(UInt));
+   tl_assert(size + sizeof(UInt) <= MAX_MESSAGE_BUFFER_LENGTH); // Frame too long
+   if (!fill_message_buffer(size + sizeof(UInt))) {
+      return False;
+   }
+   VG_(memcpy)(command, message_buffer + sizeof(UInt), size);
+   command[size] = 0;
+   message_buffer_size -= size + sizeof(UInt);
+   if (message_buffer_size > 0) {
+      VG_(memmove)(message_buffer,
+                   message_buffer + size + sizeof(UInt),
+                   message_buffer_size);
+   }
+   frame_position = command;
+   frame_end = command + size;
+   return True;
+}
+
 static void put_profile_info(HChar **buffer, SizeT *size)
 {
     SizeT s = VG_(snprintf)(*buffer,
@@ -1792,12 +1927,9 @@ static void put_profile_info(HChar **buffer, SizeT *size)
 }
 
 
-static void write_message(const char *str)
+static void write_bytes(const char *data, Int len)
 {
-   VPRINT(1, "AN%d>> %s", identification, str);
-
-   Int len = VG_(strlen)(str);
-   Int r = VG_(write_socket)(control_socket, str, len);
+   Int r = VG_(write_socket)(control_socket, data, len);
    if (r == -1) {
       VG_(printf)("Connection closed (server)\n");
       VG_(exit)(1);
@@ -1805,6 +1937,39 @@ static void write_message(const char *str)
    tl_assert(r == len);
 }
 
+static void write_message(const char *str)
+{
+   VPRINT(1, "AN%d>> %s", identification, str);
+   write_bytes(str, VG_(strlen)(str));
+}
+
+// Writes a message of an event, calls answered locally are sent before it
+static void write_event(const char *str)
+{
+   if (local_calls_size) {
+      local_calls[local_calls_size] = '\n';
+      local_calls[local_calls_size + 1] = '\0';
+      local_calls_size = 0;
+      write_message(local_calls);
+   }
+   write_message(str);
+}
+
+// Writes a numeric answer
+static void write_number(Long value)
+{
+   char tmp[32];
+   if (binary_protocol) {
+      VPRINT(1, "AN%d>> [[ NUMBER %lld ]]\n", identification, value);
+      tmp[0] = '#';
+      VG_(memcpy)(tmp + 1, &value, sizeof(Long));
+      write_bytes(tmp, sizeof(Long) + 1);
+   } else {
+      VG_(snprintf)(tmp, sizeof(tmp), "%lld\n", value);
+      write_message(tmp);
+   }
+}
+
 // Same as write_message but with DATA message
 static void write_data(void *ptr, SizeT size)
 {
@@ -1895,6 +2060,15 @@ static void hash_to_string(MD5_Digest *digest, char *out)
 }
 
 static char* next_token(void) {
+   if (binary_protocol) {
+      if (frame_position >= frame_end || *frame_position != 'S') {
+         VG_(printf)("Error: Invalid command\n");
+         VG_(exit)(1);
+      }
+      char *str = frame_position + 1;
+      frame_position = str + VG_(strlen)(str) + 1;
+      return str;
+   }
    char *str = VG_(strtok)(NULL, " ");
    if (str == NULL) {
       VG_(printf)("Error: Invalid command\n");
@@ -1903,7 +2077,28 @@ static char* next_token(void) {
    return str;
 }
 
+/* Numbers may be also sent as strings in frames,
+   then they are parsed as in the text protocol */
+static Bool next_is_frame_word(void) {
+   return binary_protocol
+      && frame_position < frame_end && *frame_position == 'W';
+}
+
+static UWord next_frame_word(void) {
+   UWord value;
+   if (frame_position + 1 + sizeof(UWord) > frame_end) {
+      write_message("Error: Invalid argument\n");
+      VG_(exit)(1);
+   }
+   VG_(memcpy)(&value, frame_position + 1, sizeof(UWord));
+   frame_position += 1 + sizeof(UWord);
+   return value;
+}
+
 static UWord next_token_uword(void) {
+   if (next_is_frame_word()) {
+      return next_frame_word();
+   }
    char *str = next_token();
    char *end;
    UWord value = VG_(strtoull10)(str, &end);
@@ -1915,6 +2110,9 @@ static UWord next_token_uword(void) {
 }
 
 static int next_token_int(void) {
+   if (next_is_frame_word()) {
+      return (int) next_frame_word();
+   }
    char *str = next_token();
    char *end;
    UWord value = VG_(strtoll10)(str, &end);
@@ -2101,21 +2299,42 @@ static Bool set_capture_syscalls_by_name(const char *name, Bool value)
     return True;
 }
 
+/* Transport of states works over sockets (interconnection of AVTs) or
+   over regular files (states spilled to disk), files cannot be used
+   with socket calls */
+static Int transport_write(Int fd, Bool file, const void *buffer, Int size)
+{
+   if (file) {
+      return VG_(write)(fd, buffer, size);
+   }
+   return VG_(write_socket)(fd, buffer, size);
+}
+
+static Int transport_read(Int fd, Bool file, void *buffer, Int size)
+{
+   if (file) {
+      return VG_(read)(fd, buffer, size);
+   }
+   return VG_(read_socket)(fd, buffer, size);
+}
+
 typedef
    struct {
       Int size; // Since Valgrind socket API uses Int, we are using Int, not SizeT
       HChar *buffer;
       Int buffer_size;
       Int socket;
+      Bool file;
    } SocketWriteBuffer;
 
 static void swb_init(
-      SocketWriteBuffer *swb, HChar *buffer, Int buffer_size, Int socket)
+      SocketWriteBuffer *swb, HChar *buffer, Int buffer_size, Int socket, Bool file)
 {
    swb->size = 0;
    swb->buffer = buffer;
    swb->buffer_size = buffer_size;
    swb->socket = socket;
+   swb->file = file;
 }
 
 static void* swb_write(SocketWriteBuffer *swb, Int size)
@@ -2126,7 +2345,8 @@ static void* swb_write(SocketWriteBuffer *swb, Int size)
       HChar *send_buffer = swb->buffer;
       tl_assert(send_size > 0);
       do {
-          Int written = VG_(write_socket)(swb->socket, send_buffer, send_size);
+          Int written = transport_write(
+               swb->socket, swb->file, send_buffer, send_size);
           tl_assert(written > 0);
           send_size -= written;
           send_buffer += written;
@@ -2141,7 +2361,8 @@ static void* swb_write(SocketWriteBuffer *swb, Int size)
 
 static void swb_end(SocketWriteBuffer *swb)
 {
-   Int written = VG_(write_socket)(swb->socket, swb->buffer, swb->size);
+   Int written = transport_write(
+         swb->socket, swb->file, swb->buffer, swb->size);
    tl_assert(written == swb->size);
 }
 
@@ -2152,16 +2373,18 @@ typedef
       HChar *buffer;
       Int buffer_size;
       Int socket;
+      Bool file;
    } SocketReadBuffer;
 
 static void srb_init(
-      SocketReadBuffer *srb, void *buffer, SizeT buffer_size, Int socket)
+      SocketReadBuffer *srb, void *buffer, SizeT buffer_size, Int socket, Bool file)
 {
    srb->ptr = (HChar*) buffer;
    srb->buffer = (HChar*) buffer;
    srb->buffer_size = buffer_size;
    srb->socket = socket;
-   srb->size = VG_(read_socket)(socket, buffer, buffer_size);
+   srb->file = file;
+   srb->size = transport_read(socket, file, buffer, buffer_size);
    tl_assert(srb->size > 0);
 }
 
@@ -2173,7 +2396,9 @@ static void* srb_read(SocketReadBuffer *srb, Int size)
       VG_(memmove)(srb->buffer, srb->ptr, remaining);
       srb->size = remaining;
       do {
-         Int read = VG_(read_socket)(srb->socket, &srb->buffer[srb->size], srb->buffer_size - srb->size);
+         Int read = transport_read(srb->socket, srb->file,
+                                   &srb->buffer[srb->size],
+                                   srb->buffer_size - srb->size);
          tl_assert(read > 0);
          srb->size += read;
       } while(srb->size < size);
@@ -2261,12 +2486,12 @@ static void push_page(SocketWriteBuffer *swb, Page *page)
    }
 }
 
-static void push_state(Int socket, State *state)
+static void push_state(Int socket, Bool file, State *state)
 {
    SocketWriteBuffer swb;
    Int buffer_size = 160 * 1024;
    void *buffer = VG_(malloc)("an.srb", buffer_size);
-   swb_init(&swb, buffer, buffer_size, socket);
+   swb_init(&swb, buffer, buffer_size, socket, file);
 
    Word blocks_count;
    void *blocks_ptr;
@@ -2310,6 +2535,7 @@ static Page *pull_page(SocketReadBuffer *srb)
     Int flags[REAL_PAGES_IN_PAGE];
 
     page->data = VG_(malloc)("an.page.data", PAGE_SIZE);
+    stats.data_pages++;
 
     Bool defined = True;
     Bool rdonly = True;
@@ -2412,7 +2638,7 @@ static Page *pull_page(SocketReadBuffer *srb)
     return page;
 }
 
-static State* pull_state(Int socket, UWord state_id)
+static State* pull_state(Int socket, Bool file, UWord state_id)
 {
    State *state = VG_(malloc)("an.state", sizeof(State));
    VG_(memset)(state, 0, sizeof(State));
@@ -2420,7 +2646,7 @@ static State* pull_state(Int socket, UWord state_id)
    SocketReadBuffer srb;
    const Int buffer_size = 160 * 1024;
    void *buffer = VG_(malloc)("an.srb", buffer_size);
-   srb_init(&srb, buffer, buffer_size, socket);
+   srb_init(&srb, buffer, buffer_size, socket, file);
 
    TransportStateHeader *header = (TransportStateHeader*)
       srb_read(&srb, sizeof(TransportStateHeader));
@@ -2454,6 +2680,17 @@ static State* pull_state(Int socket, UWord state_id)
    return state;
 }
 
+static void free_state_by_id(UWord state_id)
+{
+   State *state = (State*) VG_(HT_lookup(state_table, state_id));
+   if (state == NULL) {
+      write_message("Error: State not found\n");
+      VG_(exit)(1);
+   }
+   VG_(HT_remove)(state_table, state_id);
+   state_free(state);
+}
+
 static
 void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
 {
@@ -2465,18 +2702,26 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
    }
 
    for (;;) {
-      if (!read_command(command)) {
-         VG_(exit)(1);
+      char *cmd;
+      if (binary_protocol) {
+         if (!read_frame(command)) {
+            VG_(exit)(1);
+         }
+         cmd = next_token();
+         VPRINT(1, "AN%d<< [[ FRAME %s ]]\n", identification, cmd);
+      } else {
+         if (!read_command(command)) {
+            VG_(exit)(1);
+         }
+         VPRINT(1, "AN%d<< %s\n", identification, command);
+         cmd = VG_(strtok(command, " "));
       }
-      VPRINT(1, "AN%d<< %s\n", identification, command);
-      char *cmd = VG_(strtok(command, " "));
 
       if (!VG_(strcmp(cmd, "SAVE"))) {
          tl_assert(cet != CET_SYSCALL);
          State *state = state_save_current();
          VG_(HT_add_node(state_table, state));
-         VG_(snprintf(command, MAX_MESSAGE_BUFFER_LENGTH, "%lu\n", state->id));
-         write_message(command);
+         write_number(state->id);
          continue;
       }
 
@@ -2532,6 +2777,12 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
              SizeT size = next_token_uword();
              extern_write(addr, size, check);
              read_data(size, addr);
+         } else if (!VG_(strcmp)(param, "shm")) {
+             UWord offset = next_token_uword();
+             SizeT size = next_token_uword();
+             char *source = shm_get(offset, size);
+             extern_write(addr, size, check);
+             VG_(memcpy)((void*) addr, source, size);
          } else if (!VG_(strcmp)(param, "string")) {
              char *s = next_token();
              extern_write(addr, VG_(strlen)(s) + 1, check);
@@ -2550,10 +2801,14 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
          void *addr = (void*) next_token_uword();
          char *param = next_token();
          if (!VG_(strcmp)(param, "int")) {
-            VG_(snprintf)(command, MAX_MESSAGE_BUFFER_LENGTH,
-                         "%d\n", *((Int*) addr));
+            write_number(*((Int*) addr));
+            continue;
          } else if(!VG_(strcmp)(param, "ints")) {
              UWord count = next_token_uword();
+             if (binary_protocol) {
+                write_data(addr, count * sizeof(Int));
+                continue;
+             }
              UWord written = 0;
              UWord i;
              Int *iaddr = addr;
@@ -2568,10 +2823,14 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
                                       "\n");
              tl_assert(written < MAX_MESSAGE_BUFFER_LENGTH);
          } else if (!VG_(strcmp)(param, "pointer")) {
-                VG_(snprintf)(command, MAX_MESSAGE_BUFFER_LENGTH,
-                             "%lu\n", *((Addr*) addr));
+                write_number(*((Addr*) addr));
+                continue;
          } else if(!VG_(strcmp)(param, "pointers")) {
                 UWord count = next_token_uword();
+                if (binary_protocol) {
+                   write_data(addr, count * sizeof(Addr));
+                   continue;
+                }
                 UWord written = 0;
                 UWord i;
                 Addr *iaddr = addr;
@@ -2592,6 +2851,12 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
          } else if(!VG_(strcmp)(param, "string")) {
                 write_data(addr, VG_(strlen)(addr));
                 continue; // we want to skip "write_message" at the end of switch
+         } else if(!VG_(strcmp)(param, "shm")) {
+                UWord offset = next_token_uword();
+                SizeT size = next_token_uword();
+                VG_(memcpy)(shm_get(offset, size), addr, size);
+                write_message("Ok\n");
+                continue;
          } else {
                 tl_assert(0);
          }
@@ -2638,6 +2903,7 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
             tst->status = VgTs_Init;
          }
 
+         running_functions++;
          current_memspace->answer->function = (void*) next_token_uword();
          current_memspace->answer->function_type = next_token_uword();
          UWord count = next_token_uword();
@@ -2649,6 +2915,20 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
          return;
       }
 
+      if (!VG_(strcmp(cmd, "CLONE"))) {
+         // The process is forked by the client, see clone_finish
+         char *path = next_token();
+         if (current_memspace->answer == NULL
+             || VG_(strlen)(path) >= sizeof(clone_path)) {
+            write_message("Error: Process cannot be cloned\n");
+            continue;
+         }
+         VG_(strcpy)(clone_path, path);
+         current_memspace->answer->function = (void*) 1; // Not called
+         current_memspace->answer->function_type = VG_AISLINN_FN_FORK;
+         return;
+      }
+
       if (!VG_(strcmp(cmd, "READ_BUFFER"))) {
             UWord id = next_token_uword();
             Buffer *buffer = buffer_lookup(id);
@@ -2656,6 +2936,28 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
             continue; // we want to skip "write_message" at the end of switch
       }
 
+      if (!VG_(strcmp(cmd, "READ_BUFFER_SHM"))) {
+            UWord id = next_token_uword();
+            UWord offset = next_token_uword();
+            Buffer *buffer = buffer_lookup(id);
+            VG_(memcpy)(shm_get(offset, buffer->size),
+                        (void*)buffer_data(buffer), buffer->size);
+            write_message("Ok\n");
+            continue;
+      }
+
+      if (!VG_(strcmp(cmd, "WRITE_BUFFER_SHM"))) {
+         UWord buffer_id = (UWord) next_token_uword();
+         UWord index = (UWord) next_token_uword();
+         UWord offset = (UWord) next_token_uword();
+         UWord size = (UWord) next_token_uword();
+         Buffer *buffer = buffer_lookup(buffer_id);
+         VG_(memcpy)((void*) (buffer_data(buffer) + index),
+                     shm_get(offset, size), size);
+         write_message("Ok\n");
+         continue;
+      }
+
       if (!VG_(strcmp(cmd, "WRITE_BUFFER"))) {
          UWord buffer_id = (UWord) next_token_uword();
          UWord index = (UWord) next_token_uword();
@@ -2685,6 +2987,43 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
          continue;
       }
 
+      if (!VG_(strcmp(cmd, "NEW_BUFFER_SEGMENT"))) {
+         UWord id = next_token_uword();
+         UWord offset = next_token_uword();
+         UWord size = next_token_uword();
+         Buffer *buffer = buffer_new(id, size);
+         VG_(memcpy)((void*) buffer_data(buffer),
+                     segment_get(offset, size), size);
+         write_message("Ok\n");
+         continue;
+      }
+
+      if (!VG_(strcmp(cmd, "PACK_SEGMENT"))) {
+         // PACK_SEGMENT offset count addr size ...
+         // Regions of client memory are copied one after another
+         // into the shared segment, answer is the hash of packed data
+         UWord offset = next_token_uword();
+         UWord i, count = next_token_uword();
+         MD5_Digest digest;
+         char digest_str[33]; // 16 * 2 + 1
+         AN_(MD5_CTX) ctx;
+         AN_(MD5_Init)(&ctx);
+         for (i = 0; i < count; i++) {
+            Addr addr = (Addr) next_token_uword();
+            UWord size = next_token_uword();
+            char *target = segment_get(offset, size);
+            VG_(memcpy)(target, (void*) addr, size);
+            AN_(MD5_Update)(&ctx, target, size);
+            offset += size;
+         }
+         AN_(MD5_Final)(&digest, &ctx);
+         hash_to_string(&digest, digest_str);
+         VG_(snprintf)(command, MAX_MESSAGE_BUFFER_LENGTH,
+                      "%s\n", digest_str);
+         write_message(command);
+         continue;
+      }
+
       if (!VG_(strcmp(cmd, "HASH_BUFFER"))) {
          UWord buffer_id = (UWord) next_token_uword();
          Buffer *buffer = buffer_lookup(buffer_id);
@@ -2709,6 +3048,14 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
          continue;
       }
 
+      if (!VG_(strcmp(cmd, "FREE_BUFFERS"))) { // FREE_BUFFERS count id ...
+         UWord i, count = next_token_uword();
+         for (i = 0; i < count; i++) {
+            buffer_free(buffer_lookup(next_token_uword()));
+         }
+         continue;
+      }
+
       if (!VG_(strcmp(cmd, "HASH"))) {
          tl_assert(cet != CET_SYSCALL);
          MD5_Digest digest;
@@ -2730,16 +3077,16 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
       }
 
       if (!VG_(strcmp)(cmd, "FREE")) {
-         UWord state_id = next_token_uword();
+         free_state_by_id(next_token_uword());
+         //write_message("Ok\n");
+         continue;
+      }
 
-         State *state = (State*) VG_(HT_lookup(state_table, state_id));
-         if (state == NULL) {
-            write_message("Error: State not found\n");
-            VG_(exit)(1);
+      if (!VG_(strcmp)(cmd, "FREE_STATES")) { // FREE_STATES count id ...
+         UWord i, count = next_token_uword();
+         for (i = 0; i < count; i++) {
+            free_state_by_id(next_token_uword());
          }
-         VG_(HT_remove)(state_table, state_id);
-         state_free(state);
-         //write_message("Ok\n");
          continue;
       }
 
@@ -2791,11 +3138,15 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
                         "pages %ld|"
                         "vas %ld|"
                         "active-pages %ld|"
-                        "buffers-size %lu\n",
+                        "buffers-size %lu|"
+                        "state-memory %lu\n",
                         stats.pages,
                         stats.vas,
                         VG_(OSetGen_Size)(current_memspace->auxmap),
-                        stats.buffers_size);
+                        stats.buffers_size,
+                        stats.pages * sizeof(Page) +
+                        stats.data_pages * PAGE_SIZE +
+                        stats.vas * sizeof(VA));
           write_message(command);
           continue;
       }
@@ -2808,9 +3159,7 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
       if (!VG_(strcmp(cmd, "CLIENT_MALLOC"))) {
          UWord size = next_token_uword();
          void* buffer = client_malloc(0, size);
-         VG_(snprintf(command, MAX_MESSAGE_BUFFER_LENGTH,
-                      "%lu\n", (UWord) buffer));
-         write_message(command);
+         write_number((UWord) buffer);
          continue;
       }
 
@@ -2821,9 +3170,7 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
          void *mem = client_malloc(0, size);
          extern_write((Addr)mem, size, False);
          VG_(memcpy(mem, buffer + 1, size));
-         VG_(snprintf(command, MAX_MESSAGE_BUFFER_LENGTH,
-                      "%lu\n", (UWord) mem));
-         write_message(command);
+         write_number((UWord) mem);
          continue;
       }
 
@@ -2839,17 +3186,50 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
         UWord state_id = next_token_uword();
         State *state = (State*) VG_(HT_lookup(state_table, state_id));
         tl_assert(state);
-        push_state(socket, state);
+        push_state(socket, False, state);
         continue;
       }
 
       if (!VG_(strcmp(cmd, "CONN_PULL_STATE"))) {
         Int socket = next_token_int();
         UWord state_id = make_new_id();
-        State *state = pull_state(socket, state_id);
+        State *state = pull_state(socket, False, state_id);
         VG_(HT_add_node(state_table, state));
-        VG_(snprintf(command, MAX_MESSAGE_BUFFER_LENGTH, "%lu\n", state->id));
-        write_message(command);
+        write_number(state->id);
+        continue;
+      }
+
+      if (!VG_(strcmp(cmd, "SPILL_STATE"))) {
+        UWord state_id = next_token_uword();
+        char *filename = next_token();
+        State *state = (State*) VG_(HT_lookup(state_table, state_id));
+        tl_assert(state);
+        SysRes sr = VG_(open)(filename,
+                              VKI_O_WRONLY | VKI_O_CREAT | VKI_O_TRUNC,
+                              VKI_S_IRUSR | VKI_S_IWUSR);
+        if (sr_isError(sr)) {
+           write_message("Error: Cannot open file\n");
+           continue;
+        }
+        Int fd = sr_Res(sr);
+        push_state(fd, True, state);
+        VG_(close)(fd);
+        write_message("Ok\n");
+        continue;
+      }
+
+      if (!VG_(strcmp(cmd, "LOAD_STATE"))) {
+        char *filename = next_token();
+        SysRes sr = VG_(open)(filename, VKI_O_RDONLY, 0);
+        if (sr_isError(sr)) {
+           write_message("Error: Cannot open file\n");
+           continue;
+        }
+        Int fd = sr_Res(sr);
+        State *state = pull_state(fd, True, make_new_id());
+        VG_(close)(fd);
+        VG_(HT_add_node(state_table, state));
+        write_number(state->id);
         continue;
       }
 
@@ -2869,9 +3249,31 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
         continue;
       }
 
+      if (!VG_(strcmp(cmd, "CONN_LISTEN_UNIX"))) {
+        char *path = next_token();
+        Int socket = unix_socket(path, True);
+        if (socket < 0) {
+           write_message("Error: Cannot listen\n");
+           VG_(exit)(1);
+        }
+        write_message("Ok\n");
+        int client_socket = VG_(accept)(socket, NULL, NULL);
+        tl_assert(client_socket >= 0);
+        VG_(close)(socket);
+        VG_(unlink)(path);
+        VG_(snprintf)(command, MAX_MESSAGE_BUFFER_LENGTH, "%d\n", client_socket);
+        write_message(command);
+        continue;
+      }
+
       if (!VG_(strcmp(cmd, "CONN_CONNECT"))) {
         char *param = next_token();
-        Int socket = VG_(connect_via_socket)(param);
+        Int socket;
+        if (param[0] == '/') { // Path of AF_UNIX socket
+           socket = unix_socket(param, False);
+        } else {
+           socket = VG_(connect_via_socket)(param);
+        }
         VG_(snprintf)(command, MAX_MESSAGE_BUFFER_LENGTH, "%d\n", socket);
         write_message(command);
         continue;
@@ -2881,6 +3283,71 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
          VG_(exit)(1);
       }
 
+      if (!VG_(strcmp(cmd, "RECONNECT"))) {
+        // Continue with a new controller connected through AF_UNIX socket
+        char *path = next_token();
+        Int socket = unix_socket(path, False);
+        if (socket < 0) {
+           write_message("Error: Cannot connect\n");
+           continue;
+        }
+        VG_(close)(control_socket);
+        control_socket = VG_(safe_fd)(socket);
+        message_buffer_size = 0;
+        write_message("Ok\n");
+        continue;
+      }
+
+      if (!VG_(strcmp(cmd, "RESET"))) {
+        // Frees all states (except the given one) and buffers,
+        // then the given state is restored
+        UWord state_id = next_token_uword();
+        State *state = (State*) VG_(HT_lookup(state_table, state_id));
+        if (state == NULL || cet == CET_SYSCALL || cet == CET_REPORT) {
+           write_message("Error: Cannot reset\n");
+           continue;
+        }
+        UInt i, count;
+        VgHashNode **nodes = VG_(HT_to_array)(state_table, &count);
+        for (i = 0; i < count; i++) {
+           if (nodes[i]->key != state_id) {
+              VG_(HT_remove)(state_table, nodes[i]->key);
+              state_free((State*) nodes[i]);
+           }
+        }
+        VG_(free)(nodes);
+        nodes = VG_(HT_to_array)(buffer_table, &count);
+        for (i = 0; i < count; i++) {
+           buffer_free((Buffer*) nodes[i]);
+        }
+        VG_(free)(nodes);
+        // Answers are set again by the next controller
+        local_answers_count = 0;
+        state_restore(state);
+        write_message("Ok\n");
+        continue;
+      }
+
+      if (!VG_(strcmp(cmd, "LOCAL_ANSWER"))) {
+         char *name = next_token();
+         UWord i, count = next_token_uword();
+         if (local_answers_count == MAX_LOCAL_ANSWERS
+             || count > MAX_LOCAL_ANSWER_ARGS
+             || VG_(strlen)(name) >= sizeof(local_answers[0].name)) {
+            write_message("Error: Invalid argument\n");
+            VG_(exit)(1);
+         }
+         LocalAnswer *la = &local_answers[local_answers_count++];
+         VG_(strcpy)(la->name, name);
+         la->args_count = count;
+         for (i = 0; i < count; i++) {
+            la->args[i] = next_token_uword();
+         }
+         la->value = next_token_int();
+         write_message("Ok\n");
+         continue;
+      }
+
       if (!VG_(strcmp(cmd, "SET"))) {
          char *param = next_token();
          if (!VG_(strcmp)(param, "syscall")) {
@@ -2910,15 +3377,77 @@ void process_commands(CommandsEnterType cet, Vg_AislinnCallAnswer *answer)
             continue;
       }
       write_message("Error: Unknown command:");
-      write_message(command);
+      write_message(cmd);
       write_message("\n");
    }
 }
 
+/* Called in both processes after the fork requested by CLONE */
+static void clone_finish(Long pid, char *message)
+{
+   if (pid == 0) {
+      // The clone continues with the new controller
+      Int socket = unix_socket(clone_path, False);
+      if (socket < 0) {
+         VG_(exit)(1);
+      }
+      VG_(close)(control_socket);
+      control_socket = VG_(safe_fd)(socket);
+      message_buffer_size = 0;
+      shm_base = NULL; // Mapping is shared with the parent
+      VG_(strcpy)(message, "Ok\n");
+   } else {
+      VG_(snprintf)(message, MAX_MESSAGE_BUFFER_LENGTH, "CLONE %lld\n", pid);
+   }
+   clone_path[0] = 0;
+}
+
 /* --------------------------------------------------------
  *  CALLBACKS
  */
 
+/* Writes an answer from local_answers and records the call,
+   returns False if the call has to be sent to the controller */
+static Bool answer_call_locally(const char *name, UWord *args, UWord count)
+{
+   if (local_answers_count == 0 || running_functions || count == 0) {
+      return False;
+   }
+   Int i;
+   UWord j;
+   for (i = 0; i < local_answers_count; i++) {
+      LocalAnswer *la = &local_answers[i];
+      if (la->args_count + 1 != count || VG_(strcmp)(la->name, name)) {
+         continue;
+      }
+      for (j = 0; j < la->args_count && la->args[j] == args[j]; j++);
+      if (j < la->args_count) {
+         continue;
+      }
+      Addr addr = (Addr) args[count - 1];
+      // Reserve space for "LOCAL", the name, args and "\n\0"
+      SizeT size = VG_(strlen)(name) + count * 21 + 8;
+      if (local_calls_size + size > LOCAL_CALLS_BUFFER_SIZE
+          || !check_is_writable(addr, sizeof(Int), NULL)) {
+         // Invalid pointer is reported by the controller
+         return False;
+      }
+      char *m = local_calls + local_calls_size;
+      if (local_calls_size == 0) {
+         m += VG_(sprintf)(m, "LOCAL");
+      }
+      m += VG_(sprintf)(m, " %s", name);
+      for (j = 0; j < count; j++) {
+         m += VG_(sprintf)(m, ",%lu", args[j]);
+      }
+      local_calls_size = m - local_calls;
+      extern_write(addr, sizeof(Int), False);
+      *((Int*) addr) = la->value;
+      return True;
+   }
+   return False;
+}
+
 static
 Bool an_handle_client_request ( ThreadId tid, UWord* arg, UWord* ret )
 {
@@ -2936,6 +3465,9 @@ Bool an_handle_client_request ( ThreadId tid, UWord* arg, UWord* ret )
    tl_assert(arg[1]);
    switch(arg[0]) {
       case VG_USERREQ__AISLINN_CALL: {
+         if (answer_call_locally((char*) arg[1], (UWord*) arg[2], arg[3])) {
+            return True;
+         }
          SizeT l = MAX_MESSAGE_BUFFER_LENGTH - 1; // reserve 1 char for \n
          UWord i;
          char *m = message;
@@ -2958,14 +3490,21 @@ Bool an_handle_client_request ( ThreadId tid, UWord* arg, UWord* ret )
        } break;
        case VG_USERREQ__AISLINN_FUNCTION_RETURN: {
           answer = (Vg_AislinnCallAnswer*) arg[1];
-          VG_(strcpy)(message, "FUNCTION_FINISH\n");
+          if (running_functions > 0) {
+             running_functions--;
+          }
+          if (UNLIKELY(clone_path[0])) {
+             clone_finish((Long) answer->args[0], message);
+          } else {
+             VG_(strcpy)(message, "FUNCTION_FINISH\n");
+          }
           cet = CET_CALL;
         } break;
       default:
          tl_assert(0);
    }
 
-   write_message(message);
+   write_event(message);
    process_commands(cet, answer);
    return True;
 }
@@ -3086,11 +3625,11 @@ static void ban_mem_stack (Addr a, SizeT len)
 
 static void an_post_clo_init(void)
 {
-   if (server_port == -1) {
+   if (server_port == -1 && control_fd == -1) {
       VG_(printf)("Server port was not specified\n");
       VG_(exit)(1);
    }
-   if (server_port < 0 || server_port > 65535) {
+   if (control_fd == -1 && (server_port < 0 || server_port > 65535)) {
       VG_(printf)("Invalid server port\n");
       VG_(exit)(1);
    }
@@ -3107,10 +3646,37 @@ static void an_post_clo_init(void)
    VG_(memset)(uniform_va[MEM_DEFINED]->vabits, MEM_DEFINED, VA_CHUNKS);
    memspace_init();
 
-   char target[300];
-   VG_(snprintf)(target, 300, "127.0.0.1:%u", server_port);
-   control_socket = connect_to_server(target);
+   if (control_fd != -1) {
+      // Moved out of the reach of the client
+      control_socket = VG_(safe_fd)(control_fd);
+   } else {
+      char target[300];
+      VG_(snprintf)(target, 300, "127.0.0.1:%u", server_port);
+      control_socket = connect_to_server(target);
+   }
    tl_assert(control_socket > 0);
+
+   if (shm_fd != -1) {
+      SysRes res = VG_(am_shared_mmap_file_float_valgrind)(
+         shm_size, VKI_PROT_READ | VKI_PROT_WRITE, shm_fd, 0);
+      if (sr_isError(res)) {
+         VG_(printf)("Cannot map shared memory\n");
+         VG_(exit)(1);
+      }
+      shm_base = (char*) sr_Res(res);
+      VG_(close)(shm_fd);
+   }
+
+   if (segment_fd != -1) {
+      SysRes res = VG_(am_shared_mmap_file_float_valgrind)(
+         segment_size, VKI_PROT_READ | VKI_PROT_WRITE, segment_fd, 0);
+      if (sr_isError(res)) {
+         VG_(printf)("Cannot map shared segment\n");
+         VG_(exit)(1);
+      }
+      segment_base = (char*) sr_Res(res);
+      VG_(close)(segment_fd);
+   }
 }
 
 static
@@ -3124,7 +3690,7 @@ Bool restore_thread(ThreadId tid)
        put_profile_info(&buffer, &l);
    }
    VG_(snprintf)(buffer, l, "EXIT %lu\n", tst->os_state.exitcode);
-   write_message(str);
+   write_event(str);
    process_commands(CET_FINISH, NULL);
    return True;
 }
@@ -3264,6 +3830,26 @@ static Bool process_cmd_line_option(const HChar* arg)
       return True;
    }
 
+   if (VG_INT_CLO(arg, "--control-fd", control_fd)) {
+      return True;
+   }
+
+   if (VG_INT_CLO(arg, "--shm-fd", shm_fd)) {
+      return True;
+   }
+
+   if (VG_INT_CLO(arg, "--shm-size", shm_size)) {
+      return True;
+   }
+
+   if (VG_INT_CLO(arg, "--segment-fd", segment_fd)) {
+      return True;
+   }
+
+   if (VG_INT_CLO(arg, "--segment-size", segment_size)) {
+      return True;
+   }
+
    if (VG_INT_CLO(arg, "--verbose", verbosity_level)) {
       return True;
    }
@@ -3288,6 +3874,10 @@ static Bool process_cmd_line_option(const HChar* arg)
       return True;
    }
 
+   if (VG_BOOL_CLO(arg, "--binary-protocol", binary_protocol)) {
+      return True;
+   }
+
    return False;
 }
 
@@ -3475,7 +4065,7 @@ Bool syscall_control(ThreadId tid, UInt syscallno,
                        name, args[0], args[1], args[2]);
          break;
     }
-    write_message(message);
+    write_event(message);
     capture_syscalls.drop_current_syscall = False;
     process_commands(CET_SYSCALL, NULL);
     if (capture_syscalls.drop_current_syscall) {
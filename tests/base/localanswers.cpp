@@ -0,0 +1,40 @@
+#include <stdlib.h>
+#include <string.h>
+#include <mpi.h>
+
+int main(int argc, char **argv)
+{
+	MPI_Init(&argc, &argv);
+
+	if (argc == 2 && !strcmp(argv[1], "invalid")) {
+		MPI_Comm_rank(MPI_COMM_WORLD, (int*) 8);
+	}
+
+	MPI_Comm comm;
+	MPI_Comm_dup(MPI_COMM_WORLD, &comm);
+
+	int rank, size, self_rank, self_size, dup_rank, type_size, flag;
+	for (int i = 0; i < 1000; i++) {
+		MPI_Comm_rank(MPI_COMM_WORLD, &rank);
+		MPI_Comm_size(MPI_COMM_WORLD, &size);
+		MPI_Comm_rank(MPI_COMM_SELF, &self_rank);
+		MPI_Comm_size(MPI_COMM_SELF, &self_size);
+		MPI_Comm_rank(comm, &dup_rank);
+		MPI_Type_size(MPI_DOUBLE, &type_size);
+		MPI_Initialized(&flag);
+	}
+
+	if (size != 3 || self_rank != 0 || self_size != 1 || dup_rank != rank
+		|| type_size != sizeof(double) || !flag) {
+		return 1;
+	}
+
+	int sum;
+	MPI_Allreduce(&rank, &sum, 1, MPI_INT, MPI_SUM, MPI_COMM_WORLD);
+	if (sum != 3) {
+		return 1;
+	}
+	MPI_Comm_free(&comm);
+	MPI_Finalize();
+	return 0;
+}
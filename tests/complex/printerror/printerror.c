@@ -0,0 +1,23 @@
+#include <mpi.h>
+#include <stdio.h>
+
+/* Other processes are still writing to stdout
+   when the error of rank 0 aborts the walk */
+
+int main(int argc, char **argv)
+{
+	int rank, size, i;
+	MPI_Init(&argc, &argv);
+	MPI_Comm_rank(MPI_COMM_WORLD, &rank);
+	MPI_Comm_size(MPI_COMM_WORLD, &size);
+	if (rank == 0) {
+		MPI_Send(&rank, 1, MPI_INT, size, 1, MPI_COMM_WORLD);
+	} else {
+		for (i = 0; i < 10000; i++) {
+			printf("%i %i\n", rank, i);
+			fflush(stdout);
+		}
+	}
+	MPI_Finalize();
+	return 0;
+}
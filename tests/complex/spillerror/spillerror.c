@@ -0,0 +1,28 @@
+#include <mpi.h>
+#include <stdlib.h>
+
+/* Messages are received from any source, so many states are queued
+   before the error at the end of the program is found */
+
+int main(int argc, char **argv)
+{
+	int rank, size, i, value;
+	MPI_Init(&argc, &argv);
+	MPI_Comm_rank(MPI_COMM_WORLD, &rank);
+	MPI_Comm_size(MPI_COMM_WORLD, &size);
+	if (rank == 0) {
+		int *data = (int*) malloc(sizeof(int));
+		for (i = 0; i < 3 * (size - 1); i++) {
+			MPI_Recv(&value, 1, MPI_INT, MPI_ANY_SOURCE, 1,
+				 MPI_COMM_WORLD, MPI_STATUS_IGNORE);
+		}
+		free(data);
+		data[0] = value;
+	} else {
+		for (i = 0; i < 3; i++) {
+			MPI_Send(&rank, 1, MPI_INT, 0, 1, MPI_COMM_WORLD);
+		}
+	}
+	MPI_Finalize();
+	return 0;
+}
@@ -0,0 +1,46 @@
+#include <mpi.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+int main(int argc, char **argv)
+{
+	MPI_Init(&argc, &argv);
+
+	if (argc != 2) {
+		fprintf(stderr, "Invalid args:\n" \
+				"%s deadlock\n", argv[0]);
+		return 1;
+	}
+
+	const int deadlock = atoi(argv[1]);
+	// Ranks 0 and 1 are masters, worker 'rank' sends to master 'rank % 2'
+	// deadlock = 1 - master answers only to the first message and
+	//                the first worker of each master waits for the answer
+
+	int rank, size;
+	MPI_Comm_rank(MPI_COMM_WORLD, &rank);
+	MPI_Comm_size(MPI_COMM_WORLD, &size);
+
+	int d;
+	if (rank < 2) {
+		int count = (size - rank - 1) / 2;
+		for (int i = 0; i < count; i++) {
+			MPI_Status status;
+			MPI_Recv(&d, 1, MPI_INT, MPI_ANY_SOURCE, 10,
+				 MPI_COMM_WORLD, &status);
+			if (deadlock && i == 0) {
+				MPI_Send(&d, 1, MPI_INT, status.MPI_SOURCE, 20,
+					 MPI_COMM_WORLD);
+			}
+		}
+	} else {
+		MPI_Send(&rank, 1, MPI_INT, rank % 2, 10, MPI_COMM_WORLD);
+		if (deadlock && rank < 4) {
+			MPI_Recv(&d, 1, MPI_INT, rank % 2, 20,
+				 MPI_COMM_WORLD, MPI_STATUS_IGNORE);
+		}
+	}
+
+	MPI_Finalize();
+	return 0;
+}
@@ -0,0 +1,34 @@
+#include <stdlib.h>
+#include <mpi.h>
+#include <stdio.h>
+
+int main(int argc, char **argv) {
+	MPI_Init(&argc, &argv);
+
+	const size_t SIZE = 100;
+
+	int rank, size;
+	MPI_Comm_rank(MPI_COMM_WORLD, &rank);
+	MPI_Comm_size(MPI_COMM_WORLD, &size);
+
+	if (size < 4) {
+		return -1;
+	}
+
+	// Ranks 0 and 1 are masters, worker 'rank' sends to master 'rank % 2'
+	if (rank < 2) {
+		int *mem = (int*) malloc(SIZE);
+		int count = (size - rank - 1) / 2;
+		for (int i = 0; i < count; i++) {
+			MPI_Recv(&mem[i], 1, MPI_INT, MPI_ANY_SOURCE, 1,
+				  MPI_COMM_WORLD, MPI_STATUS_IGNORE);
+		}
+		if (mem[0] == rank + 2) {
+			free(mem);
+		}
+	} else {
+		MPI_Send(&rank, 1, MPI_INT, rank % 2, 1, MPI_COMM_WORLD);
+	}
+	MPI_Finalize();
+	return 0;
+}
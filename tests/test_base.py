@@ -1,5 +1,5 @@
 
-from utils import TestCase
+from utils import TestCase, get_child_pids
 import unittest
 
 
@@ -58,6 +58,17 @@ class BaseTests(TestCase):
         self.program("typesize")
         self.execute(1, stdout="4 8 16 40\n")
 
+    def test_localanswers(self):
+        self.program("localanswers")
+        self.execute(3)
+        self.assertTrue(self.report.get_analysis_value("local-calls") > 0)
+        self.execute(3, worker_processes=True)
+        self.assertTrue(self.report.get_analysis_value("local-calls") > 0)
+        self.execute(3, no_local_answers=True)
+        self.assertEquals(0, self.report.get_analysis_value("local-calls"))
+        self.execute(3, event_stacktraces=True)
+        self.execute(1, "invalid", error="mem/invalid-write")
+
     def test_contiguous(self):
         output = "1.11\n2.22\n3.33\n4.44\n5.55\n" \
                  "6.66\n7.77\n8.88\n9.99\n10.101\n"
@@ -202,6 +213,32 @@ class BaseTests(TestCase):
         self.output(1, "Line1\n3\n2\n0\nEnd\n")
         self.execute(4)
 
+    def test_print_zygote(self):
+        self.program("print")
+        self.output_default("Line1\nEnd\n")
+        self.output(1, "Line1\n0\n2\nEnd\n")
+        self.output(1, "Line1\n2\n0\nEnd\n")
+        self.execute(3)
+        nodes = self.report.get_analysis_value("nodes")
+        calls = self.report.get_analysis_value("mpi_calls")
+
+        path = self.start_zygote_server(3)
+        self.execute(3, zygote=path)
+        self.assertEquals(3, self.report.get_analysis_value(
+            "zygote-controllers"))
+        self.assertEquals(nodes, self.report.get_analysis_value("nodes"))
+        self.assertEquals(calls, self.report.get_analysis_value("mpi_calls"))
+        pids = get_child_pids(self.zygote_server.pid)
+        self.assertEquals(3, len(pids))
+
+        # Processes are reset and used again
+        self.execute(3, zygote=path)
+        self.assertEquals(3, self.report.get_analysis_value(
+            "zygote-controllers"))
+        self.assertEquals(nodes, self.report.get_analysis_value("nodes"))
+        self.assertEquals(calls, self.report.get_analysis_value("mpi_calls"))
+        self.assertEquals(pids, get_child_pids(self.zygote_server.pid))
+
     def test_print_big(self):
         self.program("print_big")
         self.output(0, "abcd" * (1024 * 1024 * 10 // 4) + "\n")
@@ -30,5 +30,105 @@ class ComplexTests(TestCase):
         self.assertTrue(len(self.report.get_icounts("process2")) > 10)
         self.assertTrue(len(self.report.get_icounts("global")) == 1)
 
+    def test_worker_processes(self):
+        files = ("workers.c",)
+        self.program("workers", files=files)
+        self.execute(3, ("4", "40"), stdout="", worker_processes=True)
+        self.execute(
+            3, ("4", "40"), stdout="", send_protocol="eager", profile=True,
+            worker_processes=True)
+        self.assertTrue(len(self.report.get_icounts("process1")) > 10)
+        self.assertTrue(len(self.report.get_icounts("global")) == 1)
+
+        # Workers stop when the limit of states is reached
+        self.execute(3, ("4", "40"), stdout="", worker_processes=True,
+                     max_states=20)
+        self.assertEquals(
+            "False", self.report.get_analysis_text("full-statespace"))
+
+    def test_worker_processes_error(self):
+        # An error found by one worker stops all workers
+        files = ("spillerror.c",)
+        self.program("spillerror", files=files)
+        self.execute(3, error="mem/invalid-write", worker_processes=True)
+        self.execute(3, error="mem/invalid-write", worker_processes=True,
+                     search="bfs")
+
+    def test_clone_workers(self):
+        files = ("workers.c",)
+        self.program("workers", files=files)
+        self.execute(3, ("4", "40"), stdout="", clone_workers=True)
+        self.execute(3, ("4", "40"), stdout="", gcontexts=2,
+                     clone_workers=True)
+
+    def test_search(self):
+        files = ("workers.c",)
+        self.program("workers", files=files)
+        for search in ("dfs", "requests", "deep", "cached"):
+            self.execute(3, ("4", "40"), stdout="", search=search)
+        self.execute(3, ("4", "40"), stdout="", search="cached",
+                     worker_processes=True)
+
+    def test_search_adaptive(self):
+        files = ("workers.c",)
+        self.program("workers", files=files)
+        self.execute(3, ("4", "40"), stdout="", search="adaptive",
+                     search_watermarks="4:1")
+        self.execute(3, ("4", "40"), stdout="", search="adaptive",
+                     search_watermarks="4:1", worker_processes=True)
+        # States are released and freed during the search
+        self.execute(3, ("4", "80"), stdout="", search="adaptive",
+                     search_watermarks="2:1")
+        self.assertNotEquals(
+            "none", self.report.get_analysis_text("search-switches"))
+
+    def test_spill_queue(self):
+        files = ("workers.c",)
+        self.program("workers", files=files)
+        self.execute(3, ("4", "40"), stdout="", spill_queue=4)
+        self.execute(3, ("4", "40"), stdout="", spill_queue=4, search="dfs",
+                     worker_processes=True)
+
+    def test_spill_queue_error(self):
+        # Entries are still spilled when the error stops the search
+        files = ("spillerror.c",)
+        self.program("spillerror", files=files)
+        self.execute(3, error="mem/invalid-write", spill_queue=2)
+        self.execute(3, error="mem/invalid-write", spill_queue=2,
+                     worker_processes=True)
+        self.execute(3, error="mem/invalid-write", spill_queue=2, sample=5)
+
+    def test_sample_abort_syscall(self):
+        # Processes of aborted walks are stopped in write syscalls
+        files = ("printerror.c",)
+        self.program("printerror", files=files)
+        self.execute(3, error="mpi/invalid-arg/rank", sample=10)
+        self.assertEquals(10, self.report.get_analysis_value("walks"))
+
+    def test_state_memory(self):
+        files = ("workers.c",)
+        self.program("workers", files=files)
+        self.execute(3, ("4", "40"), stdout="", state_memory="1M")
+        self.assertTrue(
+            self.report.get_analysis_value("state-store-evictions") > 0)
+        self.assertTrue(
+            self.report.get_analysis_value("state-store-misses") > 0)
+        self.execute(3, ("4", "40"), stdout="", state_memory="1M",
+                     worker_processes=True)
+        self.assertTrue(
+            self.report.get_analysis_value("state-store-evictions") > 0)
+
+    def test_gcontexts(self):
+        files = ("workers.c",)
+        self.program("workers", files=files)
+        self.execute(3, ("4", "40"), stdout="", gcontexts=3)
+        self.execute(3, ("4", "40"), stdout="", gcontexts=2, spill_queue=4,
+                     worker_processes=True)
+
+    def test_fake_remote(self):
+        files = ("workers.c",)
+        self.program("workers", files=files)
+        self.execute(3, ("4", "40"), stdout="", fake_remote=True)
+
 if __name__ == "__main__":
     unittest.main()
@@ -27,6 +27,15 @@ class DeadlockTests(TestCase):
         self.execute(3, send_protocol="eager")
         self.execute(3, send_protocol="full", error="mpi/deadlock")
 
+    def test_waitany_sample(self):
+        self.program("waitany")
+        self.execute(3, send_protocol="eager", sample=10)
+        self.execute(3, send_protocol="full", error="mpi/deadlock",
+                     sample=20, sample_seed=1)
+        trace = self.report.errors[0].element.get("trace")
+        self.execute(3, send_protocol="full", error="mpi/deadlock",
+                     replay=trace)
+
     def test_waitany2(self):
         self.program("waitany2")
         self.execute(4, send_protocol="eager")
@@ -62,6 +71,34 @@ class DeadlockTests(TestCase):
         self.execute(6, "0 1", send_protocol="full", error="mpi/deadlock")
         self.execute(6, "1 1", send_protocol="full", error="mpi/deadlock")
 
+    def test_cascade_por(self):
+        self.program("cascade")
+        self.execute(6, "1 0", send_protocol="eager")
+        nodes = self.report.get_analysis_value("nodes")
+        arcs = self.report.get_analysis_value("arcs")
+        self.execute(6, "1 0", send_protocol="eager", por=True)
+        # Each receive has the only one matching send,
+        # hence there is nothing to reduce
+        self.assertEquals(nodes, self.report.get_analysis_value("nodes"))
+        self.assertEquals(arcs, self.report.get_analysis_value("arcs"))
+        self.execute(6, "0 0", send_protocol="full", por=True)
+        self.execute(6, "1 1", send_protocol="full", error="mpi/deadlock",
+                     por=True)
+
+    def test_masterworker_por(self):
+        self.program("masterworker")
+        self.execute(6, "0")
+        nodes = self.report.get_analysis_value("nodes")
+        arcs = self.report.get_analysis_value("arcs")
+        self.execute(6, "0", por=True)
+        self.assertEquals(nodes, self.report.get_analysis_value("nodes"))
+        self.assertTrue(arcs > self.report.get_analysis_value("arcs"))
+
+        self.execute(6, "1", error="mpi/deadlock")
+        self.execute(6, "1", error="mpi/deadlock", por=True)
+        self.execute(6, "1", error="mpi/deadlock", por=True,
+                     worker_processes=True)
+
     def test_twocc(self):
         self.program("twocc")
         self.execute(3, send_protocol="eager")
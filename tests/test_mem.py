@@ -31,6 +31,16 @@ class MemTests(TestCase):
         self.program("leak")
         self.execute(2, "100")
         self.execute(3, "100", error="mem/nondeterministic-leak")
+        self.execute(3, "100", error="mem/nondeterministic-leak", por=True)
+
+    def test_leak_por(self):
+        self.program("leakmasters")
+        self.execute(6, error="mem/nondeterministic-leak")
+        nodes = self.report.get_analysis_value("nodes")
+        arcs = self.report.get_analysis_value("arcs")
+        self.execute(6, error="mem/nondeterministic-leak", por=True)
+        self.assertEquals(nodes, self.report.get_analysis_value("nodes"))
+        self.assertTrue(arcs > self.report.get_analysis_value("arcs"))
 
     def test_malloc_free(self):
         self.program("mallocfree")
@@ -73,6 +83,8 @@ class MemTests(TestCase):
         self.program("lockedmem")
         self.execute(2, "1", error="mem/invalid-write")
         self.execute(2, "2", error="mem/invalid-write")
+        self.execute(2, "1", error="mem/invalid-write",
+                     event_stacktraces=True)
 
     def test_lockedmem_persistent(self):
         self.program("lockedmem-persistent")
@@ -1,4 +1,6 @@
 from utils import TestCase
+import os
+import tempfile
 import unittest
 from vgtool.controller import make_interconnection
 
@@ -97,6 +99,29 @@ class VgTransferTests(TestCase):
 
         assert h1 == h2
 
+    def test_spill_load(self):
+        self.program("string")
+        c = self.controller()
+        c.start_and_connect()
+        c.client_malloc(1024 * 1024 * 5)
+        h1 = c.hash_state()
+        state_id = c.save_state()
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            c.spill_state(state_id, filename)
+            c.free_state(state_id)
+            d = self.controller()
+            d.start_and_connect()
+            s1 = d.load_state(filename)
+            s2 = c.load_state(filename)
+        finally:
+            os.remove(filename)
+        d.restore_state(s1)
+        c.restore_state(s2)
+        assert h1 == d.hash_state()
+        assert h1 == c.hash_state()
+
     def test_connect(self):
         self.program("string")
         c = self.controller()
@@ -112,6 +137,22 @@ class VgTransferTests(TestCase):
         assert c_sock > 0
         assert d_sock > 0
 
+    def test_connect_unix(self):
+        self.program("string")
+        c = self.controller()
+        c.start_and_connect()
+        path = c.interconn_listen_unix()
+
+        d = self.controller()
+        d.start_and_connect()
+        d.interconn_connect(path)
+
+        c_sock = c.interconn_listen_finish()
+        d_sock = d.interconn_connect_finish()
+        assert c_sock > 0
+        assert d_sock > 0
+        assert not os.path.exists(path)
+
     def test_interconnect(self):
         self.program("string")
         controllers = [self.controller() for c in xrange(6)]
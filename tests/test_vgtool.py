@@ -1,8 +1,13 @@
 
 from utils import TestCase
+from vgtool.controller import ControllerPoller, SharedSegment
 import unittest
+import hashlib
 import os
+import shutil
+import socket
 import subprocess
+import tempfile
 
 
 class VgToolTests(TestCase):
@@ -200,6 +205,164 @@ class VgToolTests(TestCase):
         c.free_buffer(500)
         c.free_buffer(600)
 
+    def test_free_many(self):
+        self.program("two_allocations")
+        c = self.controller()
+        c.start_and_connect()
+        c.FREE_IDS_LIMIT = 3
+        memory = c.get_stats()["state-memory"]
+        states = [c.save_state() for i in xrange(10)]
+        self.assertTrue(c.get_stats()["state-memory"] > memory)
+        for i in xrange(10):
+            c.make_buffer(500 + i, 1000)
+        c.free_states(states)
+        c.free_buffers(range(500, 510))
+        stats = c.get_stats()
+        self.assertEquals(stats["pages"], stats["active-pages"])
+        self.assertEquals(stats["buffers-size"], 0)
+
+    def test_batch(self):
+        self.program("two_allocations")
+        c = self.controller()
+        mem1 = int(c.start_and_connect().split()[2])
+        mem2 = int(c.run_process().split()[2])
+        data = "abcABCwxyz" * 10000
+        c.start_batch()
+        c.make_buffer(500, 100000)
+        c.write_data_into_buffer(500, 0, data)
+        c.write_buffer(mem2, 500)
+        c.write_int(mem1, 10)
+        # Answer is expected, batch is sent
+        self.assertEquals(10, c.read_int(mem1))
+        c.write_int(mem1, 20)
+        c.free_buffer(500)
+        c.finish_batch()
+        self.assertEquals(20, c.read_int(mem1))
+        self.assertEquals(data, c.read_mem(mem2, 100000))
+        self.assertEquals("EXIT 0", c.run_process())
+
+    def test_shm_size(self):
+        self.program("two_allocations")
+        for shm_size in (0, 1000):
+            c = self.controller()
+            c.shm_size = shm_size
+            mem1 = int(c.start_and_connect().split()[2])
+            mem2 = int(c.run_process().split()[2])
+            c.make_buffer(600, 100000)
+            data1 = "abc123"
+            data2 = "abcABCwxyz" * 10000
+            c.write_data(mem1, data1)
+            c.write_data_into_buffer(600, 0, data2)
+            c.write_buffer(mem2, 600)
+            self.assertEquals(data1, c.read_mem(mem1, 6))
+            self.assertEquals(data2, c.read_mem(mem2, 100000))
+            self.assertEquals(data2, c.read_buffer(600, 100000))
+            self.assertEquals("EXIT 0", c.run_process())
+
+    def test_segment(self):
+        self.program("two_allocations")
+        segment = SharedSegment(200000)
+        try:
+            c1 = self.controller()
+            c1.segment = segment
+            c1.start_and_connect()
+            mem = int(c1.run_process().split()[2])
+            c2 = self.controller()
+            c1.clone(c2)
+            data = "abcABCwxyz" * 10000
+            segment.mmap[1000:101000] = data
+            for c in (c1, c2):
+                c.make_buffer_from_segment(600, 1000, 100000)
+                c.write_buffer(mem, 600)
+                self.assertEquals(data, c.read_mem(mem, 100000))
+                h = c.pack_into_segment(150000, [(mem + 3, 5), (mem, 3)])
+                self.assertEquals("ABCwxabc", segment.mmap[150000:150008])
+                self.assertEquals(hashlib.md5("ABCwxabc").hexdigest(), h)
+                self.assertEquals("EXIT 0", c.run_process())
+            c2.kill()
+        finally:
+            segment.close()
+
+    def test_text_protocol(self):
+        self.program("two_allocations")
+        c = self.controller()
+        c.binary_protocol = False
+        mem1 = int(c.start_and_connect().split()[2])
+        mem2 = int(c.run_process().split()[2])
+        c.write_ints(mem1, [10, -20])
+        self.assertEquals([10, -20], c.read_ints(mem1, 2))
+        c.write_pointer(mem2, mem1)
+        self.assertEquals(mem1, c.read_pointer(mem2))
+        state = c.save_state()
+        c.write_int(mem1, 30)
+        c.restore_state(state)
+        self.assertEquals(10, c.read_int(mem1))
+        self.assertEquals("EXIT 0", c.run_process())
+
+    def test_poller(self):
+        self.program("simple")
+        poller = ControllerPoller()
+        controllers = [self.controller() for i in xrange(3)]
+        for c in controllers:
+            c.poller = poller
+            self.assertEquals(c.start_and_connect(), "CALL Hello 1")
+        self.assertFalse(poller.has_running())
+        for c in controllers:
+            c.run_process_async()
+        self.assertTrue(poller.has_running())
+        finished = []
+        while poller.has_running():
+            for c in poller.poll():
+                self.assertEquals(c.finish_async(), "CALL Hello 2")
+                finished.append(c)
+        self.assertEquals(set(finished), set(controllers))
+        for c in controllers:
+            self.assertEquals(c.run_process(), "EXIT 0")
+        poller.close()
+
+    def test_reconnect_and_reset(self):
+        self.program("simple")
+        c1 = self.controller()
+        line = c1.start_and_connect()
+        self.assertEquals(line, "CALL Hello 1")
+        state = c1.save_state()
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "conn")
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            sock.listen(1)
+            c1.reconnect(path)
+            c2 = self.controller()
+            c2.attach(sock.accept()[0], line + "\n")
+            sock.close()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEquals(c2.receive_line(), "CALL Hello 1")
+        self.assertEquals(c2.run_process(), "CALL Hello 2")
+        c2.make_buffer(500, 10)
+        c2.save_state()
+        self.assertEquals(c2.run_process(), "EXIT 0")
+        self.assertTrue(c2.reset(state))
+        self.assertEquals(c2.run_process(), "CALL Hello 2")
+        self.assertEquals(c2.run_process(), "EXIT 0")
+        c1.kill()
+
+    def test_clone(self):
+        self.program("simple")
+        c1 = self.controller()
+        self.assertEquals(c1.start_and_connect(), "CALL Hello 1")
+        h = c1.hash_state()
+        c2 = self.controller()
+        c1.clone(c2)
+        self.assertEquals(h, c1.hash_state())
+        self.assertEquals(h, c2.hash_state())
+        self.assertEquals(c1.run_process(), "CALL Hello 2")
+        self.assertEquals(c2.run_process(), "CALL Hello 2")
+        self.assertEquals(c1.run_process(), "EXIT 0")
+        self.assertEquals(c2.run_process(), "EXIT 0")
+        c2.kill()
+
     def test_lock_and_restore(self):
         self.program("two_allocations")
         c = self.controller()
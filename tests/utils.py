@@ -1,9 +1,11 @@
 import os
+import signal
 import subprocess
 import shutil
 import unittest
 import xml.etree.ElementTree as xml
 import sys
+import time
 
 AISLINN_TESTS = os.path.dirname(os.path.abspath(__file__))
 AISLINN_ROOT = os.path.dirname(AISLINN_TESTS)
@@ -42,10 +44,12 @@ class TestCase(unittest.TestCase):
         self.reset_output_on_change = True
         self.counter = None
         self.controllers = []
+        self.zygote_server = None
 
     def tearDown(self):
         for c in self.controllers:
             c.kill()
+        self.stop_zygote_server()
 
     def read_report(self):
         filename = os.path.join(AISLINN_BUILD, "report.xml")
@@ -102,7 +106,23 @@ class TestCase(unittest.TestCase):
                 send_protocol="full",
                 heap_size=None,
                 redzone_size=None,
-                profile=False):
+                profile=False,
+                worker_processes=False,
+                por=False,
+                search=None,
+                search_watermarks=None,
+                spill_queue=None,
+                state_memory=None,
+                gcontexts=None,
+                fake_remote=False,
+                clone_workers=False,
+                sample=None,
+                sample_seed=None,
+                replay=None,
+                event_stacktraces=False,
+                no_local_answers=False,
+                max_states=None,
+                zygote=None):
         aislinn_args = {"report-type": "xml",
                         "workers": 2,
                         "verbose": 0,
@@ -132,6 +152,55 @@ class TestCase(unittest.TestCase):
         if profile:
             aislinn_args["profile"] = None
 
+        if worker_processes:
+            aislinn_args["worker-processes"] = None
+
+        if max_states is not None:
+            aislinn_args["max-states"] = max_states
+
+        if fake_remote:
+            aislinn_args["fake-remote"] = None
+
+        if clone_workers:
+            aislinn_args["clone-workers"] = None
+
+        if por:
+            aislinn_args["por"] = None
+
+        if search:
+            aislinn_args["search"] = search
+
+        if search_watermarks:
+            aislinn_args["search-watermarks"] = search_watermarks
+
+        if spill_queue:
+            aislinn_args["spill-queue"] = spill_queue
+
+        if state_memory:
+            aislinn_args["state-memory"] = state_memory
+
+        if gcontexts:
+            aislinn_args["gcontexts"] = gcontexts
+
+        if sample:
+            aislinn_args["sample"] = sample
+
+        if sample_seed is not None:
+            aislinn_args["sample-seed"] = sample_seed
+
+        if replay is not None:
+            aislinn_args["replay"] = replay
+
+        if event_stacktraces:
+            aislinn_args["event-stacktraces"] = None
+
+        if no_local_answers:
+            aislinn_args["debug-no-local-answers"] = None
+
+        if zygote:
+            aislinn_args["zygote"] = zygote
+            aislinn_args["workers"] = 1
+
         if stdout is not None:
             aislinn_args["stdout"] = "print"
             check_output = False
@@ -205,6 +274,26 @@ class TestCase(unittest.TestCase):
                             set_to_sorted_list(
                                 expected_outputs - program_outputs)))
 
+    def start_zygote_server(self, processes, args=()):
+        self.assertTrue(self.program_instance is not None)
+        path = os.path.join(AISLINN_BUILD, "zygote")
+        if os.path.exists(path):
+            os.unlink(path)
+        if isinstance(args, str):
+            args = args.split()
+        self.zygote_server = self.program_instance.start_zygote_server(
+            path, processes, args)
+        while not os.path.exists(path):
+            self.assertTrue(self.zygote_server.poll() is None)
+            time.sleep(0.05)
+        return path
+
+    def stop_zygote_server(self):
+        if self.zygote_server is not None:
+            self.zygote_server.send_signal(signal.SIGINT)
+            self.zygote_server.wait()
+            self.zygote_server = None
+
     def controller(self, args=(), verbose=False, profile=False):
         self.assertTrue(self.program_instance is not None)
         self.report = None
@@ -236,6 +325,22 @@ def run(args,
     return (p.returncode, stdout, stderr)
 
 
+def get_child_pids(pid):
+    pids = set()
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", name, "stat")) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # The name of the program may contain spaces
+        if int(stat[stat.rindex(")") + 2:].split()[1]) == pid:
+            pids.add(int(name))
+    return pids
+
+
 def check_prefix(prefix):
     def fn(value):
         if not value.startswith(prefix):
@@ -310,6 +415,12 @@ class Program:
                             .format(exitcode, stdout, stderr))
         return stdout, stderr
 
+    def start_zygote_server(self, path, processes, program_args):
+        run_args = [AISLINN, "-p={0}".format(processes), "--verbose=0",
+                    "--zygote-server={0}".format(path), "./a.out"]
+        run_args += list(program_args)
+        return subprocess.Popen(run_args, cwd=AISLINN_BUILD)
+
     def controller(self, args, verbose, profile):
         controller = vgtool.controller.Controller(
             base.paths.VALGRIND_BIN, ("./a.out",) + args, AISLINN_BUILD)
@@ -358,6 +469,12 @@ class Report:
         return int(self.root.find("analysis").find(
             "deterministic-non-freed-memory").text)
 
+    def get_analysis_value(self, name):
+        return int(self.get_analysis_text(name))
+
+    def get_analysis_text(self, name):
+        return self.root.find("analysis").find(name).text
+
     def get_icounts(self, name):
         profile = self.root.find("profile")
         return map(str, profile.find("instructions").find(name).text.split())